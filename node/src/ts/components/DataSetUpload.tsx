@@ -212,7 +212,7 @@ export default class DataSetUpload extends React.Component<Props, {}> {
             </span>
             <input
               type="file"
-              accept=".ttl,.nt,.xml,.owl,.rdf"
+              accept=".ttl,.nt,.xml,.owl,.rdf,.gz,.bz2,.xz,.zip"
               ref={this.ontologyFileRef}
               onChange={this.onChangeOntologyFile}
             />
@@ -232,7 +232,7 @@ export default class DataSetUpload extends React.Component<Props, {}> {
             </span>
             <input
               type="file"
-              accept=".ttl,.nt"
+              accept=".ttl,.nt,.gz,.bz2,.xz,.zip"
               ref={this.sbmFileRef}
               onChange={this.onChangeSbmFile}
             />
@@ -67,6 +67,11 @@ export namespace FormAttributes {
       PROPERTIES_ASC = 4,
       UPLOAD_AT_DESC = 5,
       UPLOAD_AT_ASC = 6,
+      RELEVANCE = 7,
+      TRIPLES_DESC = 8,
+      TRIPLES_ASC = 9,
+      CRAWLED_AT_DESC = 10,
+      CRAWLED_AT_ASC = 11,
     }
     export const SORT_TYPES = [
       { value: SortValue.CLASSES_DESC, id: 'sortBy.descendingNumberOfClass' },
@@ -81,6 +86,17 @@ export namespace FormAttributes {
       },
       { value: SortValue.UPLOAD_AT_DESC, id: 'sortBy.descendingDateUploaded' },
       { value: SortValue.UPLOAD_AT_ASC, id: 'sortBy.ascendingDateUploaded' },
+      { value: SortValue.RELEVANCE, id: 'sortBy.relevance' },
+      {
+        value: SortValue.TRIPLES_DESC,
+        id: 'sortBy.descendingNumberOfTriple',
+      },
+      { value: SortValue.TRIPLES_ASC, id: 'sortBy.ascendingNumberOfTriple' },
+      {
+        value: SortValue.CRAWLED_AT_DESC,
+        id: 'sortBy.descendingDateCrawled',
+      },
+      { value: SortValue.CRAWLED_AT_ASC, id: 'sortBy.ascendingDateCrawled' },
     ]
   }
 }
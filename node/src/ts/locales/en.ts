@@ -115,6 +115,11 @@ const MESSAGES: IMessage = {
   'sortBy.ascendingNumberOfProperty': 'Ascending in number of property',
   'sortBy.descendingDateUploaded': 'Descending in date of upload',
   'sortBy.ascendingDateUploaded': 'Ascending in date of upload',
+  'sortBy.relevance': 'Relevance to search words',
+  'sortBy.descendingNumberOfTriple': 'Descending in number of triple',
+  'sortBy.ascendingNumberOfTriple': 'Ascending in number of triple',
+  'sortBy.descendingDateCrawled': 'Descending in date of crawl',
+  'sortBy.ascendingDateCrawled': 'Ascending in date of crawl',
   'admin.dataSetList.buttonDelete': 'Delete selected items',
   'admin.dataSetList.tableTitle': 'Title',
   'admin.dataSetList.tableUri': 'URI',
@@ -116,6 +116,11 @@ const MESSAGES: IMessage = {
   'sortBy.ascendingNumberOfProperty': 'プロパティ数が少ない順',
   'sortBy.descendingDateUploaded': '作成日時が新しい順',
   'sortBy.ascendingDateUploaded': '作成日時が古い順',
+  'sortBy.relevance': '検索語との関連度が高い順',
+  'sortBy.descendingNumberOfTriple': 'トリプル数が多い順',
+  'sortBy.ascendingNumberOfTriple': 'トリプル数が少ない順',
+  'sortBy.descendingDateCrawled': 'クロール日時が新しい順',
+  'sortBy.ascendingDateCrawled': 'クロール日時が古い順',
   'admin.dataSetList.buttonDelete': '選択したデータを削除する',
   'admin.dataSetList.tableTitle': 'タイトル',
   'admin.dataSetList.tableUri': 'URI',
@@ -0,0 +1,47 @@
+"""Add DataSet class and property URI index
+
+Revision ID: 2e7b9f1c6d08
+Revises: 8d41c2e7f5a3
+Create Date: 2026-10-18 15:06:42.118375
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2e7b9f1c6d08'
+down_revision = '8d41c2e7f5a3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'data_set_classes',
+        sa.Column('data_set_id', sa.Integer(), nullable=False),
+        sa.Column('uri_hash', sa.String(length=64), nullable=False),
+        sa.Column('uri', sa.Text(), nullable=False),
+        sa.Column('entities', sa.BigInteger(), nullable=True),
+        sa.ForeignKeyConstraint(['data_set_id'], ['data_sets.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('data_set_id', 'uri_hash')
+    )
+    op.create_index('class_uri_entities_idx', 'data_set_classes', ['uri_hash', 'entities'], unique=False)
+    op.create_table(
+        'data_set_properties',
+        sa.Column('data_set_id', sa.Integer(), nullable=False),
+        sa.Column('uri_hash', sa.String(length=64), nullable=False),
+        sa.Column('uri', sa.Text(), nullable=False),
+        sa.Column('triples', sa.BigInteger(), nullable=True),
+        sa.ForeignKeyConstraint(['data_set_id'], ['data_sets.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('data_set_id', 'uri_hash')
+    )
+    op.create_index('property_uri_triples_idx', 'data_set_properties', ['uri_hash', 'triples'], unique=False)
+    # 既存のDataSetは python manage.py build_uri_index で登録する
+
+
+def downgrade():
+    op.drop_index('property_uri_triples_idx', table_name='data_set_properties')
+    op.drop_table('data_set_properties')
+    op.drop_index('class_uri_entities_idx', table_name='data_set_classes')
+    op.drop_table('data_set_classes')
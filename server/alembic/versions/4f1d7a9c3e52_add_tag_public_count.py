@@ -0,0 +1,32 @@
+"""Add Tag public count
+
+Revision ID: 4f1d7a9c3e52
+Revises: 6c3a8e2d4b17
+Create Date: 2026-10-18 18:21:09.534107
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4f1d7a9c3e52'
+down_revision = '6c3a8e2d4b17'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('tags', sa.Column('public_count', sa.Integer(), server_default='0', nullable=False))
+    op.create_index('tag_public_count_idx', 'tags', ['public_count'], unique=False)
+    op.execute(
+        "UPDATE tags SET public_count = ("
+        "SELECT COUNT(*) FROM data_set_tag_association "
+        "JOIN data_sets ON data_sets.id = data_set_tag_association.data_set_id "
+        "WHERE data_set_tag_association.tag_id = tags.id AND data_sets.is_public = 1)"
+    )
+
+
+def downgrade():
+    op.drop_index('tag_public_count_idx', table_name='tags')
+    op.drop_column('tags', 'public_count')
@@ -0,0 +1,25 @@
+"""Add DataSet content sections
+
+Revision ID: 6c3a8e2d4b17
+Revises: 2e7b9f1c6d08
+Create Date: 2026-10-18 16:31:19.804522
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6c3a8e2d4b17'
+down_revision = '2e7b9f1c6d08'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('data_sets', sa.Column('content_sections', sa.JSON(), nullable=True))
+    # 既存のDataSetは python manage.py build_content_sections で分ける
+
+
+def downgrade():
+    op.drop_column('data_sets', 'content_sections')
@@ -0,0 +1,42 @@
+"""Add DataSet fulltext search
+
+Revision ID: 8d41c2e7f5a3
+Revises: 5b8e2d7c4a19
+Create Date: 2026-10-18 14:22:08.531947
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql
+
+
+# revision identifiers, used by Alembic.
+revision = '8d41c2e7f5a3'
+down_revision = '5b8e2d7c4a19'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('data_sets', sa.Column('search_tags', sa.Text(), nullable=False))
+    op.add_column('data_sets', sa.Column('search_text', mysql.MEDIUMTEXT(), nullable=False))
+    op.execute(
+        "UPDATE data_sets SET search_tags = COALESCE(("
+        "SELECT GROUP_CONCAT(tags.name ORDER BY tags.name SEPARATOR ' ') "
+        "FROM data_set_tag_association JOIN tags ON tags.id = data_set_tag_association.tag_id "
+        "WHERE data_set_tag_association.data_set_id = data_sets.id), '')"
+    )
+    # ngramパーサーでは1文字のストップワード(a, iなど)を含むトークンがすべて除かれるので使わない
+    op.execute("SET SESSION innodb_ft_enable_stopword = OFF")
+    op.execute(
+        "CREATE FULLTEXT INDEX search_fulltext_idx ON data_sets (title, search_tags, search_text) WITH PARSER ngram"
+    )
+    op.execute("CREATE FULLTEXT INDEX title_fulltext_idx ON data_sets (title) WITH PARSER ngram")
+    # search_textは python manage.py build_search_texts で作る
+
+
+def downgrade():
+    op.drop_index('title_fulltext_idx', table_name='data_sets')
+    op.drop_index('search_fulltext_idx', table_name='data_sets')
+    op.drop_column('data_sets', 'search_text')
+    op.drop_column('data_sets', 'search_tags')
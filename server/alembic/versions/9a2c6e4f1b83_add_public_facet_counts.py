@@ -0,0 +1,33 @@
+"""Add public facet counts
+
+Revision ID: 9a2c6e4f1b83
+Revises: 4f1d7a9c3e52
+Create Date: 2026-10-18 19:02:47.210936
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9a2c6e4f1b83'
+down_revision = '4f1d7a9c3e52'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'public_facet_counts',
+        sa.Column('facet', sa.String(length=32), nullable=False),
+        sa.Column('value', sa.String(length=255), nullable=False),
+        sa.Column('count', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('facet', 'value')
+    )
+    op.create_index('facet_count_idx', 'public_facet_counts', ['facet', 'count'], unique=False)
+    # 既存の公開DataSetは python manage.py build_facet_counts で数える
+
+
+def downgrade():
+    op.drop_index('facet_count_idx', table_name='public_facet_counts')
+    op.drop_table('public_facet_counts')
@@ -0,0 +1,35 @@
+"""Add DataSet triples, crawl date and endpoint host columns
+
+Revision ID: b7e3d5a8c214
+Revises: 9a2c6e4f1b83
+Create Date: 2026-10-18 19:48:13.671204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7e3d5a8c214'
+down_revision = '9a2c6e4f1b83'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute("ALTER TABLE data_sets ADD COLUMN meta_data_triples BIGINT GENERATED ALWAYS AS (JSON_EXTRACT(meta_data, '$.triples')) STORED")
+    op.add_column('data_sets', sa.Column('crawled_at', sa.DateTime(), nullable=True))
+    op.add_column('data_sets', sa.Column('endpoint_host', sa.String(length=255), nullable=True))
+    op.create_index('public_triples_idx', 'data_sets', ['is_public', 'meta_data_triples'], unique=False)
+    op.create_index('public_crawled_idx', 'data_sets', ['is_public', 'crawled_at'], unique=False)
+    op.create_index('public_endpoint_host_idx', 'data_sets', ['is_public', 'endpoint_host'], unique=False)
+    # 既存のDataSetのcrawled_atとendpoint_hostは python manage.py build_meta_data_columns で設定する
+
+
+def downgrade():
+    op.drop_index('public_endpoint_host_idx', table_name='data_sets')
+    op.drop_index('public_crawled_idx', table_name='data_sets')
+    op.drop_index('public_triples_idx', table_name='data_sets')
+    op.drop_column('data_sets', 'endpoint_host')
+    op.drop_column('data_sets', 'crawled_at')
+    op.drop_column('data_sets', 'meta_data_triples')
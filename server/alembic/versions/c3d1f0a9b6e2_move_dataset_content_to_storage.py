@@ -0,0 +1,40 @@
+"""Move DataSet content to content storage
+
+Revision ID: c3d1f0a9b6e2
+Revises: 777453724560
+Create Date: 2026-10-18 10:12:31.402815
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3d1f0a9b6e2'
+down_revision = '777453724560'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('data_sets', sa.Column('content_hash', sa.String(length=64), nullable=True))
+    op.add_column('data_sets', sa.Column('content_size', sa.BigInteger(), nullable=True))
+    op.add_column('data_sets', sa.Column('content_stored_size', sa.BigInteger(), nullable=True))
+    op.add_column('data_sets', sa.Column('meta_data', sa.JSON(), nullable=True))
+    op.create_index(op.f('ix_data_sets_content_hash'), 'data_sets', ['content_hash'], unique=False)
+    op.execute("UPDATE data_sets SET meta_data = JSON_EXTRACT(content, '$.meta_data')")
+    # Virtualカラムをcontentではなくmeta_dataから作る
+    op.execute("ALTER TABLE data_sets MODIFY COLUMN meta_data_classes INT GENERATED ALWAYS AS (JSON_EXTRACT(meta_data, '$.classes'))")
+    op.execute("ALTER TABLE data_sets MODIFY COLUMN meta_data_properties INT GENERATED ALWAYS AS (JSON_EXTRACT(meta_data, '$.properties'))")
+    # contentの移行は python manage.py migrate_contents で行う
+
+
+def downgrade():
+    # content_storageに移行済みのデータは python manage.py restore_contents で戻しておくこと
+    op.execute("ALTER TABLE data_sets MODIFY COLUMN meta_data_classes INT GENERATED ALWAYS AS (JSON_EXTRACT(content, '$.meta_data.classes'))")
+    op.execute("ALTER TABLE data_sets MODIFY COLUMN meta_data_properties INT GENERATED ALWAYS AS (JSON_EXTRACT(content, '$.meta_data.properties'))")
+    op.drop_index(op.f('ix_data_sets_content_hash'), table_name='data_sets')
+    op.drop_column('data_sets', 'meta_data')
+    op.drop_column('data_sets', 'content_stored_size')
+    op.drop_column('data_sets', 'content_size')
+    op.drop_column('data_sets', 'content_hash')
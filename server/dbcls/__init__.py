@@ -4,8 +4,13 @@ from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
 import redis
 from .datetimeformat import datetimeformat
+from .storage import create_content_storage
+from .payload import PayloadCache
+from .asset_cache import AssetCache
+from .upload import Request
 
 app = Flask(__name__)
+app.request_class = Request
 config_name = os.getenv("APP_ENV").capitalize()
 app.config.from_object(f'dbcls.config.{config_name}Config')
 app.jinja_env.filters['datetimeformat'] = datetimeformat
@@ -15,5 +20,12 @@ db = SQLAlchemy(app)
 CORS(app)
 
 redis_client = redis.Redis(**app.config['REDIS'])
+# 圧縮したデータなどバイト列を保存する場合に使う
+binary_redis_client = redis.Redis(**{**app.config['REDIS'], 'decode_responses': False})
+
+content_storage = create_content_storage(app.config['CONTENT_STORAGE'])
+payload_cache = PayloadCache(app.config['PAYLOAD_CACHE_PATH'])
+index_asset_cache = AssetCache(**app.config['INDEX_ASSET_CACHE'])
+converted_ontology_cache = AssetCache(**app.config['CONVERTED_ONTOLOGY_CACHE'])
 
 import dbcls.api.app  # noqa
@@ -7,16 +7,20 @@ from firebase_admin import auth as firebase_auth
 from google.auth.exceptions import TransportError
 
 from dbcls import app
-from dbcls.api.resources.proxy import Proxy
-from dbcls.models import User, UserRole, UserRoleTypes
+from dbcls.auth import use_shared_certificate_cache, verify_id_token, load_user
+from dbcls.models import UserRoleTypes
 from dbcls.api.resources.signup import SignUp
 from dbcls.api.resources.authenticate import Authenticate
 from dbcls.api.resources.data_set import (
     DataSetList, VisualizedDataSet, DataSetDetail, PublicDataSetList, DataSetGenerator,
-    DataSetGenerateProcessStatus
+    DataSetGenerateProcessStatus, DataSetGenerateProcessEvents, PublicUriUsageList, DataSetBulkUpload,
+    DataSetBulkUploadStatus
 )
 from dbcls.api.resources.user import Me, MyCustomToken
-from dbcls.api.resources.admin import AdminDataSetList, AdminDataSetDetail
+from dbcls.api.resources.tag import TagList
+from dbcls.api.resources.admin import (
+    AdminDataSetList, AdminDataSetDetail, AdminDataSetBulkDelete, AdminDataSetBulkDeleteStatus, AdminCacheStats
+)
 
 
 @app.before_first_request
@@ -26,6 +30,7 @@ def before_first_request():
     if VARIABEL_GOOGLE_CREDENTIALS not in os.environ:
         os.environ[VARIABEL_GOOGLE_CREDENTIALS] = app.config['GOOGLE_CREDENTIALS_PATH']
     firebase_admin.initialize_app()
+    use_shared_certificate_cache()
 
 
 class Healthy(Resource):
@@ -40,8 +45,8 @@ def verify_authentication():
         abort(401)
     try:
         token = authorization.replace('Bearer ', '')
-        decoded_token = firebase_auth.verify_id_token(token)
-        g.user = User.query.filter_by(firebase_uid=decoded_token['uid']).first()
+        decoded_token = verify_id_token(token)
+        g.user, g.user_role_types = load_user(decoded_token['uid'])
     except (ValueError, firebase_auth.AuthError, TransportError) as e:
         abort(401)
 
@@ -56,19 +61,23 @@ api_v1.add_resource(Healthy, '/healthy', endpoint='healthy')
 api_v1.add_resource(SignUp, '/signup', endpoint='signup')
 api_v1.add_resource(Authenticate, '/auth', endpoint='auth')
 api_v1.add_resource(DataSetList, '/data_sets')
-api_v1.add_resource(Proxy, '/proxy', endpoint='proxy')
 api_v1.add_resource(DataSetDetail, '/data_sets/<int:id>')
+api_v1.add_resource(DataSetBulkUpload, '/data_sets/bulk')
+api_v1.add_resource(DataSetBulkUploadStatus, '/data_sets/bulk/<task_id>')
 api_v1.add_resource(DataSetGenerator, '/data_sets/generate')
 api_v1.add_resource(DataSetGenerateProcessStatus, '/data_sets/generate/<task_id>')
+api_v1.add_resource(DataSetGenerateProcessEvents, '/data_sets/generate/<task_id>/events')
 api_v1.add_resource(VisualizedDataSet, '/visualize/<path>', endpoint='visualize')
 api_v1.add_resource(PublicDataSetList, '/public_data_sets', endpoint='public_data_sets')
+api_v1.add_resource(PublicUriUsageList, '/public_data_sets/uri_usages', endpoint='public_uri_usages')
+api_v1.add_resource(TagList, '/tags', endpoint='tags')
 api_v1.add_resource(Me, '/me')
 api_v1.add_resource(MyCustomToken, '/me/custom_token')
 
 
 NOT_NEED_AUTHORIZATION_ENDPOINTS = [
     f'{api_v1_bp.name}.{endpoint}'
-    for endpoint in ('healthy', 'signup', 'auth', 'public_data_sets', 'visualize', 'proxy')
+    for endpoint in ('healthy', 'signup', 'auth', 'public_data_sets', 'public_uri_usages', 'visualize', 'tags')
 ]
 
 
@@ -87,6 +96,9 @@ admin_api_v1_bp = Blueprint('admin_api_v1', __name__, url_prefix='/api/v1/admin'
 admin_api_v1 = Api(admin_api_v1_bp)
 admin_api_v1.add_resource(AdminDataSetList, '/data_sets')
 admin_api_v1.add_resource(AdminDataSetDetail, '/data_sets/<int:id>')
+admin_api_v1.add_resource(AdminDataSetBulkDelete, '/data_sets/bulk_delete')
+admin_api_v1.add_resource(AdminDataSetBulkDeleteStatus, '/data_sets/bulk_delete/<task_id>')
+admin_api_v1.add_resource(AdminCacheStats, '/cache_stats')
 
 
 @admin_api_v1_bp.before_request
@@ -96,15 +108,7 @@ def has_admin_role():
 
     verify_authentication()
 
-    admin_role = (
-        UserRole.query
-        .filter(
-            UserRole.role_type==UserRoleTypes.ADMIN.value,
-            UserRole.users.contains(g.user)
-        )
-        .first()
-    )
-    if not admin_role:
+    if UserRoleTypes.ADMIN.value not in g.user_role_types:
         abort(404)
 
 
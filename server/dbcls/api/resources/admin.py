@@ -1,15 +1,25 @@
+import datetime
+import json
+import time
 import urllib.parse
+from uuid import uuid4
 
-from flask import request
-from flask_restful import Resource, reqparse
+from flask import g, request
+from flask_restful import Resource, reqparse, inputs
 
-from dbcls import db
+from dbcls import db, redis_client
+from dbcls.cache import public_data_sets_cache, data_set_count_cache, result_caches
+from dbcls.constants import TASK_PROPERTIES_EXPIRE
+from dbcls.pagination import paginate, InvalidCursorError
+from dbcls.task_queue import delete_task_queue
+from dbcls.tasks import TaskState, is_task_lost
 from dbcls.utils import localize_as_jst
-from dbcls.models import DataSet, User
+from dbcls.models import DataSet, User, delete_data_sets
 
 
 parser = reqparse.RequestParser()
 parser.add_argument('page', type=int, location='args', default=1)
+parser.add_argument('cursor', type=str, location='args', default=None)
 SIZE_PER_PAGE = 50
 
 
@@ -27,26 +37,53 @@ class AdminDataSetList(Resource):
         return {
             'page': page,
             'offset': offset,
+            'cursor': args['cursor'],
         }
 
+    def _count(self):
+        # 件数は更新があるまでキャッシュしておく
+        cache_key = data_set_count_cache.key({'public': False})
+        count = data_set_count_cache.get(cache_key)
+        if count is None:
+            count = DataSet.query.count()
+            data_set_count_cache.set(cache_key, count)
+        return count
+
     def get(self):
         args = self._parse_args()
-        query = DataSet.query.join(DataSet.user).with_entities(DataSet.id, DataSet.title, DataSet.path, DataSet.is_public, DataSet.upload_at, User.display_name, User.contact_uri).order_by(DataSet.upload_at.desc())
-        count = query.count()
-        query = query.offset(args['offset']).limit(SIZE_PER_PAGE)
-        # 前ページ
-        previousUrl = None
-        if args['offset'] >= 1:
-            params = {'page': args['page'] - 1}
-            params_string = urllib.parse.urlencode(params)
-            previousUrl = f'{request.path}?{params_string}'
-
-        # 次ページ
-        nextUrl = None
-        if args['offset'] + SIZE_PER_PAGE < count:
-            params = {'page': args['page'] + 1}
-            params_string = urllib.parse.urlencode(params)
-            nextUrl = f'{request.path}?{params_string}'
+        query = DataSet.query.join(DataSet.user).with_entities(DataSet.id, DataSet.title, DataSet.path, DataSet.is_public, DataSet.upload_at, User.display_name, User.contact_uri)
+        count = self._count()
+
+        if args['cursor'] is not None:
+            # カーソルを指定した場合はOFFSETを使わない
+            try:
+                page = paginate(query, DataSet.upload_at, DataSet.id, True, args['cursor'], SIZE_PER_PAGE)
+            except InvalidCursorError:
+                return {'message': 'cursor is invalid'}, 400
+            data_sets = page.rows
+            previousUrl = None
+            if page.previous_cursor:
+                params_string = urllib.parse.urlencode({'cursor': page.previous_cursor})
+                previousUrl = f'{request.path}?{params_string}'
+            nextUrl = None
+            if page.next_cursor:
+                params_string = urllib.parse.urlencode({'cursor': page.next_cursor})
+                nextUrl = f'{request.path}?{params_string}'
+        else:
+            data_sets = query.order_by(DataSet.upload_at.desc(), DataSet.id.desc()).offset(args['offset']).limit(SIZE_PER_PAGE)
+            # 前ページ
+            previousUrl = None
+            if args['offset'] >= 1:
+                params = {'page': args['page'] - 1}
+                params_string = urllib.parse.urlencode(params)
+                previousUrl = f'{request.path}?{params_string}'
+
+            # 次ページ
+            nextUrl = None
+            if args['offset'] + SIZE_PER_PAGE < count:
+                params = {'page': args['page'] + 1}
+                params_string = urllib.parse.urlencode(params)
+                nextUrl = f'{request.path}?{params_string}'
         return {
             'count': count,
             'previous': previousUrl,
@@ -65,17 +102,79 @@ class AdminDataSetList(Resource):
                         'contact_uri': data_set.contact_uri,
                     }
                 }
-                for data_set in query
+                for data_set in data_sets
             ]
         }
 
 
 class AdminDataSetDetail(Resource):
     def delete(self, id):
-        data_set = DataSet.query.get(id)
-        if not data_set:
+        if not delete_data_sets(db.session, DataSet.id == id):
             return {'message': 'not found'}, 404
 
-        db.session.delete(data_set)
         db.session.commit()
+        public_data_sets_cache.invalidate()
         return '', 204
+
+
+bulk_delete_parser = reqparse.RequestParser()
+bulk_delete_parser.add_argument('ids', type=int, action='append', location='json')
+bulk_delete_parser.add_argument('user_id', type=int, location='json')
+bulk_delete_parser.add_argument('is_public', type=inputs.boolean, location='json')
+bulk_delete_parser.add_argument('uploaded_before', type=inputs.datetime_from_iso8601, location='json')
+bulk_delete_parser.add_argument('uploaded_after', type=inputs.datetime_from_iso8601, location='json')
+
+
+class AdminDataSetBulkDelete(Resource):
+    """ idの一覧か条件(すべてを満たすもの)に合うDataSetをワーカーで少しずつ削除する """
+
+    def post(self):
+        args = bulk_delete_parser.parse_args()
+        criteria = {key: value for key, value in args.items() if value is not None}
+        if not criteria:
+            return {'message': 'ids or filter is required'}, 400
+        for key in ('uploaded_before', 'uploaded_after'):
+            if key in criteria:
+                # upload_atはUTCで保存している。タイムゾーンがなければUTCとみなす
+                value = criteria[key]
+                if value.tzinfo is not None:
+                    value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+                criteria[key] = value.isoformat()
+
+        task_id = str(uuid4())
+        pipe = redis_client.pipeline()
+        pipe.set(task_id, json.dumps({
+            'user': g.user.id,
+            'state': TaskState.PENDING.value,
+            'criteria': criteria,
+            'deleted': 0,
+            'created_at': time.time(),
+        }))
+        pipe.expire(task_id, TASK_PROPERTIES_EXPIRE)
+        pipe.execute()
+        delete_task_queue.enqueue(g.user.id, task_id)
+        return {'task_id': task_id}, 202
+
+
+class AdminDataSetBulkDeleteStatus(Resource):
+    def get(self, task_id):
+        task_properties = redis_client.get(task_id)
+        if not task_properties:
+            return {'message': 'task not found'}, 404
+
+        task_properties = json.loads(task_properties)
+        if 'criteria' not in task_properties:
+            return {'message': 'task not found'}, 404
+        state = TaskState(task_properties['state'])
+        if state == TaskState.STARTED and is_task_lost(delete_task_queue, task_id):
+            state = TaskState.FAILURE
+            task_properties['message'] = 'raised unknown error'
+        result = {'state': state.name, 'deleted': task_properties['deleted']}
+        if state == TaskState.FAILURE:
+            result['message'] = task_properties['message']
+        return result
+
+
+class AdminCacheStats(Resource):
+    def get(self):
+        return {cache.name: cache.stats() for cache in result_caches}
@@ -1,37 +1,46 @@
 from enum import Enum
+import hashlib
 import json
+import os
 import urllib.parse
-import subprocess
-import shutil
-import tempfile
-from multiprocessing import Process
-from pathlib import Path
+import time
 from uuid import uuid4
 
-from flask import g, request
+from flask import g, request, Response, stream_with_context
 from flask_restful import Resource, reqparse
 from firebase_admin import auth as firebase_auth
-from sqlalchemy import func, or_
+from sqlalchemy import and_, false, func, select, true, type_coerce
 from werkzeug.datastructures import FileStorage
-
-from dbcls import db, app, redis_client
-from dbcls.constants import TASK_PROPERTIES_EXPIRE
+from werkzeug.exceptions import HTTPException, RequestEntityTooLarge
+from werkzeug.wsgi import wrap_file
+
+from dbcls import db, app, redis_client, payload_cache
+from dbcls.bulk_upload import check_archive, InvalidArchiveError
+from dbcls.cache import public_data_sets_cache, data_set_count_cache, uri_usages_cache, facet_counts_cache
+from dbcls.constants import TASK_PROPERTIES_EXPIRE, TASK_EVENTS_POLL_TIMEOUT, TASK_EVENTS_RETRY, TAG_NAME_MAX_LENGTH, FACET_VALUES_LIMIT
+from dbcls.content import InvalidContentError
+from dbcls.pagination import paginate, InvalidCursorError
+from dbcls.payload import build_payload, build_projected_payload, IDENTITY
+from dbcls.search import Match, build_boolean_query
+from dbcls.task_queue import generate_task_queue, bulk_upload_task_queue
+from dbcls.upload import WorkspaceUploader
+from dbcls.uri_index import uri_hash
 from dbcls.utils import localize_as_jst
-from dbcls.models import DataSet, Tag
-from dbcls.tasks import generate_by_umakaparser, UmakaparserState
+from dbcls.models import (
+    DataSet, Tag, User, UserRoleTypes, tag_association_table, data_set_class_table, data_set_property_table,
+    delete_data_sets, set_data_set_tags, public_facet_table
+)
+from dbcls.tasks import (
+    UmakaparserState, GenerateStage, TaskState, is_task_lost, record_progress, task_events_key, task_events_channel
+)
 
 
 parser = reqparse.RequestParser()
 parser.add_argument('file', type=FileStorage, required=True, nullable=False, location='files')
 
-
-META_DATA_ATTRIBUTES = {
-    'properties': int,
-    'triples': int,
-    'classes': int,
-    'endpoint': str,
-    'crawl_date': str,
-}
+list_parser = reqparse.RequestParser()
+list_parser.add_argument('size', type=int, location='args', default=50)
+list_parser.add_argument('cursor', type=str, location='args', default=None)
 
 
 class DataSetList(Resource):
@@ -44,49 +53,118 @@ class DataSetList(Resource):
             'is_public': data_set.is_public,
         }
 
-    def _validate_file(self):
+    def get(self):
+        args = list_parser.parse_args()
+        query = DataSet.query.filter_by(user_id=g.user.id)
+        if args['cursor'] is None:
+            data_sets = [self._to_json(d) for d in query.order_by(DataSet.id).all()]
+            return {'data': data_sets}
+
+        # カーソルを指定した場合はページングする
+        size = max(args['size'], 1)
+        try:
+            page = paginate(query, DataSet.id, DataSet.id, False, args['cursor'], size)
+        except InvalidCursorError:
+            return {'message': 'cursor is invalid'}, 400
+        previousUrl = None
+        if page.previous_cursor:
+            params_string = urllib.parse.urlencode({'size': size, 'cursor': page.previous_cursor})
+            previousUrl = f'{request.path}?{params_string}'
+        nextUrl = None
+        if page.next_cursor:
+            params_string = urllib.parse.urlencode({'size': size, 'cursor': page.next_cursor})
+            nextUrl = f'{request.path}?{params_string}'
+        return {
+            'previous': previousUrl,
+            'next': nextUrl,
+            'data': [self._to_json(d) for d in page.rows],
+        }
+
+    def post(self):
+        # 受け取る前に大きさがわかる場合はすぐに断る
+        max_size = app.config['DATA_SET_MAX_SIZE']
+        if max_size is not None and request.content_length and request.content_length > max_size:
+            raise RequestEntityTooLarge()
         args = parser.parse_args()
         data_set_file = args['file']
-
-        # jsonファイルであることを確認
         try:
-            content = json.load(data_set_file.stream)
-            data_set_file.stream.seek(0)
-        except (UnicodeDecodeError, json.decoder.JSONDecodeError) as e:
-            return {'ok': False, 'message': f'{e}'}
-
-        # meta_dataがあるのを確認
-        if 'meta_data' not in content:
-            return {'ok': False, 'message': 'meta_data does not exist'}
+            data_set = DataSet.create(g.user, data_set_file, max_size)
+        except InvalidContentError as e:
+            return {'message': e.message}, 400
 
-        # meta_dataに必要なデータを確認
-        meta_data = content['meta_data']
-        for key, meta_type in META_DATA_ATTRIBUTES.items():
-            if key not in meta_data:
-                return {'ok': False, 'message': f'{key} does not exist'}
-            if not isinstance(meta_data[key], meta_type):
-                return {'ok': False, 'message': f'{key} is invalid type'}
+        db.session.add(data_set)
+        db.session.commit()
+        public_data_sets_cache.invalidate()
+        return self._to_json(data_set), 201
 
-        return {'ok': True}
 
-    def get(self):
-        data_sets = [
-            self._to_json(d)
-            for d in DataSet.query.filter_by(user_id=g.user.id).all()
-        ]
-        return {'data': data_sets}
+class DataSetBulkUpload(Resource):
+    """ umakaparserで作ったJSONファイルをまとめたzipかtarからワーカーでDataSetを作る """
 
     def post(self):
-        result = self._validate_file()
-        if not result['ok']:
-            return {'message': f'{result["message"]}'}, 400
+        # アーカイブは展開せずに作業ディレクトリへ直接書き込む
+        uploader = WorkspaceUploader(
+            app.config['GENERATOR_WORKSPACE'],
+            app.config['BULK_UPLOAD_MAX_SIZE'],
+            decompress=False
+        )
+        uploader.check_content_length(request.content_length)
+        request.file_stream_factory = uploader.stream_factory
+        try:
+            args = parser.parse_args()
+            uploader.finish()
+        except HTTPException:
+            uploader.discard()
+            raise
+
+        archive_path = args['file'].stream.path
+        # フォームに含まれていたそれ以外のファイルは使わない
+        for stream in uploader.files:
+            if stream.path != archive_path:
+                os.remove(stream.path)
+        try:
+            check_archive(archive_path)
+        except InvalidArchiveError as e:
+            os.remove(archive_path)
+            return {'message': e.message}, 400
 
-        args = parser.parse_args()
-        data_set_file = args['file']
-        data_set = DataSet.create(g.user, data_set_file)
-        db.session.add(data_set)
-        db.session.commit()
-        return self._to_json(data_set), 201
+        task_id = str(uuid4())
+        pipe = redis_client.pipeline()
+        pipe.set(task_id, json.dumps({
+            'user': g.user.id,
+            'state': TaskState.PENDING.value,
+            'archive_path': archive_path,
+            'files': [],
+            'created_at': time.time(),
+        }))
+        pipe.expire(task_id, TASK_PROPERTIES_EXPIRE)
+        pipe.execute()
+        bulk_upload_task_queue.enqueue(g.user.id, task_id)
+        return {'task_id': task_id}, 202
+
+
+class DataSetBulkUploadStatus(Resource):
+    def get(self, task_id):
+        task_properties = redis_client.get(task_id)
+        if not task_properties:
+            return {'message': 'task not found'}, 404
+
+        task_properties = json.loads(task_properties)
+        if task_properties['user'] != g.user.id or 'archive_path' not in task_properties:
+            return {'message': 'task not found'}, 404
+        state = TaskState(task_properties['state'])
+        if state == TaskState.STARTED and is_task_lost(bulk_upload_task_queue, task_id):
+            state = TaskState.FAILURE
+            task_properties['message'] = 'raised unknown error'
+        files = task_properties['files']
+        created = sum(1 for result in files if result['status'] == 'created')
+        result = {'state': state.name, 'created': created, 'failed': len(files) - created, 'files': files}
+        if state == TaskState.PENDING:
+            # 自分より前に処理されるタスクの数
+            result['position'] = bulk_upload_task_queue.position(g.user.id, task_id)
+        if state == TaskState.FAILURE:
+            result['message'] = task_properties['message']
+        return result
 
 
 generator_parser = reqparse.RequestParser()
@@ -94,36 +172,58 @@ generator_parser.add_argument('ontology', type=FileStorage, required=False, null
 generator_parser.add_argument('sbm', type=FileStorage, required=True, nullable=False, location='files')
 
 
+def max_upload_size(role_types):
+    """ ユーザーがDataSet生成のために一度にアップロードできるサイズ """
+    if UserRoleTypes.ADMIN.value in role_types:
+        return app.config['GENERATOR_ADMIN_MAX_UPLOAD_SIZE']
+    return app.config['GENERATOR_MAX_UPLOAD_SIZE']
+
+
 class DataSetGenerator(Resource):
     def post(self):
-        args = generator_parser.parse_args()
-        # それぞれ一時ファイルに保存
-        file_types = ['sbm', 'ontology']
-        temp_files = {
-            file_type: tempfile.mkstemp(suffix=Path(args[file_type].filename).suffix)
-            for file_type in file_types if args[file_type]
-        }
-        for file_type in temp_files:
-            with open(temp_files[file_type][1], 'wb') as f:
-                shutil.copyfileobj(args[file_type], f)
-        # DataSet生成プロセス
+        # それぞれワーカーから読める作業ディレクトリに直接書き込む
+        # 圧縮されたファイルは展開して保存する
+        uploader = WorkspaceUploader(
+            app.config['GENERATOR_WORKSPACE'],
+            max_upload_size(g.user_role_types),
+            app.config['GENERATOR_MAX_EXTRACTED_SIZE']
+        )
+        uploader.check_content_length(request.content_length)
+        request.file_stream_factory = uploader.stream_factory
+        try:
+            args = generator_parser.parse_args()
+            uploader.finish()
+        except HTTPException:
+            uploader.discard()
+            raise
+
+        file_paths = {'sbm': None, 'ontology': None}
+        file_hashes = {'sbm': None, 'ontology': None}
+        for file_type in file_paths:
+            if not args[file_type]:
+                continue
+            file_paths[file_type] = args[file_type].stream.path
+            file_hashes[file_type] = args[file_type].stream.sha256
+        # フォームに含まれていたそれ以外のファイルは使わない
+        for stream in uploader.files:
+            if stream.path not in file_paths.values():
+                os.remove(stream.path)
+        # DataSet生成はワーカーで行うのでここではキューに追加するだけ
         task_id = str(uuid4())
         pipe = redis_client.pipeline()
-        pipe.set(task_id, json.dumps({'user': g.user.id, 'state': UmakaparserState.PENDING.value}))
+        pipe.set(task_id, json.dumps({
+            'user': g.user.id,
+            'state': UmakaparserState.PENDING.value,
+            'sbm_path': file_paths['sbm'],
+            'ontology_path': file_paths['ontology'],
+            'sbm_hash': file_hashes['sbm'],
+            'ontology_hash': file_hashes['ontology'],
+            'created_at': time.time(),
+        }))
         pipe.expire(task_id, TASK_PROPERTIES_EXPIRE)
         pipe.execute()
-        # umakaparserを実行するプロセスではconnectionを持ち越せないので、2番目の方法を採用
-        # https://docs.sqlalchemy.org/en/13/faq/connections.html#how-do-i-use-engines-connections-sessions-with-python-multiprocessing-or-os-fork
-        db.session.close()
-        db.engine.dispose()
-
-        sbm_file = temp_files[file_types[0]][1]
-        ontology_file = temp_files[file_types[1]][1] if file_types[1] in temp_files else None
-        process = Process(
-            target=generate_by_umakaparser,
-            args=(g.user.id, sbm_file, ontology_file, task_id)
-        )
-        process.start()
+        record_progress(task_id, GenerateStage.UPLOADED)
+        generate_task_queue.enqueue(g.user.id, task_id)
         return {'task_id': task_id}, 201
 
 
@@ -138,17 +238,16 @@ class DataSetGenerateProcessStatus(Resource):
             return {'message': 'task not found'}, 404
 
         if task_properties['state'] == UmakaparserState.PENDING.value:
-            return '', 202
+            # 自分より前に処理されるタスクの数
+            return {'position': generate_task_queue.position(g.user.id, task_id)}, 202
 
         if task_properties['state'] == UmakaparserState.FAILURE.value:
             redis_client.delete(task_id)
             return {'message': task_properties['message']}, 400
 
         if task_properties['state'] == UmakaparserState.STARTED.value:
-            # プロセスが終了していたらキャッチできなかったエラーで終了している
-            pid = task_properties['pid']
-            p = subprocess.run([f'ps -o command= {pid}'], stdout=subprocess.PIPE)
-            if p.returncode != 0:
+            # ハートビートが途切れていて再実行もされなければキャッチできなかったエラーで終了している
+            if is_task_lost(generate_task_queue, task_id):
                 redis_client.delete(task_id)
                 return {'message': 'raised unknown error'}, 400
             return '', 204
@@ -164,17 +263,142 @@ class DataSetGenerateProcessStatus(Resource):
         }, 200
 
 
+class DataSetGenerateProcessEvents(Resource):
+    """ 進捗をServer-Sent Eventsで送る
+    uwsgiのプロセスを占有し続けないように、新しいイベントを送るか短い時間待ったら切断する
+    クライアントにはretryの後にLast-Event-IDで続きから再接続させる
+    """
+
+    def get(self, task_id):
+        task_properties = redis_client.get(task_id)
+        if not task_properties or json.loads(task_properties)['user'] != g.user.id:
+            return {'message': 'task not found'}, 404
+
+        last_event_id = request.headers.get('Last-Event-ID', '0')
+        last_event_id = int(last_event_id) if last_event_id.isdigit() else 0
+        events_key = task_events_key(task_id)
+        if last_event_id > 0 and last_event_id >= redis_client.llen(events_key):
+            last_event = redis_client.lindex(events_key, -1)
+            if last_event is not None and self._is_final(last_event):
+                # 終了まで送ったので再接続させない
+                return Response(status=204)
+
+        response = Response(
+            stream_with_context(self._stream(task_id, last_event_id)),
+            mimetype='text/event-stream'
+        )
+        response.cache_control.no_cache = True
+        # nginxでバッファリングさせない
+        response.headers['X-Accel-Buffering'] = 'no'
+        return response
+
+    def _is_final(self, event):
+        return json.loads(event)['stage'] in (GenerateStage.SUCCESS.value, GenerateStage.FAILURE.value)
+
+    def _stream(self, task_id, last_event_id):
+        pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+        # 取りこぼさないようにイベントを読む前に購読しておく
+        pubsub.subscribe(task_events_channel(task_id))
+        try:
+            yield f'retry: {TASK_EVENTS_RETRY * 1000}\n\n'
+            deadline = time.monotonic() + TASK_EVENTS_POLL_TIMEOUT
+            while True:
+                events = redis_client.lrange(task_events_key(task_id), last_event_id, -1)
+                for event in events:
+                    last_event_id += 1
+                    yield f'id: {last_event_id}\nevent: progress\ndata: {event}\n\n'
+                    if self._is_final(event):
+                        return
+
+                # 処理していたプロセスが落ちていたら終了
+                task_properties = redis_client.get(task_id)
+                if task_properties and json.loads(task_properties)['state'] == UmakaparserState.STARTED.value:
+                    if is_task_lost(generate_task_queue, task_id):
+                        event = json.dumps({'stage': GenerateStage.FAILURE.value, 'message': 'raised unknown error'})
+                        yield f'event: progress\ndata: {event}\n\n'
+                        return
+
+                # 送ったら切断して、続きは再接続したときに送る
+                timeout = deadline - time.monotonic()
+                if events or timeout <= 0:
+                    return
+                pubsub.get_message(timeout=timeout)
+        finally:
+            pubsub.close()
+
+
+def parse_list_arg(name):
+    """ カンマ区切りのクエリパラメータ。指定がなければNone """
+    value = request.args.get(name)
+    if value is None:
+        return None
+    return sorted(set(v.strip() for v in value.split(',') if v.strip()))
+
+
 class VisualizedDataSet(Resource):
+    """ fields=classes,prefixesでcontentのセクションを、languages=ja,enでlabelsの言語を絞り込める """
+
     def get(self, path):
         data_set = DataSet.query.filter_by(path=path).first()
         if not data_set:
             return {'message': 'not found'}, 404
 
-        return {
-            'id': data_set.id,
-            'title': data_set.title,
-            'content': data_set.content
-        }
+        fields = parse_list_arg('fields')
+        languages = parse_list_arg('languages')
+        projected = fields is not None or languages is not None
+
+        etag = data_set.content_etag
+        if etag is None:
+            # content_storageに移行前のデータ
+            if projected:
+                payload = build_projected_payload(
+                    data_set.id, data_set.title, data_set.content_parts(fields, languages)
+                )
+                return Response(payload, mimetype='application/json')
+            return {
+                'id': data_set.id,
+                'title': data_set.title,
+                'content': data_set.content
+            }
+
+        if projected:
+            key = f'{etag}:{",".join(fields or ["*"])}:{",".join(languages or ["*"])}'
+            etag = hashlib.sha256(key.encode()).hexdigest()
+
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            response = self._payload_response(data_set, etag, fields, languages, projected)
+        response.set_etag(etag)
+        response.cache_control.no_cache = True
+        response.vary.add('Accept-Encoding')
+        return response
+
+    def _build_payload(self, data_set, fields, languages, projected):
+        if projected:
+            # 必要なセクションだけを読み込む
+            return build_projected_payload(data_set.id, data_set.title, data_set.content_parts(fields, languages))
+        return build_payload(data_set.id, data_set.title, data_set.raw_content())
+
+    def _payload_response(self, data_set, etag, fields, languages, projected):
+        encoding = payload_cache.select_encoding(request.accept_encodings)
+        payload_path = payload_cache.get_path(etag, encoding)
+        if payload_path is None:
+            # 初回アクセス時に圧縮済みのレスポンスを作っておく
+            payload_cache.put(etag, self._build_payload(data_set, fields, languages, projected))
+            payload_path = payload_cache.get_path(etag, encoding)
+
+        if encoding == IDENTITY:
+            return Response(payload_cache.read_identity(etag), mimetype='application/json')
+
+        response = Response(
+            wrap_file(request.environ, payload_path.open('rb')),
+            mimetype='application/json',
+            direct_passthrough=True
+        )
+        response.content_length = payload_path.stat().st_size
+        response.content_encoding = encoding
+        return response
 
 
 update_parser = reqparse.RequestParser()
@@ -200,12 +424,11 @@ class DataSetDetail(Resource):
         }
 
     def delete(self, id):
-        data_set = self._get_data_set(id)
-        if not data_set:
+        if not delete_data_sets(db.session, and_(DataSet.user_id == g.user.id, DataSet.id == id)):
             return {'message': 'not found'}, 404
 
-        db.session.delete(data_set)
         db.session.commit()
+        public_data_sets_cache.invalidate()
         return '', 204
 
     def patch(self, id):
@@ -227,14 +450,9 @@ class DataSetDetail(Resource):
             # タグをすべて外さない場合はタグ名を確認
             if comma_separated_tag_name != '' and len(tag_names) == 0:
                 return {'message': 'no tags'}, 400
-            data_set.tags.clear()
-            for tag_name in tag_names:
-                # タグとDataSetを紐付ける
-                tag = Tag.query.filter_by(name=tag_name).first()
-                if not tag:
-                    tag = Tag(name=tag_name)
-                tag.data_sets.append(data_set)
-                db.session.add(tag)
+            if any(len(t) > TAG_NAME_MAX_LENGTH for t in tag_names):
+                return {'message': 'tag name is too long'}, 400
+            set_data_set_tags(db.session, data_set, tag_names)
 
         # DataSet更新
         if args.get('title') is not None:
@@ -243,6 +461,7 @@ class DataSetDetail(Resource):
             data_set.is_public = args['is_public']
         db.session.add(data_set)
         db.session.commit()
+        public_data_sets_cache.invalidate()
         return {
             'id': data_set.id,
             'title': data_set.title,
@@ -258,24 +477,79 @@ class SortBy(Enum):
     PROPERTIES_ASC = 4
     UPLOAD_AT_DESC = 5
     UPLOAD_AT_ASC = 6
+    # 検索語との関連度。検索語がない場合はCLASSES_DESCと同じ
+    RELEVANCE = 7
+    TRIPLES_DESC = 8
+    TRIPLES_ASC = 9
+    CRAWLED_AT_DESC = 10
+    CRAWLED_AT_ASC = 11
 
 
 SORT_VALUES = set(e.value for e in SortBy)
+# (ソートするカラム, 降順かどうか)
+SORT_COLUMNS = {
+    SortBy.CLASSES_DESC.value: (DataSet.meta_data_classes, True),
+    SortBy.CLASSES_ASC.value: (DataSet.meta_data_classes, False),
+    SortBy.PROPERTIES_DESC.value: (DataSet.meta_data_properties, True),
+    SortBy.PROPERTIES_ASC.value: (DataSet.meta_data_properties, False),
+    SortBy.UPLOAD_AT_DESC.value: (DataSet.upload_at, True),
+    SortBy.UPLOAD_AT_ASC.value: (DataSet.upload_at, False),
+    SortBy.TRIPLES_DESC.value: (DataSet.meta_data_triples, True),
+    SortBy.TRIPLES_ASC.value: (DataSet.meta_data_triples, False),
+    SortBy.CRAWLED_AT_DESC.value: (DataSet.crawled_at, True),
+    SortBy.CRAWLED_AT_ASC.value: (DataSet.crawled_at, False),
+}
 SORT_UNARY_EXPRESSIONS = {
-    SortBy.CLASSES_DESC.value: DataSet.meta_data_classes.desc(),
-    SortBy.CLASSES_ASC.value: DataSet.meta_data_classes.asc(),
-    SortBy.PROPERTIES_DESC.value: DataSet.meta_data_properties.desc(),
-    SortBy.PROPERTIES_ASC.value: DataSet.meta_data_properties.asc(),
-    SortBy.UPLOAD_AT_DESC.value: DataSet.upload_at.desc(),
-    SortBy.UPLOAD_AT_ASC.value: DataSet.upload_at.asc(),
+    sort: (column.desc(), DataSet.id.desc()) if descending else (column.asc(), DataSet.id.asc())
+    for sort, (column, descending) in SORT_COLUMNS.items()
 }
 
+# 一覧の行ごとにuserとtagsを読み込まないように1回のクエリで取得する
+TAGS_EXPRESSION = type_coerce(
+    select([func.json_arrayagg(func.json_object('id', Tag.id, 'name', Tag.name))])
+    .select_from(tag_association_table.join(Tag))
+    .where(tag_association_table.c.data_set_id == DataSet.id)
+    .as_scalar(),
+    db.JSON
+).label('tags')
+PUBLIC_LIST_COLUMNS = (
+    DataSet.id, DataSet.title, DataSet.path, DataSet.upload_at, DataSet.meta_data,
+    DataSet.meta_data_classes, DataSet.meta_data_properties, DataSet.meta_data_triples, DataSet.crawled_at,
+    User.display_name, User.contact_uri, TAGS_EXPRESSION,
+)
+
+# search_fulltext_idxと同じカラム
+SEARCH_COLUMNS = (DataSet.title, DataSet.search_tags, DataSet.search_text)
+
+
+def relevance_expression(boolean_query):
+    """ タイトルに含まれるものを優先する
+    カーソルで比較できるように整数にする
+    """
+    score = Match(SEARCH_COLUMNS, boolean_query) + Match((DataSet.title,), boolean_query)
+    return type_coerce(func.floor(score * 1000000), db.Integer).label('relevance')
+
 
 public_parser = reqparse.RequestParser()
 public_parser.add_argument('size', type=int, location='args', default=4)
 public_parser.add_argument('page', type=int, location='args', default=1)
-public_parser.add_argument('sort', type=int, location='args', default=SortBy.CLASSES_DESC.value)
+public_parser.add_argument('sort', type=int, location='args', default=None)
 public_parser.add_argument('search', type=str, location='args', default='')
+public_parser.add_argument('cursor', type=str, location='args', default=None)
+public_parser.add_argument('min_triples', type=int, location='args', default=None)
+public_parser.add_argument('max_triples', type=int, location='args', default=None)
+public_parser.add_argument('min_classes', type=int, location='args', default=None)
+public_parser.add_argument('max_classes', type=int, location='args', default=None)
+public_parser.add_argument('endpoint_host', type=str, location='args', default=None)
+
+# 絞り込みのパラメータごとの条件。どれもis_publicとの複合インデックスがあるカラムを使う
+FILTER_CONDITIONS = {
+    'min_triples': lambda value: DataSet.meta_data_triples >= value,
+    'max_triples': lambda value: DataSet.meta_data_triples <= value,
+    'min_classes': lambda value: DataSet.meta_data_classes >= value,
+    'max_classes': lambda value: DataSet.meta_data_classes <= value,
+    'endpoint_host': lambda value: DataSet.endpoint_host == value,
+}
 
 
 class PublicDataSetList(Resource):
@@ -293,74 +567,201 @@ class PublicDataSetList(Resource):
         if page > 1:
             offset = size * (page - 1)
 
-        sort = args['sort'] if args['sort'] in SORT_VALUES else SortBy.CLASSES_DESC.value
+        # 指定がなければ検索語がある場合は関連度順
+        searching = bool(build_boolean_query(args['search']))
+        sort = args['sort']
+        if sort not in SORT_VALUES:
+            sort = SortBy.RELEVANCE.value if searching else SortBy.CLASSES_DESC.value
+        elif sort == SortBy.RELEVANCE.value and not searching:
+            sort = SortBy.CLASSES_DESC.value
+
+        filters = {name: args[name] for name in FILTER_CONDITIONS if args[name] is not None}
+        if 'endpoint_host' in filters:
+            # ホスト名は小文字で保存している
+            filters['endpoint_host'] = filters['endpoint_host'].strip().lower()
+            if not filters['endpoint_host']:
+                del filters['endpoint_host']
 
         return {
             'size': size,
             'page': page,
             'offset': offset,
             'sort': sort,
-            'search': args['search']
+            'search': args['search'],
+            'cursor': args['cursor'],
+            'filters': filters,
         }
 
     def get(self):
         args = self._parse_args()
-        public_query = DataSet.query.filter_by(is_public=True)
-        query = (
-            public_query
-            .order_by(SORT_UNARY_EXPRESSIONS[args['sort']])
-            .add_columns(func.json_extract(DataSet.content, '$.meta_data').label('meta_data'))
-        )
-        if args['search']:
-            query = (
-                query
-                .filter(
-                    or_(
-                        DataSet.title == args['search'],
-                        DataSet.tags.any(Tag.name == args['search'])
-                    )
+        cache_key = public_data_sets_cache.key(args)
+        result = public_data_sets_cache.get(cache_key)
+        if result is None:
+            try:
+                result = self._search(args)
+            except InvalidCursorError:
+                return {'message': 'cursor is invalid'}, 400
+            public_data_sets_cache.set(cache_key, result)
+        return result
+
+    def _count(self, query, args):
+        # 件数は更新があるまでキャッシュしておく
+        cache_key = data_set_count_cache.key({'public': True, 'search': args['search'], 'filters': args['filters']})
+        count = data_set_count_cache.get(cache_key)
+        if count is None:
+            count = query.count()
+            data_set_count_cache.set(cache_key, count)
+        return count
+
+    def _facets(self):
+        # 検索語に関係なく公開DataSet全体の数。集計済みのテーブルから読んで更新があるまでキャッシュしておく
+        cache_key = facet_counts_cache.key({'public': True})
+        facets = facet_counts_cache.get(cache_key)
+        if facets is None:
+            tags = (
+                db.session.query(Tag.name, Tag.public_count)
+                .filter(Tag.public_count > 0)
+                .order_by(Tag.public_count.desc(), Tag.name)
+                .limit(FACET_VALUES_LIMIT)
+            )
+            facets = {'tags': [{'value': name, 'count': count} for name, count in tags]}
+            for facet in ('triples', 'endpoint_host'):
+                rows = (
+                    db.session.query(public_facet_table.c.value, public_facet_table.c.count)
+                    .filter(public_facet_table.c.facet == facet, public_facet_table.c.count > 0)
+                    .order_by(public_facet_table.c.count.desc(), public_facet_table.c.value)
+                    .limit(FACET_VALUES_LIMIT)
                 )
+                facets[facet] = [{'value': value, 'count': count} for value, count in rows]
+            # triplesは区間の下限の順にする
+            facets['triples'] = sorted(
+                ({'value': int(f['value']), 'count': f['count']} for f in facets['triples']),
+                key=lambda f: f['value']
             )
-        # 全体の個数を取得したいのでoffsetとlimitの前に実行
-        count = query.count()
-        query = query.offset(args['offset']).limit(args['size'])
+            facet_counts_cache.set(cache_key, facets)
+        return facets
 
-        # 前ページ
-        previousUrl = None
-        if args['offset'] >= 1:
-            params = {'size': args['size'], 'page': args['page'] - 1, 'sort': args['sort']}
-            if args['search']:
-                params.update({'search': args['search']})
-            params_string = urllib.parse.urlencode(params)
-            previousUrl = f'{request.path}?{params_string}'
-        # 次ページ
-        nextUrl = None
-        if args['offset'] + args['size'] < count:
-            params = {'size': args['size'], 'page': args['page'] + 1, 'sort': args['sort']}
-            if args['search']:
-                params.update({'search': args['search']})
-            params_string = urllib.parse.urlencode(params)
-            nextUrl = f'{request.path}?{params_string}'
+    def _url(self, args, **params):
+        params = {'size': args['size'], **params, 'sort': args['sort'], **args['filters']}
+        if args['search']:
+            params.update({'search': args['search']})
+        params_string = urllib.parse.urlencode(params)
+        return f'{request.path}?{params_string}'
+
+    def _search(self, args):
+        query = DataSet.query.filter_by(is_public=True)
+        columns = PUBLIC_LIST_COLUMNS
+        boolean_query = build_boolean_query(args['search'])
+        if boolean_query:
+            # タイトル、タグ、クラスとプロパティのURI、ラベルのどれかに含まれるもの
+            query = query.filter(Match(SEARCH_COLUMNS, boolean_query) > 0)
+            columns = (*columns, relevance_expression(boolean_query))
+        elif args['search']:
+            query = query.filter(false())
+        for name, value in args['filters'].items():
+            query = query.filter(FILTER_CONDITIONS[name](value))
+        count = self._count(query, args)
+        query = query.join(DataSet.user).with_entities(*columns)
+
+        if args['sort'] == SortBy.RELEVANCE.value:
+            column, descending = columns[-1], True
+            order_by = (column.desc(), DataSet.id.desc())
+        else:
+            column, descending = SORT_COLUMNS[args['sort']]
+            order_by = SORT_UNARY_EXPRESSIONS[args['sort']]
+
+        if args['cursor'] is not None:
+            # カーソルを指定した場合はOFFSETを使わない
+            page = paginate(query, column, DataSet.id, descending, args['cursor'], args['size'])
+            data_sets = page.rows
+            previousUrl = None
+            if page.previous_cursor:
+                previousUrl = self._url(args, cursor=page.previous_cursor)
+            nextUrl = None
+            if page.next_cursor:
+                nextUrl = self._url(args, cursor=page.next_cursor)
+        else:
+            data_sets = (
+                query
+                .order_by(*order_by)
+                .offset(args['offset'])
+                .limit(args['size'])
+            )
+            # 前ページ
+            previousUrl = None
+            if args['offset'] >= 1:
+                previousUrl = self._url(args, page=args['page'] - 1)
+            # 次ページ
+            nextUrl = None
+            if args['offset'] + args['size'] < count:
+                nextUrl = self._url(args, page=args['page'] + 1)
 
         return {
             'count': count,
+            'facets': self._facets(),
             'previous': previousUrl,
             'next': nextUrl,
             'data': [
                 {
-                    'id': result.DataSet.id,
-                    'title': result.DataSet.title,
-                    'path': result.DataSet.path,
+                    'id': data_set.id,
+                    'title': data_set.title,
+                    'path': data_set.path,
                     'upload_at': (
-                        localize_as_jst(result.DataSet.upload_at).isoformat()
+                        localize_as_jst(data_set.upload_at).isoformat()
                     ),
-                    'meta_data': json.loads(result.meta_data),
+                    'meta_data': data_set.meta_data,
                     'user': {
-                        'display_name': result.DataSet.user.display_name,
-                        'contact_uri': result.DataSet.user.contact_uri,
+                        'display_name': data_set.display_name,
+                        'contact_uri': data_set.contact_uri,
                     },
-                    'tags': [{'id': t.id, 'name': t.name} for t in result.DataSet.tags],
+                    'tags': data_set.tags or [],
                 }
-                for result in query
+                for data_set in data_sets
             ]
         }
+
+
+uri_parser = reqparse.RequestParser()
+uri_parser.add_argument('uri', type=str, location='args', required=True, nullable=False)
+uri_parser.add_argument('size', type=int, location='args', default=50)
+
+
+class PublicUriUsageList(Resource):
+    """ クラスかプロパティとしてURIを使っている公開DataSetを
+    クラスはentities、プロパティはtriplesの多い順に返す
+    """
+
+    def get(self):
+        args = uri_parser.parse_args()
+        size = min(max(args['size'], 1), 1000)
+        cache_key = uri_usages_cache.key({'uri': args['uri'], 'size': size})
+        result = uri_usages_cache.get(cache_key)
+        if result is None:
+            result = {
+                'uri': args['uri'],
+                'classes': self._usages(data_set_class_table, 'entities', args['uri'], size),
+                'properties': self._usages(data_set_property_table, 'triples', args['uri'], size),
+            }
+            uri_usages_cache.set(cache_key, result)
+        return result
+
+    def _usages(self, table, count_name, uri, size):
+        count_column = table.c[count_name]
+        rows = (
+            db.session.query(DataSet.id, DataSet.title, DataSet.path, DataSet.upload_at, count_column)
+            .select_from(table)
+            .join(DataSet, DataSet.id == table.c.data_set_id)
+            .filter(table.c.uri_hash == uri_hash(uri), DataSet.is_public == true())
+            .order_by(count_column.desc(), table.c.data_set_id)
+            .limit(size)
+        )
+        return [
+            {
+                'id': row.id,
+                'title': row.title,
+                'path': row.path,
+                'upload_at': localize_as_jst(row.upload_at).isoformat(),
+                count_name: getattr(row, count_name),
+            }
+            for row in rows
+        ]
@@ -2,6 +2,7 @@ from flask_restful import Resource, reqparse
 from firebase_admin import auth as firebase_auth
 
 from dbcls import db
+from dbcls.auth import create_custom_token
 from dbcls.models import User
 
 
@@ -30,5 +31,4 @@ class SignUp(Resource):
         db.session.add(user)
         db.session.commit()
 
-        custom_token = firebase_auth.create_custom_token(firebase_uid)
-        return {'custom_token': custom_token.decode()}, 201
+        return {'custom_token': create_custom_token(firebase_uid)}, 201
@@ -0,0 +1,34 @@
+from flask_restful import Resource, reqparse
+
+from dbcls import db
+from dbcls.cache import tag_suggestions_cache
+from dbcls.models import Tag
+
+
+parser = reqparse.RequestParser()
+parser.add_argument('prefix', type=str, location='args', default='')
+parser.add_argument('size', type=int, location='args', default=10)
+
+
+class TagList(Resource):
+    """ タグ入力の補完候補を公開DataSetに多く使われている順に返す
+    非公開のDataSetにしか付いていないタグは返さない
+    """
+
+    def get(self):
+        args = parser.parse_args()
+        prefix = args['prefix'].strip()
+        size = min(max(args['size'], 1), 100)
+        cache_key = tag_suggestions_cache.key({'prefix': prefix, 'size': size})
+        tags = tag_suggestions_cache.get(cache_key)
+        if tags is None:
+            query = db.session.query(Tag.id, Tag.name, Tag.public_count).filter(Tag.public_count > 0)
+            if prefix:
+                # nameのインデックスで前方一致の範囲だけを読む
+                query = query.filter(Tag.name.startswith(prefix, autoescape=True))
+            tags = [
+                {'id': row.id, 'name': row.name, 'public_count': row.public_count}
+                for row in query.order_by(Tag.public_count.desc(), Tag.name).limit(size)
+            ]
+            tag_suggestions_cache.set(cache_key, tags)
+        return {'tags': tags}
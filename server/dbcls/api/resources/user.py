@@ -3,6 +3,9 @@ from flask_restful import Resource, abort, reqparse
 from firebase_admin import auth as firebase_auth
 
 from dbcls import db
+from dbcls.auth import invalidate_user, create_custom_token
+from dbcls.cache import public_data_sets_cache
+from dbcls.models import delete_user
 
 
 parser = reqparse.RequestParser()
@@ -15,7 +18,7 @@ class Me(Resource):
         return {
             'display_name': g.user.display_name,
             'contact_uri': g.user.contact_uri,
-            'roles': [role.role_type for role in g.user.user_roles],
+            'roles': g.user_role_types,
         }
 
     def patch(self):
@@ -26,15 +29,22 @@ class Me(Resource):
             g.user.contact_uri = args['contact_uri'][:255]
         db.session.add(g.user)
         db.session.commit()
+        invalidate_user(g.user.firebase_uid)
+        # 公開DataSetの一覧に表示名が含まれている
+        public_data_sets_cache.invalidate()
         return {
             'display_name': g.user.display_name,
             'contact_uri': g.user.contact_uri,
-            'roles': [role.role_type for role in g.user.user_roles],
+            'roles': g.user_role_types,
         }
 
     def delete(self):
-        db.session.delete(g.user)
+        # DataSetを1件ずつ読み込まないようにテーブルごとにまとめて削除する
+        firebase_uid = g.user.firebase_uid
+        delete_user(db.session, g.user.id)
         db.session.commit()
+        invalidate_user(firebase_uid)
+        public_data_sets_cache.invalidate()
         return '', 204
 
 
@@ -45,5 +55,4 @@ class MyCustomToken(Resource):
         except (ValueError, firebase_auth.AuthError) as e:
             return {'message': f'{e}'}, 400
 
-        custom_token = firebase_auth.create_custom_token(g.user.firebase_uid)
-        return {'custom_token': custom_token.decode()}
+        return {'custom_token': create_custom_token(g.user.firebase_uid)}
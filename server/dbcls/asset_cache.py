@@ -0,0 +1,95 @@
+import hashlib
+import os
+from pathlib import Path
+import shutil
+import tempfile
+
+
+def file_hash(path, chunk_size=1024 * 1024):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def link_tree(src, dest):
+    """ ハードリンクでディレクトリを複製する(別のファイルシステムの場合はコピー) """
+    for root, dirs, files in os.walk(src):
+        relative = os.path.relpath(root, src)
+        os.makedirs(os.path.join(dest, relative), exist_ok=True)
+        for name in files:
+            src_file = os.path.join(root, name)
+            dest_file = os.path.join(dest, relative, name)
+            try:
+                os.link(src_file, dest_file)
+            except OSError:
+                shutil.copy2(src_file, dest_file)
+
+
+class AssetCache:
+    """ umakaparser build-indexで作ったassetsを再利用する
+    最後に使われた時刻をディレクトリのmtimeで管理し、max_sizeを超えたら古いものから削除する
+    """
+
+    def __init__(self, root, max_size):
+        self.root = Path(root)
+        self.max_size = max_size
+
+    def key(self, *values):
+        return hashlib.sha256(':'.join(values).encode()).hexdigest()
+
+    def _path(self, key):
+        return Path(self.root, key)
+
+    def checkout(self, key, dest):
+        """ キャッシュがあればdestに複製してTrueを返す """
+        path = self._path(key)
+        if not path.is_dir():
+            return False
+        dest_existed = os.path.isdir(dest)
+        # 使用中に削除されても影響がないようにハードリンクで複製する
+        try:
+            link_tree(path, dest)
+            os.utime(path)
+        except FileNotFoundError:
+            # 途中まで複製したファイルを残さずに元の状態へ戻す
+            shutil.rmtree(dest, ignore_errors=True)
+            if dest_existed:
+                os.mkdir(dest)
+            return False
+        return True
+
+    def store(self, key, src):
+        path = self._path(key)
+        if path.exists():
+            return
+        self.root.mkdir(parents=True, exist_ok=True)
+        temp_path = tempfile.mkdtemp(dir=self.root, prefix='.tmp')
+        try:
+            link_tree(src, temp_path)
+            os.rename(temp_path, path)
+        except OSError:
+            # 他のプロセスが先に保存した
+            shutil.rmtree(temp_path, ignore_errors=True)
+        self.evict()
+
+    def _entries(self):
+        if not self.root.exists():
+            return []
+        return [path for path in self.root.iterdir() if path.is_dir() and not path.name.startswith('.')]
+
+    def _size(self, path):
+        return sum(f.stat().st_size for f in path.rglob('*') if f.is_file())
+
+    def evict(self):
+        entries = sorted(
+            ((path.stat().st_mtime, path, self._size(path)) for path in self._entries()),
+            key=lambda entry: entry[0]
+        )
+        total_size = sum(size for _, _, size in entries)
+        for _, path, size in entries:
+            if total_size <= self.max_size:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total_size -= size
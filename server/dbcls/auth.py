@@ -0,0 +1,93 @@
+import hashlib
+import json
+import time
+
+import cachecontrol
+from cachecontrol.caches.redis_cache import RedisCache
+from firebase_admin import auth as firebase_auth
+import google.auth.transport.requests
+import requests
+from sqlalchemy.orm import make_transient_to_detached
+
+from dbcls import app, db, redis_client, binary_redis_client
+from dbcls.constants import AUTH_USER_CACHE_EXPIRE, AUTH_CUSTOM_TOKEN_CACHE_EXPIRE
+from dbcls.models import User
+
+
+def use_shared_certificate_cache():
+    """ IDトークンの署名の証明書をRedisに保存してプロセス間で共有する
+    有効期限は証明書のレスポンスのCache-Controlに従い、切れたら取り直す
+    firebase_adminの非公開の属性を使うので、見つからなければ共有せずにFalseを返す
+    """
+    get_auth_service = getattr(firebase_auth, '_get_auth_service', None)
+    token_verifier = None
+    if get_auth_service is not None:
+        try:
+            token_verifier = getattr(get_auth_service(None), 'token_verifier', None)
+        except ValueError:
+            # firebaseが初期化されていない
+            return False
+    if token_verifier is None or not hasattr(token_verifier, 'request'):
+        app.logger.warning('token verifier of firebase_admin is not found. certificates are not shared')
+        return False
+    session = cachecontrol.CacheControl(requests.Session(), cache=RedisCache(binary_redis_client))
+    token_verifier.request = google.auth.transport.requests.Request(session=session)
+    return True
+
+
+def verify_id_token(token):
+    """ 検証済みのIDトークンは有効期限までRedisに保存しておく """
+    key = f'auth:id_token:{hashlib.sha256(token.encode()).hexdigest()}'
+    cached = redis_client.get(key)
+    if cached:
+        return json.loads(cached)
+
+    decoded_token = firebase_auth.verify_id_token(token)
+    expire = int(decoded_token.get('exp', 0) - time.time())
+    if expire > 0:
+        redis_client.set(key, json.dumps(decoded_token), ex=expire)
+    return decoded_token
+
+
+def user_cache_key(firebase_uid):
+    return f'auth:user:{firebase_uid}'
+
+
+def load_user(firebase_uid):
+    """ Userとロールの一覧を返す。Userはキャッシュから作るのでDBに問い合わせない """
+    cached = redis_client.get(user_cache_key(firebase_uid))
+    if cached:
+        record = json.loads(cached)
+        role_types = record.pop('role_types')
+        user = User(**record)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False), role_types
+
+    user = User.query.filter_by(firebase_uid=firebase_uid).first()
+    if not user:
+        return None, []
+    role_types = [role.role_type for role in user.user_roles]
+    redis_client.set(user_cache_key(firebase_uid), json.dumps({
+        'id': user.id,
+        'firebase_uid': user.firebase_uid,
+        'display_name': user.display_name,
+        'contact_uri': user.contact_uri,
+        'role_types': role_types,
+    }), ex=AUTH_USER_CACHE_EXPIRE)
+    return user, role_types
+
+
+def invalidate_user(firebase_uid):
+    redis_client.delete(user_cache_key(firebase_uid))
+
+
+def create_custom_token(firebase_uid):
+    """ カスタムトークンは有効期限内なら使い回す """
+    key = f'auth:custom_token:{firebase_uid}'
+    custom_token = redis_client.get(key)
+    if custom_token:
+        return custom_token
+
+    custom_token = firebase_auth.create_custom_token(firebase_uid).decode()
+    redis_client.set(key, custom_token, ex=AUTH_CUSTOM_TOKEN_CACHE_EXPIRE)
+    return custom_token
@@ -0,0 +1,164 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import datetime
+import multiprocessing
+import os
+import shutil
+import tarfile
+import tempfile
+import zipfile
+
+from dbcls import db
+from dbcls.content import InvalidContentError, load_content
+from dbcls.models import DataSet, generate_path, prepare_content
+
+
+class InvalidArchiveError(Exception):
+    def __init__(self, message):
+        self.message = message
+
+
+def check_archive(path):
+    """ zipかtar(gz, bz2, xzで圧縮してもよい)でなければInvalidArchiveErrorにする。tarは先頭だけを読む """
+    if zipfile.is_zipfile(path):
+        return
+    try:
+        with tarfile.open(path, mode='r:*'):
+            pass
+    except (tarfile.TarError, EOFError, OSError):
+        raise InvalidArchiveError('file must be a zip or tar archive')
+
+
+def iter_archive(path, members_dir, max_files, max_file_size, skip=0):
+    """ アーカイブに含まれるJSONファイルを1つずつmembers_dirに書き出して(名前, パス, エラー)で返す
+    アーカイブもファイルもメモリに載せない。先頭からskip個のファイルは書き出さずに読み飛ばす
+    """
+    if zipfile.is_zipfile(path):
+        archive = zipfile.ZipFile(path)
+        members = (
+            (info.filename, info.file_size, lambda info=info: archive.open(info))
+            for info in archive.infolist() if not info.is_dir()
+        )
+    else:
+        try:
+            archive = tarfile.open(path, mode='r|*')
+        except tarfile.TarError:
+            raise InvalidArchiveError('file must be a zip or tar archive')
+        members = (
+            (info.name, info.size, lambda info=info: archive.extractfile(info))
+            for info in archive if info.isfile()
+        )
+
+    count = 0
+    try:
+        for name, size, open_member in members:
+            # macOSのメタデータなどは読み飛ばす
+            basename = os.path.basename(name)
+            if not basename.lower().endswith('.json') or basename.startswith('.') or '__MACOSX' in name:
+                continue
+            count += 1
+            if count > max_files:
+                raise InvalidArchiveError(f'archive must contain at most {max_files} files')
+            if count <= skip:
+                continue
+            if size > max_file_size:
+                yield name, None, 'file is too large'
+                continue
+            # アーカイブ内の名前はパスに使わない
+            member_path = os.path.join(members_dir, f'{count}.json')
+            with open_member() as src, open(member_path, 'wb') as dest:
+                shutil.copyfileobj(src, dest)
+            yield name, member_path, None
+    except (zipfile.BadZipFile, tarfile.TarError, EOFError, OSError):
+        raise InvalidArchiveError('archive is broken')
+    finally:
+        archive.close()
+
+
+def prepare_member(path):
+    """ ワーカープロセスで検証してcontent_storageに保存する """
+    try:
+        with open(path, 'rb') as f:
+            digest, content = load_content(f)
+        return prepare_content(digest, content), None
+    except InvalidContentError as e:
+        return None, e.message
+    finally:
+        os.remove(path)
+
+
+def ingest_archive(user_id, path, processes, batch_size, max_files, max_file_size, skip=0, on_batch=None):
+    """ アーカイブに含まれるJSONファイルからDataSetを作り、ファイルごとの結果を返す
+    検証と保存はワーカープロセスで並列に行い、DBにはbatch_sizeごとに1回のトランザクションで書き込む
+    ワーカープロセスには書き出したファイルのパスを渡し、書き出して待っているファイルはprocessesの2倍までにする
+    書き込むたびにその結果をon_batchに渡す
+    """
+    report = []
+    pending = deque()
+    batch = []
+
+    def write_batch():
+        results = ingest_batch(user_id, batch)
+        batch.clear()
+        report.extend(results)
+        if on_batch is not None:
+            on_batch(results)
+
+    def collect(max_pending):
+        while len(pending) > max_pending:
+            name, future, error = pending.popleft()
+            values, error = future.result() if future is not None else (None, error)
+            batch.append((name, values, error))
+            if len(batch) >= batch_size:
+                write_batch()
+
+    members_dir = tempfile.mkdtemp(dir=os.path.dirname(path))
+    try:
+        # ワーカーはハートビートのスレッドを動かしているのでforkせずに起動する
+        with ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('spawn')) as executor:
+            archive_error = None
+            try:
+                for name, member_path, error in iter_archive(path, members_dir, max_files, max_file_size, skip):
+                    future = executor.submit(prepare_member, member_path) if error is None else None
+                    pending.append((name, future, error))
+                    collect(processes * 2)
+            except InvalidArchiveError as e:
+                archive_error = e
+            collect(0)
+            if batch:
+                write_batch()
+    finally:
+        shutil.rmtree(members_dir, ignore_errors=True)
+
+    if archive_error is not None:
+        if not report and not skip:
+            raise archive_error
+        # 途中までに作ったDataSetは残して、以降のファイルは処理しない
+        result = {'name': None, 'status': 'error', 'message': archive_error.message}
+        report.append(result)
+        if on_batch is not None:
+            on_batch([result])
+    return report
+
+
+def ingest_batch(user_id, batch):
+    """ ワーカープロセスの結果を1回のトランザクションで書き込む """
+    upload_at = datetime.datetime.utcnow()
+    results = []
+    for name, values, error in batch:
+        if error is not None:
+            results.append(({'name': name, 'status': 'error', 'message': error}, None))
+            continue
+        title, _ = os.path.splitext(os.path.basename(name))
+        data_set = DataSet(user_id=user_id, title=title[:32], path=generate_path(), upload_at=upload_at, **values)
+        results.append(({'name': name, 'status': 'created'}, data_set))
+
+    data_sets = [data_set for _, data_set in results if data_set is not None]
+    if data_sets:
+        db.session.add_all(data_sets)
+        db.session.flush()
+        for result, data_set in results:
+            if data_set is not None:
+                result.update({'id': data_set.id, 'path': data_set.path})
+        db.session.commit()
+    return [result for result, _ in results]
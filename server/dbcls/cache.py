@@ -0,0 +1,65 @@
+import hashlib
+import json
+
+from dbcls import redis_client
+from dbcls.constants import RESULT_CACHE_EXPIRE
+
+
+class ResultCache:
+    """ APIの結果をRedisにキャッシュする
+    更新時はバージョンを上げて古いキャッシュを参照しないようにする(古いキャッシュは期限切れで消える)
+    """
+
+    def __init__(self, name, expire=RESULT_CACHE_EXPIRE, version_name=None):
+        self.name = name
+        self.expire = expire
+        # version_nameが同じキャッシュはまとめて無効になる
+        self.version_key = f'{version_name or name}:version'
+        self.stats_key = f'{name}:stats'
+
+    def _version(self):
+        return redis_client.get(self.version_key) or '0'
+
+    def key(self, params):
+        # DBを検索する前にバージョンを決めておく
+        normalized = json.dumps(params, sort_keys=True, ensure_ascii=False)
+        digest = hashlib.sha1(normalized.encode()).hexdigest()
+        return f'{self.name}:{self._version()}:{digest}'
+
+    def get(self, key):
+        cached = redis_client.get(key)
+        redis_client.hincrby(self.stats_key, 'hits' if cached is not None else 'misses')
+        if cached is None:
+            return None
+        return json.loads(cached)
+
+    def set(self, key, result):
+        redis_client.set(key, json.dumps(result), ex=self.expire)
+
+    def invalidate(self):
+        redis_client.incr(self.version_key)
+
+    def stats(self):
+        stats = redis_client.hgetall(self.stats_key)
+        return {
+            'version': int(self._version()),
+            'hits': int(stats.get('hits', 0)),
+            'misses': int(stats.get('misses', 0)),
+        }
+
+
+public_data_sets_cache = ResultCache('public_data_sets')
+data_set_count_cache = ResultCache('data_set_count', version_name='public_data_sets')
+uri_usages_cache = ResultCache('uri_usages', version_name='public_data_sets')
+# タグの公開数は公開DataSetの一覧と同じときに変わる
+tag_suggestions_cache = ResultCache('tag_suggestions', version_name='public_data_sets')
+facet_counts_cache = ResultCache('facet_counts', version_name='public_data_sets')
+
+# 管理画面で統計を表示するキャッシュ。キャッシュを追加したらここにも加える
+result_caches = [
+    public_data_sets_cache,
+    data_set_count_cache,
+    uri_usages_cache,
+    tag_suggestions_cache,
+    facet_counts_cache,
+]
@@ -1 +1,36 @@
 TASK_PROPERTIES_EXPIRE = 60 * 60 * 24 * 7  # 1week
+TASK_HEARTBEAT_INTERVAL = 10
+TASK_HEARTBEAT_EXPIRE = 30
+# ワーカーが処理中に終了したタスクをキューに戻す回数の上限
+TASK_MAX_ATTEMPTS = 3
+# 進捗のイベントを待つ時間。uwsgiのプロセスを長く占有しないように短くしてクライアントに再接続させる
+TASK_EVENTS_POLL_TIMEOUT = 5
+# クライアントが再接続するまでの時間(秒)
+TASK_EVENTS_RETRY = 1
+# まとめて削除するときに1回のトランザクションで削除するDataSetの数
+DELETE_CHUNK_SIZE = 500
+
+META_DATA_ATTRIBUTES = {
+    'properties': int,
+    'triples': int,
+    'classes': int,
+    'endpoint': str,
+    'crawl_date': str,
+}
+
+CRAWL_DATE_FORMATS = ('%Y/%m/%d %H:%M:%S', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%Y/%m/%d', '%Y-%m-%d')
+
+RESULT_CACHE_EXPIRE = 60 * 60  # 1hour
+
+# ロールはAPIから変更できないので、DBを直接変更した場合はこの時間で反映される
+AUTH_USER_CACHE_EXPIRE = 60 * 5
+# カスタムトークンの有効期限(1時間)より短くする
+AUTH_CUSTOM_TOKEN_CACHE_EXPIRE = 60 * 30
+
+# 検索用の文字列の最大長(MEDIUMTEXTに収まるようにする)
+SEARCH_TEXT_MAX_LENGTH = 1024 * 1024
+TAG_NAME_MAX_LENGTH = 20
+
+# 公開DataSetの一覧のファセット。triplesは区間の下限で数える
+TRIPLES_BUCKETS = (0, 1000000, 10000000, 100000000, 1000000000)
+FACET_VALUES_LIMIT = 20
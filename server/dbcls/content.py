@@ -0,0 +1,114 @@
+from collections import namedtuple
+import datetime
+import hashlib
+import json
+
+from dbcls.constants import META_DATA_ATTRIBUTES, CRAWL_DATE_FORMATS
+
+
+class InvalidContentError(Exception):
+    def __init__(self, message):
+        self.message = message
+
+
+def validate_meta_data(content):
+    # meta_dataがあるのを確認
+    if not isinstance(content, dict) or 'meta_data' not in content:
+        raise InvalidContentError('meta_data does not exist')
+
+    # meta_dataに必要なデータを確認
+    meta_data = content['meta_data']
+    if not isinstance(meta_data, dict):
+        raise InvalidContentError('meta_data is invalid type')
+    for key, meta_type in META_DATA_ATTRIBUTES.items():
+        if key not in meta_data:
+            raise InvalidContentError(f'{key} does not exist')
+        if not isinstance(meta_data[key], meta_type):
+            raise InvalidContentError(f'{key} is invalid type')
+
+
+ContentDigest = namedtuple('ContentDigest', ['content_hash', 'size'])
+
+
+def content_digest(raw):
+    return ContentDigest(hashlib.sha256(raw).hexdigest(), len(raw))
+
+
+def parse_content(raw):
+    try:
+        content = json.loads(raw)
+    except (UnicodeDecodeError, json.decoder.JSONDecodeError) as e:
+        raise InvalidContentError(f'{e}')
+
+    validate_meta_data(content)
+    return content
+
+
+def load_content(stream, max_size=None, chunk_size=1024 * 1024):
+    """ アップロードされたファイルを検証して(ContentDigest, content)を返す
+    バイト列は保持せずに、ハッシュとサイズはストリームを少しずつ読んで計算する
+    パースするとファイルの何倍ものメモリを使うので、max_sizeを超えるものはパースする前に断る
+    """
+    sha256 = hashlib.sha256()
+    size = 0
+    for chunk in iter(lambda: stream.read(chunk_size), b''):
+        sha256.update(chunk)
+        size += len(chunk)
+        if max_size is not None and size > max_size:
+            raise InvalidContentError('file is too large')
+
+    # アップロードされたファイルはSpooledTemporaryFileなので、TextIOWrapperで包まずに読む(Python 3.11より前はreadableがない)
+    # json.loadsはバイト列のエンコーディング(UTF-16など)を判定する
+    stream.seek(0)
+    return ContentDigest(sha256.hexdigest(), size), parse_content(stream.read())
+
+
+def dump_content(content):
+    return json.dumps(content, ensure_ascii=False, separators=(',', ':')).encode()
+
+
+def split_sections(content):
+    """ 一部だけを返せるようにcontentを最上位のキーごとに分ける
+    labelsは言語ごとにも分ける({uri: {lang: label}}の形のまま)
+    """
+    fields = {key: dump_content(value) for key, value in content.items()}
+    labels = {}
+    if isinstance(content.get('labels'), dict):
+        for uri, label in content['labels'].items():
+            if not isinstance(label, dict):
+                continue
+            for lang, value in label.items():
+                labels.setdefault(lang, {})[uri] = {lang: value}
+    return fields, {lang: dump_content(value) for lang, value in labels.items()}
+
+
+def join_sections(parts):
+    """ (キー, JSON)の一覧を1つのJSONオブジェクトにする。それぞれのJSONはデコードしない """
+    return b''.join([
+        b'{',
+        b','.join(json.dumps(key, ensure_ascii=False).encode() + b':' + raw for key, raw in parts),
+        b'}',
+    ])
+
+
+def merge_labels(raw_labels):
+    """ 言語ごとに分けたlabelsを1つにする。1つだけならデコードしない """
+    if len(raw_labels) == 1:
+        return raw_labels[0]
+    merged = {}
+    for raw in raw_labels:
+        for uri, label in json.loads(raw).items():
+            merged.setdefault(uri, {}).update(label)
+    return dump_content(merged)
+
+
+def parse_crawl_date(crawl_date):
+    """ meta_dataのcrawl_date(umakaparserは'2015/12/31 14:18:17'の形式)を読む。読めなければNone """
+    if not isinstance(crawl_date, str):
+        return None
+    for date_format in CRAWL_DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(crawl_date.strip(), date_format)
+        except ValueError:
+            continue
+    return None
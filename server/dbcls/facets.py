@@ -0,0 +1,34 @@
+from urllib.parse import urlparse
+
+from dbcls.constants import TRIPLES_BUCKETS
+
+
+def triples_bucket(triples):
+    """ triplesを含む区間の下限 """
+    if not isinstance(triples, int) or isinstance(triples, bool) or triples < 0:
+        return None
+    return max(b for b in TRIPLES_BUCKETS if b <= triples)
+
+
+def endpoint_host(endpoint):
+    if not isinstance(endpoint, str):
+        return None
+    try:
+        host = urlparse(endpoint.strip()).hostname
+    except ValueError:
+        return None
+    return host[:255] if host else None
+
+
+def facet_values(meta_data):
+    """ DataSetを数える(ファセット, 値)の一覧。値が分からないファセットは含めない """
+    if not isinstance(meta_data, dict):
+        return []
+    values = []
+    bucket = triples_bucket(meta_data.get('triples'))
+    if bucket is not None:
+        values.append(('triples', str(bucket)))
+    host = endpoint_host(meta_data.get('endpoint'))
+    if host is not None:
+        values.append(('endpoint_host', host))
+    return values
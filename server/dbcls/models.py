@@ -2,11 +2,21 @@ from enum import Enum
 import json
 import codecs
 import datetime
+import hashlib
 import os
 from flask import url_for
-from sqlalchemy.orm import deferred
+from sqlalchemy import and_, event, inspect, literal, select, func, true, union_all
+from sqlalchemy.dialects.mysql import MEDIUMTEXT, insert as mysql_insert
+from sqlalchemy.orm import column_property, deferred
 from sqlalchemy.schema import FetchedValue
-from dbcls import app, db
+from dbcls import app, db, content_storage
+from dbcls.constants import TRIPLES_BUCKETS
+from dbcls.content import (
+    load_content, content_digest, dump_content, split_sections, join_sections, merge_labels, parse_crawl_date
+)
+from dbcls.facets import facet_values, endpoint_host
+from dbcls.search import build_search_text, build_tags_text
+from dbcls.uri_index import extract_uri_usages
 
 
 class User(db.Model):
@@ -54,6 +64,79 @@ tag_association_table = db.Table(
 )
 
 
+# クラスとプロパティのURIからDataSetを探すためのテーブル。DataSetを削除するとDBで削除される
+data_set_class_table = db.Table(
+    'data_set_classes',
+    db.Column('data_set_id', db.Integer, db.ForeignKey('data_sets.id', ondelete='CASCADE'), primary_key=True),
+    db.Column('uri_hash', db.String(64), primary_key=True),
+    db.Column('uri', db.Text, nullable=False),
+    db.Column('entities', db.BigInteger),
+    db.Index('class_uri_entities_idx', 'uri_hash', 'entities'),
+)
+
+data_set_property_table = db.Table(
+    'data_set_properties',
+    db.Column('data_set_id', db.Integer, db.ForeignKey('data_sets.id', ondelete='CASCADE'), primary_key=True),
+    db.Column('uri_hash', db.String(64), primary_key=True),
+    db.Column('uri', db.Text, nullable=False),
+    db.Column('triples', db.BigInteger),
+    db.Index('property_uri_triples_idx', 'uri_hash', 'triples'),
+)
+
+# 公開DataSetの一覧のファセットごとの数。DataSetの公開状態かmeta_dataが変わったときに数え直す
+public_facet_table = db.Table(
+    'public_facet_counts',
+    db.Column('facet', db.String(32), primary_key=True),
+    db.Column('value', db.String(255), primary_key=True),
+    db.Column('count', db.Integer, default=0, nullable=False),
+    db.Index('facet_count_idx', 'facet', 'count'),
+)
+
+
+def generate_path():
+    # base64url 192bit
+    path = codecs.encode(os.urandom(24), 'base64').decode()
+    return path.translate(path.maketrans('+/', '-_', '\n'))
+
+
+def store_sections(content):
+    """ contentをセクションごとにcontent_storageに保存して(参照, 保存したサイズ)を返す """
+    fields, labels = split_sections(content)
+    stored_fields = {key: content_storage.put(raw) for key, raw in fields.items()}
+    stored_labels = {lang: content_storage.put(raw) for lang, raw in labels.items()}
+    # 同じ内容のセクションは1つだけ保存される
+    stored_sizes = {
+        stored.content_hash: stored.stored_size
+        for stored in list(stored_fields.values()) + list(stored_labels.values())
+    }
+    content_sections = {
+        'fields': {key: stored.content_hash for key, stored in stored_fields.items()},
+        'labels': {lang: stored.content_hash for lang, stored in stored_labels.items()},
+    }
+    return content_sections, sum(stored_sizes.values())
+
+
+def prepare_content(digest, content):
+    """ contentをcontent_storageに保存してDataSetに設定する値を返す
+    全体はセクションをつなげて返すので、アップロードされたままのデータは保存しない
+    DBを使わないので別のプロセスでも実行できる
+    """
+    content_sections, stored_size = store_sections(content)
+    return {
+        # ETagと変更の検出に使う
+        'content_hash': digest.content_hash,
+        'content_size': digest.size,
+        'content_stored_size': stored_size,
+        'meta_data': content['meta_data'],
+        'crawled_at': parse_crawl_date(content['meta_data'].get('crawl_date')),
+        'endpoint_host': endpoint_host(content['meta_data'].get('endpoint')),
+        'content_sections': content_sections,
+        'search_text': build_search_text(content),
+        # DataSetのidが決まってから書き込む
+        'pending_uri_usages': extract_uri_usages(content),
+    }
+
+
 class DataSet(db.Model):
     __tablename__ = 'data_sets'
 
@@ -61,9 +144,21 @@ class DataSet(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     title = db.Column(db.String(64), default='', nullable=False)
     path = db.Column(db.String(255), unique=True, nullable=False)
-    content = deferred(db.Column(db.JSON))
+    # 移行前のデータ。新しいデータはcontent_storageに保存する
+    legacy_content = deferred(db.Column('content', db.JSON))
+    content_hash = db.Column(db.String(64), index=True)
+    content_size = db.Column(db.BigInteger)
+    content_stored_size = db.Column(db.BigInteger)
+    # 一部だけを返すためにセクションごとに保存したcontentのハッシュ
+    # {'fields': {キー: ハッシュ}, 'labels': {言語: ハッシュ}}
+    content_sections = db.Column(db.JSON)
+    # 変更前の値のファセットも数え直すために読み込んでおく
+    meta_data = column_property(db.Column(db.JSON), active_history=True)
     upload_at = db.Column(db.DateTime, nullable=False)
-    is_public = db.Column(db.Boolean, default=False, nullable=False)
+    is_public = column_property(db.Column(db.Boolean, default=False, nullable=False), active_history=True)
+    # 全文検索用。タグはタグの変更時に、それ以外はcontentの保存時に作る
+    search_tags = db.Column(db.Text, default='', nullable=False)
+    search_text = deferred(db.Column(db.Text().with_variant(MEDIUMTEXT, 'mysql'), default='', nullable=False))
 
     user = db.relationship('User', backref=db.backref('data_sets', cascade='all,delete'), enable_typechecks=False)
     tags = db.relationship(
@@ -76,6 +171,11 @@ class DataSet(db.Model):
     # jsonのデータでindexを作るためのVirtualカラム
     meta_data_classes = db.Column(db.Integer, server_default=FetchedValue())
     meta_data_properties = db.Column(db.Integer, server_default=FetchedValue())
+    # 別のインデックスで読んだ行を絞り込むときにJSONを読まないようにVirtualではなくStoredにしている
+    meta_data_triples = db.Column(db.BigInteger, server_default=FetchedValue())
+    # meta_dataのcrawl_dateとendpointはSQLで読みにくいのでcontentの保存時に設定する
+    crawled_at = db.Column(db.DateTime)
+    endpoint_host = db.Column(db.String(255))
 
     __table_args__ = (
         db.Index('public_upload_idx', 'is_public', 'upload_at'),
@@ -84,18 +184,80 @@ class DataSet(db.Model):
         db.Index('search_classes_idx', 'is_public', 'title', 'meta_data_classes'),
         db.Index('public_properties_idx', 'is_public', 'meta_data_properties'),
         db.Index('search_properties_idx', 'is_public', 'title', 'meta_data_properties'),
+        db.Index('public_triples_idx', 'is_public', 'meta_data_triples'),
+        db.Index('public_crawled_idx', 'is_public', 'crawled_at'),
+        db.Index('public_endpoint_host_idx', 'is_public', 'endpoint_host'),
+        db.Index('upload_idx', 'upload_at'),
+        db.Index('search_fulltext_idx', 'title', 'search_tags', 'search_text',
+                 mysql_prefix='FULLTEXT', mysql_with_parser='ngram'),
+        db.Index('title_fulltext_idx', 'title', mysql_prefix='FULLTEXT', mysql_with_parser='ngram'),
     )
 
+    # flush時にdata_set_classesとdata_set_propertiesに書き込む
+    pending_uri_usages = None
+
     @classmethod
-    def create(cls, user, file):
-        # base64url 192bit
-        path = codecs.encode(os.urandom(24), 'base64').decode()
-        path = path.translate(path.maketrans('+/', '-_', '\n'))
+    def create(cls, user, file, max_size=None):
         title, ext = os.path.splitext(file.filename)
-        content = json.load(file.stream)
+        digest, content = load_content(file.stream, max_size)
         upload_at = datetime.datetime.utcnow()
 
-        return cls(user=user, title=title[:32], path=path, content=content, upload_at=upload_at)
+        data_set = cls(user=user, title=title[:32], path=generate_path(), upload_at=upload_at)
+        data_set.store_content(digest, content)
+        return data_set
+
+    def store_content(self, digest, content):
+        for key, value in prepare_content(digest, content).items():
+            setattr(self, key, value)
+        self.legacy_content = None
+
+    def content_parts(self, fields=None, languages=None):
+        """ 指定したセクションを(キー, JSON)の一覧で返す
+        fieldsがNoneならすべてのセクション、languagesがNoneならすべての言語のラベル
+        """
+        if self.content_sections is None:
+            # セクションごとに保存する前のデータ
+            field_raws, label_raws = split_sections(self.content)
+            load = bytes
+        else:
+            field_raws, label_raws = self.content_sections['fields'], self.content_sections['labels']
+            load = content_storage.get
+
+        parts = []
+        for key in (field_raws if fields is None else fields):
+            if key not in field_raws:
+                continue
+            if key == 'labels' and languages is not None:
+                raw_labels = [load(label_raws[lang]) for lang in languages if lang in label_raws]
+                parts.append((key, merge_labels(raw_labels) if raw_labels else b'{}'))
+            else:
+                parts.append((key, load(field_raws[key])))
+        return parts
+
+    def raw_content(self):
+        """ contentのJSONをデコードせずに返す """
+        if self.content_sections is None:
+            # セクションごとに保存する前のデータ
+            return content_storage.get(self.content_hash)
+        return join_sections(self.content_parts())
+
+    @property
+    def content(self):
+        if self.content_hash is None:
+            return self.legacy_content
+        return json.loads(self.raw_content())
+
+    @content.setter
+    def content(self, content):
+        self.store_content(content_digest(dump_content(content)), content)
+
+    @property
+    def content_etag(self):
+        # 可視化用のレスポンスが変わるのはタイトルかcontentが変わったとき
+        if self.content_hash is None:
+            return None
+        key = f'{self.id}:{self.title}:{self.content_hash}'
+        return hashlib.sha256(key.encode()).hexdigest()
 
     @property
     def visualization_url(self):
@@ -105,11 +267,212 @@ class DataSet(db.Model):
         return f'<DataSet id={self.id} title={self.title} path={self.path}>'
 
 
+@event.listens_for(db.session, 'before_flush')
+def update_search_tags(session, flush_context, instances):
+    data_sets = set()
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, DataSet) and inspect(obj).attrs.tags.history.has_changes():
+            data_sets.add(obj)
+        # tag.data_sets.append()のように逆側から変更された場合
+        if isinstance(obj, Tag):
+            history = inspect(obj).attrs.data_sets.history
+            data_sets.update(history.added or ())
+            data_sets.update(history.deleted or ())
+    for data_set in data_sets:
+        data_set.search_tags = build_tags_text(t.name for t in data_set.tags)
+
+
+@event.listens_for(db.session, 'before_flush')
+def collect_tag_count_changes(session, flush_context, instances):
+    """ 公開DataSetの数が変わるかもしれないタグを集めて、flush後にpublic_countを数え直す """
+    tags = session.info.setdefault('tag_count_changes', set())
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, DataSet):
+            state = inspect(obj)
+            history = state.attrs.tags.history
+            if obj in session.deleted or history.has_changes() or state.attrs.is_public.history.has_changes():
+                tags.update(obj.tags)
+                tags.update(history.deleted or ())
+        if isinstance(obj, Tag) and inspect(obj).attrs.data_sets.history.has_changes():
+            tags.add(obj)
+
+
+def replace_uri_usages(session, data_set_id, uri_usages):
+    for table, rows in zip((data_set_class_table, data_set_property_table), uri_usages):
+        session.execute(table.delete().where(table.c.data_set_id == data_set_id))
+        if rows:
+            session.execute(table.insert(), [{**row, 'data_set_id': data_set_id} for row in rows])
+
+
+def _previous_value(obj, key):
+    history = inspect(obj).attrs[key].history
+    if history.deleted or history.unchanged:
+        return (history.deleted or history.unchanged)[0]
+    if history.added:
+        # 新しいDataSet
+        return None
+    return getattr(obj, key)
+
+
+@event.listens_for(db.session, 'before_flush')
+def collect_facet_changes(session, flush_context, instances):
+    """ 公開DataSetの数が変わる(ファセット, 値)を集めて、flush後にまとめて数え直す """
+    changes = session.info.setdefault('facet_changes', set())
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if not isinstance(obj, DataSet):
+            continue
+        state = inspect(obj)
+        changed = state.attrs.is_public.history.has_changes() or state.attrs.meta_data.history.has_changes()
+        if obj in session.dirty and not changed:
+            continue
+        if _previous_value(obj, 'is_public'):
+            changes.update(facet_values(_previous_value(obj, 'meta_data')))
+        if obj not in session.deleted and obj.is_public:
+            changes.update(facet_values(obj.meta_data))
+
+
+def facet_count_query(facet, value):
+    """ (ファセット, 値)の公開DataSetの数を(is_public, endpoint_host)か(is_public, meta_data_triples)のインデックスで数える """
+    query = (
+        select([literal(facet).label('facet'), literal(value).label('value'), func.count().label('count')])
+        .select_from(DataSet.__table__)
+        # IS TRUEではインデックスを使えないので=で比べる
+        .where(DataSet.is_public == true())
+    )
+    if facet == 'endpoint_host':
+        return query.where(DataSet.endpoint_host == value)
+    lower = int(value)
+    upper = min((bucket for bucket in TRIPLES_BUCKETS if bucket > lower), default=None)
+    query = query.where(DataSet.meta_data_triples >= lower)
+    return query if upper is None else query.where(DataSet.meta_data_triples < upper)
+
+
+def refresh_facet_counts(session, changes):
+    """ 公開DataSetのファセットごとの数を数え直す
+    増減で更新すると競合した更新でずれるので、変わった値だけをまとめて数える
+    """
+    if not changes:
+        return
+    counts = union_all(*(facet_count_query(facet, value) for facet, value in sorted(changes))).alias('counts')
+    # INSERT ... SELECTは読んだ行をロックするので、同時に変更されても確定した数になる
+    insert = mysql_insert(public_facet_table).from_select(
+        ['facet', 'value', 'count'],
+        select([counts.c.facet, counts.c.value, counts.c.count])
+    )
+    insert = insert.on_duplicate_key_update(count=insert.inserted.count)
+    session.execute(insert)
+
+
+def refresh_tag_counts(session, tag_ids):
+    """ タグを付けた公開DataSetの数を数え直す
+    増減で更新すると競合した更新でずれるので、変わったタグだけをまとめて数える
+    """
+    if not tag_ids:
+        return
+    public_count = (
+        select([func.count()])
+        .select_from(tag_association_table.join(DataSet.__table__))
+        .where(tag_association_table.c.tag_id == Tag.id)
+        # IS TRUEではインデックスを使えないので=で比べる
+        .where(DataSet.is_public == true())
+        .as_scalar()
+    )
+    session.execute(Tag.__table__.update().where(Tag.id.in_(tag_ids)).values(public_count=public_count))
+
+
+def set_data_set_tags(session, data_set, tag_names):
+    """ DataSetのタグをtag_namesにする
+    タグは1回のINSERTでまとめて作り、紐付けは差分だけを書き換える
+    """
+    tags = {}
+    if tag_names:
+        # 同時に同じ名前のタグを作っても一意制約で失敗しない
+        insert = mysql_insert(Tag.__table__)
+        insert = insert.on_duplicate_key_update(name=insert.inserted.name)
+        session.execute(insert, [{'name': name} for name in tag_names])
+        tags = dict(session.execute(select([Tag.id, Tag.name]).where(Tag.name.in_(tag_names))).fetchall())
+
+    current_tag_ids = {
+        row.tag_id for row in session.execute(
+            select([tag_association_table.c.tag_id]).where(tag_association_table.c.data_set_id == data_set.id)
+        )
+    }
+    added = set(tags) - current_tag_ids
+    removed = current_tag_ids - set(tags)
+    if removed:
+        session.execute(tag_association_table.delete().where(and_(
+            tag_association_table.c.data_set_id == data_set.id,
+            tag_association_table.c.tag_id.in_(removed),
+        )))
+    if added:
+        session.execute(tag_association_table.insert(), [
+            {'data_set_id': data_set.id, 'tag_id': tag_id} for tag_id in added
+        ])
+    refresh_tag_counts(session, added | removed)
+
+    # ORMを通さずに変更したのでflush時のフックの代わりに設定する
+    data_set.search_tags = build_tags_text(tags.values())
+    session.expire(data_set, ['tags'])
+
+
+def delete_data_sets(session, condition):
+    """ 条件に合うDataSetをテーブルごとに1回のDELETEで削除する(ORMのcascadeのように1行ずつ読み込まない)
+    data_set_classesとdata_set_propertiesは外部キーでDBが削除する
+    """
+    data_set_ids = select([DataSet.id]).where(condition)
+    facet_changes = set()
+    for row in session.execute(select([DataSet.meta_data]).where(and_(condition, DataSet.is_public == true()))):
+        facet_changes.update(facet_values(row.meta_data))
+    public_tag_ids = [
+        row.tag_id for row in session.execute(
+            select([tag_association_table.c.tag_id]).distinct()
+            .where(tag_association_table.c.data_set_id.in_(data_set_ids.where(DataSet.is_public == true())))
+        )
+    ]
+    session.execute(tag_association_table.delete().where(tag_association_table.c.data_set_id.in_(data_set_ids)))
+    deleted = session.execute(DataSet.__table__.delete().where(condition)).rowcount
+    refresh_tag_counts(session, public_tag_ids)
+    refresh_facet_counts(session, facet_changes)
+    return deleted
+
+
+def delete_user(session, user_id):
+    """ ユーザーとそのDataSetを削除する """
+    delete_data_sets(session, DataSet.user_id == user_id)
+    session.execute(user_role_association_table.delete().where(user_role_association_table.c.user_id == user_id))
+    session.execute(User.__table__.delete().where(User.id == user_id))
+
+
+@event.listens_for(db.session, 'after_flush')
+def write_uri_usages(session, flush_context):
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, DataSet) and obj.pending_uri_usages is not None:
+            replace_uri_usages(session, obj.id, obj.pending_uri_usages)
+            obj.pending_uri_usages = None
+
+
+@event.listens_for(db.session, 'after_flush')
+def update_tag_counts(session, flush_context):
+    tags = session.info.pop('tag_count_changes', set())
+    refresh_tag_counts(session, {tag.id for tag in tags})
+
+
+@event.listens_for(db.session, 'after_flush')
+def write_facet_counts(session, flush_context):
+    refresh_facet_counts(session, session.info.pop('facet_changes', set()))
+
+
 class Tag(db.Model):
     __tablename__ = 'tags'
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(20), unique=True, nullable=False)
+    # タグを付けた公開DataSetの数。タグの紐付けかDataSetの公開状態が変わったときに数え直す
+    public_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+
+    __table_args__ = (
+        db.Index('tag_public_count_idx', 'public_count'),
+    )
 
     def __repr__(self):
         return f'<Tag id={self.id} name={self.name}>'
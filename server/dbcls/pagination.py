@@ -0,0 +1,94 @@
+import base64
+import binascii
+import datetime
+import json
+
+from sqlalchemy import and_, or_
+
+
+class InvalidCursorError(Exception):
+    pass
+
+
+NEXT = 'n'
+PREVIOUS = 'p'
+
+
+def encode_cursor(direction, value, row_id):
+    if isinstance(value, datetime.datetime):
+        value = value.isoformat()
+    raw = json.dumps([direction, value, row_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor, column):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        direction, value, row_id = json.loads(raw)
+        if direction not in (NEXT, PREVIOUS) or not isinstance(row_id, int) or isinstance(row_id, bool):
+            raise ValueError(cursor)
+        # 配列やオブジェクトはSQLで比較できない
+        if value is not None and (not isinstance(value, (int, float, str)) or isinstance(value, bool)):
+            raise ValueError(cursor)
+        if value is not None and issubclass(column.type.python_type, datetime.datetime):
+            value = datetime.datetime.fromisoformat(value)
+    except (binascii.Error, ValueError, TypeError, NotImplementedError):
+        raise InvalidCursorError(cursor)
+    return direction, value, row_id
+
+
+def after_condition(column, id_column, value, row_id, descending):
+    """ (value, row_id)より後ろに並ぶ行の条件
+    MySQLではNULLが最小の値として並ぶ
+    """
+    if descending:
+        if value is None:
+            return and_(column.is_(None), id_column < row_id)
+        return or_(column < value, column.is_(None), and_(column == value, id_column < row_id))
+    if value is None:
+        return or_(column.isnot(None), and_(column.is_(None), id_column > row_id))
+    return or_(column > value, and_(column == value, id_column > row_id))
+
+
+class KeysetPage:
+    def __init__(self, rows, next_cursor, previous_cursor):
+        self.rows = rows
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+
+def paginate(query, column, id_column, descending, cursor, size):
+    """ OFFSETを使わずにソートしているカラムの値とidでページングする
+    idは同じ値のカラムが複数あるときの順序を決めるために使う
+    """
+    direction = NEXT
+    if cursor:
+        direction, value, row_id = decode_cursor(cursor, column)
+
+    # 前のページは逆順に取得してから並べ直す
+    backwards = direction == PREVIOUS
+    forward_descending = descending != backwards
+    if cursor:
+        query = query.filter(after_condition(column, id_column, value, row_id, forward_descending))
+    if forward_descending:
+        query = query.order_by(column.desc(), id_column.desc())
+    else:
+        query = query.order_by(column.asc(), id_column.asc())
+
+    rows = query.limit(size + 1).all()
+    has_more = len(rows) > size
+    rows = rows[:size]
+    if backwards:
+        rows.reverse()
+
+    def cursor_of(direction, row):
+        return encode_cursor(direction, getattr(row, column.key), getattr(row, id_column.key))
+
+    next_cursor = None
+    previous_cursor = None
+    if rows:
+        if has_more or backwards:
+            next_cursor = cursor_of(NEXT, rows[-1])
+        if (has_more and backwards) or (cursor and not backwards):
+            previous_cursor = cursor_of(PREVIOUS, rows[0])
+    return KeysetPage(rows, next_cursor, previous_cursor)
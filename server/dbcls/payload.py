@@ -0,0 +1,90 @@
+import gzip
+import json
+import os
+from pathlib import Path
+import tempfile
+import time
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from dbcls.content import dump_content, join_sections
+
+
+IDENTITY = 'identity'
+
+# 優先度の高い順
+ENCODINGS = {}
+if brotli is not None:
+    ENCODINGS['br'] = ('.br', lambda data: brotli.compress(data, mode=brotli.MODE_TEXT))
+ENCODINGS['gzip'] = ('.gz', lambda data: gzip.compress(data, compresslevel=9))
+
+
+def build_payload(data_set_id, title, raw_content):
+    """ 保存されているcontentをデコードせずにレスポンスのJSONに埋め込む """
+    if json.detect_encoding(raw_content) != 'utf-8':
+        raw_content = dump_content(json.loads(raw_content))
+    title = json.dumps(title, ensure_ascii=False).encode()
+    return b''.join([
+        b'{"id":', str(data_set_id).encode(),
+        b',"title":', title,
+        b',"content":', raw_content, b'}',
+    ])
+
+
+def build_projected_payload(data_set_id, title, parts):
+    """ (キー, JSON)の一覧からcontentを組み立てる。それぞれのJSONはデコードしない """
+    return build_payload(data_set_id, title, join_sections(parts))
+
+
+class PayloadCache:
+    """ 可視化用のレスポンスを圧縮済みの状態で保存しておく """
+
+    def __init__(self, root):
+        self.root = Path(root)
+
+    def _path(self, etag, encoding):
+        # 非圧縮のレスポンスはgzipから展開する
+        if encoding == IDENTITY:
+            encoding = 'gzip'
+        suffix, _ = ENCODINGS[encoding]
+        return Path(self.root, etag[:2], f'{etag}{suffix}')
+
+    def select_encoding(self, accept_encodings):
+        for encoding in ENCODINGS:
+            if accept_encodings[encoding]:
+                return encoding
+        return IDENTITY
+
+    def get_path(self, etag, encoding):
+        path = self._path(etag, encoding)
+        return path if path.exists() else None
+
+    def put(self, etag, payload):
+        for encoding, (_, compress) in ENCODINGS.items():
+            path = self._path(etag, encoding)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(compress(payload))
+                os.replace(temp_path, path)
+            except BaseException:
+                os.remove(temp_path)
+                raise
+
+    def read_identity(self, etag):
+        return gzip.decompress(self._path(etag, 'gzip').read_bytes())
+
+    def purge(self, older_than=0):
+        threshold = time.time() - older_than
+        purged = 0
+        if not self.root.exists():
+            return purged
+        for path in self.root.glob('*/*'):
+            if path.stat().st_mtime <= threshold:
+                path.unlink()
+                purged += 1
+        return purged
@@ -0,0 +1,77 @@
+import asyncio
+import time
+
+from aiohttp import web, ClientSession, TCPConnector
+
+from dbcls.sparql_proxy import PROXY_PATH, create_proxy_app
+
+
+FAKE_RESULT = {
+    'head': {'vars': ['s']},
+    'results': {'bindings': [{'s': {'type': 'uri', 'value': 'http://example.com/s'}}]},
+}
+FAKE_CSV_RESULT = 's\r\nhttp://example.com/s\r\n'
+
+
+def create_fake_sparql_app(delay=0.1, result=None):
+    """ delay秒後に決まった結果を返すSPARQLエンドポイント
+    同時に処理したリクエストの最大数と使われた接続の数を記録する
+    """
+    fake_app = web.Application()
+    stats = {'requests': 0, 'active': 0, 'max_active': 0, 'connections': set()}
+    fake_app['stats'] = stats
+
+    async def handle(request):
+        stats['requests'] += 1
+        stats['active'] += 1
+        stats['max_active'] = max(stats['max_active'], stats['active'])
+        stats['connections'].add(request.transport.get_extra_info('peername'))
+        try:
+            await asyncio.sleep(delay)
+        finally:
+            stats['active'] -= 1
+        if 'text/csv' in request.headers.get('Accept', ''):
+            return web.Response(text=FAKE_CSV_RESULT, content_type='text/csv')
+        return web.json_response(result or FAKE_RESULT, content_type='application/sparql-results+json')
+
+    fake_app.router.add_get('/sparql', handle)
+    return fake_app
+
+
+async def start_app(target_app):
+    runner = web.AppRunner(target_app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    return runner, f'http://{host}:{port}'
+
+
+async def run_benchmark(config, requests=200, concurrency=50, delay=0.1):
+    fake_app = create_fake_sparql_app(delay)
+    fake_runner, fake_url = await start_app(fake_app)
+    proxy_runner, proxy_url = await start_app(create_proxy_app(config))
+    try:
+        async with ClientSession(connector=TCPConnector(limit=concurrency)) as session:
+            async def send():
+                data = {'endpoint': f'{fake_url}/sparql', 'query': 'SELECT * WHERE { ?s ?p ?o }'}
+                async with session.post(f'{proxy_url}{PROXY_PATH}', data=data) as res:
+                    await res.read()
+                    return res.status
+
+            started_at = time.perf_counter()
+            statuses = await asyncio.gather(*(send() for _ in range(requests)))
+            elapsed = time.perf_counter() - started_at
+    finally:
+        await proxy_runner.cleanup()
+        await fake_runner.cleanup()
+
+    stats = fake_app['stats']
+    return {
+        'requests': requests,
+        'succeeded': statuses.count(200),
+        'elapsed': elapsed,
+        'requests_per_second': requests / elapsed,
+        'max_upstream_concurrency': stats['max_active'],
+        'upstream_connections': len(stats['connections']),
+    }
@@ -0,0 +1,65 @@
+import hashlib
+import re
+from urllib.parse import urlsplit
+import zlib
+
+
+# 文字列リテラル、IRI、コメントと空白の連続のどれか
+QUERY_TOKEN_PATTERN = re.compile(
+    r'(?P<literal>"""(?:[^"\\]|\\.|"(?!""))*"""|\'\'\'(?:[^\'\\]|\\.|\'(?!\'\'))*\'\'\''
+    r'|"(?:[^"\\\n]|\\.)*"|\'(?:[^\'\\\n]|\\.)*\')'
+    r'|(?P<iri><[^<>"{}|^`\\\s]*>)'
+    r'|(?P<space>(?:\s|#[^\n]*)+)'
+)
+
+
+def normalize_query(query):
+    """ 結果が変わらない範囲でクエリを正規化する
+    文字列リテラルとIRIの中は変えずに、コメントを取り除いて空白をまとめる
+    """
+    def replace(match):
+        if match.lastgroup == 'space':
+            return ' '
+        return match.group()
+
+    return QUERY_TOKEN_PATTERN.sub(replace, query).strip()
+
+
+class ProxyResultCache:
+    """ SPARQLプロキシの結果を圧縮してRedisに保存する
+    有効期限はエンドポイントごとに設定でき、0の場合は保存しない
+    """
+
+    def __init__(self, redis_client, default_ttl=3600, ttls=None, max_size=10 * 1024 * 1024):
+        self.redis_client = redis_client
+        self.default_ttl = default_ttl
+        self.ttls = ttls or {}
+        self.max_size = max_size
+
+    def key(self, endpoint, query, accept=None):
+        digest = hashlib.sha256(f'{endpoint}\n{accept or ""}\n{normalize_query(query)}'.encode()).hexdigest()
+        return f'proxy:{digest}'
+
+    def ttl(self, endpoint):
+        # URLが一致しなければホスト名で探す
+        if endpoint in self.ttls:
+            return self.ttls[endpoint]
+        return self.ttls.get(urlsplit(endpoint).netloc, self.default_ttl)
+
+    def get(self, key):
+        """ (content_type, body)を返す """
+        compressed = self.redis_client.get(key)
+        if compressed is None:
+            return None
+        content_type, body = zlib.decompress(compressed).split(b'\n', 1)
+        return content_type.decode(), body
+
+    def set(self, key, endpoint, content_type, body):
+        ttl = self.ttl(endpoint)
+        if not ttl:
+            return
+        compressed = zlib.compress(content_type.encode() + b'\n' + body)
+        # 大きすぎる結果でRedisを埋めない
+        if len(compressed) > self.max_size:
+            return
+        self.redis_client.set(key, compressed, ex=ttl)
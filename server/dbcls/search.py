@@ -0,0 +1,54 @@
+from sqlalchemy import Float, literal, String
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ColumnElement
+
+from dbcls.constants import SEARCH_TEXT_MAX_LENGTH
+
+
+class Match(ColumnElement):
+    """ MATCH (columns) AGAINST (query IN BOOLEAN MODE)
+    FULLTEXTインデックスと同じカラムを指定すること
+    """
+    type = Float()
+
+    def __init__(self, columns, against):
+        self.columns = columns
+        self.against = literal(against, String)
+
+
+@compiles(Match)
+def compile_match(element, compiler, **kw):
+    columns = ', '.join(compiler.process(column, **kw) for column in element.columns)
+    return f'MATCH ({columns}) AGAINST ({compiler.process(element.against, **kw)} IN BOOLEAN MODE)'
+
+
+def build_search_text(content):
+    """ contentのクラスとプロパティのURI、すべての言語のラベルを検索用の文字列にする """
+    words = []
+    classes = content.get('classes')
+    if isinstance(classes, dict):
+        words.extend(classes.keys())
+    properties = content.get('properties')
+    if isinstance(properties, list):
+        words.extend(p['uri'] for p in properties if isinstance(p, dict) and isinstance(p.get('uri'), str))
+    labels = content.get('labels')
+    if isinstance(labels, dict):
+        for label in labels.values():
+            if isinstance(label, dict):
+                words.extend(v for v in label.values() if isinstance(v, str))
+
+    # 重複を除いて順序は保つ
+    text = ' '.join(dict.fromkeys(w for w in words if w))
+    return text[:SEARCH_TEXT_MAX_LENGTH]
+
+
+def build_tags_text(tag_names):
+    return ' '.join(sorted(tag_names))
+
+
+def build_boolean_query(search):
+    """ 空白で区切った語をすべて含むもの(AND)を探す
+    ngramパーサーではフレーズ指定にすると語の部分一致になる
+    """
+    words = [w.replace('"', '') for w in search.split()]
+    return ' '.join(f'+"{w}"' for w in words if w)
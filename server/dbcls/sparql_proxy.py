@@ -0,0 +1,362 @@
+import asyncio
+from contextlib import asynccontextmanager
+import logging
+from urllib.parse import urlsplit
+
+from aiohttp import web, ClientError, ClientResponseError, ClientSession, ClientTimeout, TCPConnector
+import redis
+
+
+PROXY_PATH = '/api/v1/proxy'
+
+# SPARQLWrapperでJSONを指定した場合と同じパラメータ
+JSON_PARAMS = {'format': 'json', 'output': 'json', 'results': 'json'}
+JSON_ACCEPT = 'application/sparql-results+json,application/json,text/javascript,application/javascript'
+
+CHUNK_SIZE = 64 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+class InvalidProxyRequestError(Exception):
+    def __init__(self, message):
+        self.message = message
+
+
+class ResultTooLargeError(Exception):
+    pass
+
+
+class EndpointLimiter:
+    """ エンドポイントごとに同時に送るリクエストの数を制限する """
+
+    def __init__(self, concurrency):
+        self.concurrency = concurrency
+        # エンドポイント -> [Semaphore, 使用中と待機中の数]
+        self._semaphores = {}
+
+    @asynccontextmanager
+    async def limit(self, endpoint):
+        entry = self._semaphores.setdefault(endpoint, [asyncio.Semaphore(self.concurrency), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            # 使われていないエンドポイントは忘れる
+            if entry[1] == 0:
+                del self._semaphores[endpoint]
+
+
+class UpstreamResponse:
+    """ エンドポイントからのレスポンスを受け取った順に複数のクライアントへ中継する
+    キャッシュに保存する間はチャンクをすべて残し、それ以外は全員が読んだチャンクから捨てる
+    残さない場合は読まれていないチャンクがmax_buffer_sizeを超えるとエンドポイントからの読み込みを待たせる
+    """
+
+    def __init__(self, retain=False, max_buffer_size=16 * CHUNK_SIZE):
+        self.content_type = None
+        self.chunks = []
+        # 捨てたチャンクの数(chunks[0]の番号)
+        self.offset = 0
+        self.size = 0
+        self.retain = retain
+        self.max_buffer_size = max_buffer_size
+        self.done = False
+        self.error = None
+        self.started = asyncio.Event()
+        self._changed = asyncio.Event()
+        self._buffered_size = 0
+        # 読み手 -> 次に読むチャンクの番号
+        self._positions = {}
+        self._abandoned = False
+
+    @property
+    def joinable(self):
+        # 最初のチャンクから読める間だけ同じクエリの読み手が加われる
+        return self.offset == 0 and (self.retain or not self._abandoned)
+
+    def open(self):
+        reader = UpstreamReader(self)
+        self._positions[reader] = self.offset
+        return reader
+
+    def close(self, reader):
+        self._positions.pop(reader, None)
+        if not self._positions:
+            self._abandoned = True
+        self._trim()
+
+    def start(self, content_type):
+        self.content_type = content_type
+        self.started.set()
+
+    async def append(self, chunk):
+        """ チャンクを追加する。読み手がいなくなりキャッシュにも保存しないならFalseを返す """
+        self.chunks.append(chunk)
+        self.size += len(chunk)
+        self._buffered_size += len(chunk)
+        self._notify()
+        # 遅いクライアントに合わせてエンドポイントから読む速さを落とす
+        while not self.retain and not self._abandoned and self._buffered_size > self.max_buffer_size:
+            await self._changed.wait()
+        return self.retain or not self._abandoned
+
+    def release(self):
+        """ キャッシュに保存しないことが分かったら読まれたチャンクを捨てる """
+        self.retain = False
+        self._trim()
+
+    def finish(self, error=None):
+        self.done = True
+        self.error = error
+        self.started.set()
+        self._notify()
+
+    def _trim(self):
+        if self.retain:
+            return
+        position = min(self._positions.values(), default=self.offset + len(self.chunks))
+        if position == self.offset:
+            return
+        for chunk in self.chunks[:position - self.offset]:
+            self._buffered_size -= len(chunk)
+        del self.chunks[:position - self.offset]
+        self.offset = position
+        self._notify()
+
+    def _notify(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def read(self, reader):
+        """ 読み手の次のチャンクを返す。最後まで読んだらNone """
+        while True:
+            position = self._positions[reader]
+            if position < self.offset + len(self.chunks):
+                chunk = self.chunks[position - self.offset]
+                self._positions[reader] = position + 1
+                self._trim()
+                return chunk
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return None
+            await self._changed.wait()
+
+
+class UpstreamReader:
+    """ UpstreamResponseを最初のチャンクから読む。読み終わったらcloseする """
+
+    def __init__(self, upstream):
+        self.upstream = upstream
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        chunk = await self.upstream.read(self)
+        if chunk is None:
+            raise StopAsyncIteration
+        return chunk
+
+    def close(self):
+        self.upstream.close(self)
+
+
+class SparqlProxy:
+    """ SPARQLエンドポイントへのリクエストを非同期で中継する
+    接続はエンドポイントごとにkeep-aliveで使い回し、レスポンスはパースせずにそのまま流す
+    """
+
+    def __init__(self, timeout=1800, max_connections=100, max_concurrency_per_endpoint=4, keepalive_timeout=60,
+                 max_result_size=100 * 1024 * 1024, cache=None):
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.keepalive_timeout = keepalive_timeout
+        self.max_result_size = max_result_size
+        self.limiter = EndpointLimiter(max_concurrency_per_endpoint)
+        self.cache = cache
+        self.session = None
+        # キャッシュのキー -> エンドポイントから受け取っているレスポンス
+        self._inflight = {}
+
+    async def start(self):
+        self.session = ClientSession(
+            connector=TCPConnector(limit=self.max_connections, keepalive_timeout=self.keepalive_timeout),
+            timeout=ClientTimeout(total=self.timeout),
+        )
+
+    async def close(self):
+        await self.session.close()
+
+    async def request(self, endpoint, query, accept=None):
+        """ キャッシュがあれば(content_type, body)を、なければUpstreamReaderを返す
+        同じクエリを問い合わせている途中ならそのレスポンスを一緒に受け取る
+        """
+        loop = asyncio.get_event_loop()
+        key = None
+        if self.cache is not None:
+            key = self.cache.key(endpoint, query, accept)
+            try:
+                cached = await loop.run_in_executor(None, self.cache.get, key)
+            except redis.RedisError as e:
+                # キャッシュが使えなくてもエンドポイントに問い合わせる
+                logger.warning('failed to get proxy cache: %r', e)
+                cached = None
+            if cached is not None:
+                return cached
+            inflight = self._inflight.get(key)
+            if inflight is not None and inflight.joinable:
+                return inflight.open()
+
+        # キャッシュに保存する結果だけを最後まで残す
+        upstream = UpstreamResponse(retain=self.cache is not None and bool(self.cache.ttl(endpoint)))
+        reader = upstream.open()
+        task = asyncio.ensure_future(self._fetch(upstream, key, endpoint, query, accept))
+        if key is not None:
+            self._inflight[key] = upstream
+            task.add_done_callback(lambda _: self._inflight.pop(key, None) if self._inflight.get(key) is upstream else None)
+        return reader
+
+    async def _fetch(self, upstream, key, endpoint, query, accept):
+        # キャッシュに保存する場合は待っているクライアントが切断しても止めない
+        try:
+            async with self.limiter.limit(endpoint):
+                async with self.session.get(
+                    endpoint,
+                    params={'query': query} if accept else {'query': query, **JSON_PARAMS},
+                    headers={'Accept': accept or JSON_ACCEPT},
+                ) as res:
+                    res.raise_for_status()
+                    if res.content_length is not None and res.content_length > self.max_result_size:
+                        raise ResultTooLargeError()
+                    upstream.start(res.headers.get('Content-Type', 'application/octet-stream'))
+                    async for chunk in res.content.iter_chunked(CHUNK_SIZE):
+                        if upstream.size + len(chunk) > self.max_result_size:
+                            raise ResultTooLargeError()
+                        if not await upstream.append(chunk):
+                            # 受け取るクライアントがいない
+                            upstream.finish()
+                            return
+                        if upstream.retain and upstream.size > self.cache.max_size:
+                            # キャッシュに保存できない大きさなので残しておかない
+                            upstream.release()
+        except asyncio.CancelledError:
+            upstream.finish(ClientError('proxy is shutting down'))
+            raise
+        except Exception as e:
+            upstream.finish(e)
+            return
+        upstream.finish()
+
+        if upstream.retain:
+            try:
+                await asyncio.get_event_loop().run_in_executor(
+                    None, self.cache.set, key, endpoint, upstream.content_type, b''.join(upstream.chunks)
+                )
+            except redis.RedisError as e:
+                logger.warning('failed to set proxy cache: %r', e)
+
+
+def parse_proxy_form(form):
+    endpoint = form.get('endpoint')
+    query = form.get('query')
+    if not endpoint:
+        raise InvalidProxyRequestError('endpoint is required')
+    if not query:
+        raise InvalidProxyRequestError('query is required')
+    # ローカルファイルなどを読ませない
+    if urlsplit(endpoint).scheme not in ('http', 'https'):
+        raise InvalidProxyRequestError('endpoint is invalid')
+    return endpoint, query
+
+
+def parse_accept(accept):
+    """ 形式の指定がなければSPARQLWrapperと同じくJSONで問い合わせる """
+    if not accept or accept.strip() == '*/*':
+        return None
+    return accept
+
+
+@web.middleware
+async def cors_middleware(request, handler):
+    if request.method == 'OPTIONS':
+        response = web.Response()
+        response.headers['Access-Control-Allow-Methods'] = 'POST, OPTIONS'
+        if 'Access-Control-Request-Headers' in request.headers:
+            response.headers['Access-Control-Allow-Headers'] = request.headers['Access-Control-Request-Headers']
+        return response
+    return await handler(request)
+
+
+async def add_cors_headers(request, response):
+    # APIと同じくどこからでも使えるようにする。ストリームは送り始めると変更できないのでここで付ける
+    response.headers['Access-Control-Allow-Origin'] = '*'
+
+
+def error_response(error):
+    if isinstance(error, asyncio.TimeoutError):
+        return web.json_response({'message': 'endpoint timed out'}, status=504)
+    if isinstance(error, ClientResponseError):
+        return web.json_response({'message': f'endpoint returned {error.status}'}, status=502)
+    if isinstance(error, ResultTooLargeError):
+        return web.json_response({'message': 'result is too large'}, status=502)
+    return web.json_response({'message': 'endpoint is unavailable'}, status=502)
+
+
+async def handle_proxy(request):
+    proxy = request.app['proxy']
+    try:
+        endpoint, query = parse_proxy_form(await request.post())
+    except InvalidProxyRequestError as e:
+        return web.json_response({'message': e.message}, status=400)
+
+    result = await proxy.request(endpoint, query, parse_accept(request.headers.get('Accept')))
+    if isinstance(result, tuple):
+        content_type, body = result
+        return web.Response(body=body, headers={'Content-Type': content_type, 'X-Proxy-Cache': 'HIT'})
+
+    reader = result
+    try:
+        upstream = reader.upstream
+        await upstream.started.wait()
+        if upstream.content_type is None:
+            return error_response(upstream.error)
+
+        response = web.StreamResponse(headers={'Content-Type': upstream.content_type, 'X-Proxy-Cache': 'MISS'})
+        await response.prepare(request)
+        try:
+            async for chunk in reader:
+                await response.write(chunk)
+        except (asyncio.TimeoutError, ClientError, ResultTooLargeError) as e:
+            # 送り始めた後はステータスを変えられないので接続を切って途中で終わったことを伝える
+            logger.warning('proxy response from %s was aborted: %r', endpoint, e)
+            request.transport.close()
+            return response
+        await response.write_eof()
+        return response
+    finally:
+        # 読み終わったチャンクを捨てられるようにする
+        reader.close()
+
+
+def create_proxy_app(config, cache=None):
+    """ /api/v1/proxyだけを受け持つaiohttpのアプリケーション
+    uwsgiのプロセスを遅いエンドポイントに占有されないように別のプロセスで動かす
+    """
+    proxy_app = web.Application(middlewares=[cors_middleware])
+    proxy_app['proxy'] = SparqlProxy(**config, cache=cache)
+
+    async def on_startup(proxy_app):
+        await proxy_app['proxy'].start()
+
+    async def on_cleanup(proxy_app):
+        await proxy_app['proxy'].close()
+
+    proxy_app.on_startup.append(on_startup)
+    proxy_app.on_cleanup.append(on_cleanup)
+    proxy_app.on_response_prepare.append(add_cors_headers)
+    proxy_app.router.add_post(PROXY_PATH, handle_proxy)
+    return proxy_app
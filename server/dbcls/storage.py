@@ -0,0 +1,135 @@
+from collections import namedtuple
+import gzip
+import hashlib
+import os
+from pathlib import Path
+import tempfile
+import time
+
+from werkzeug.utils import import_string
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+StoredContent = namedtuple('StoredContent', ['content_hash', 'size', 'stored_size'])
+
+
+class GzipCodec:
+    suffix = '.gz'
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def compress(self, data):
+        return gzip.compress(data, compresslevel=self.level)
+
+    def decompress(self, data):
+        return gzip.decompress(data)
+
+
+class ZstdCodec:
+    suffix = '.zst'
+
+    def __init__(self, level=3):
+        if zstandard is None:
+            raise RuntimeError('zstandard is not installed')
+        self.level = level
+
+    def compress(self, data):
+        return zstandard.ZstdCompressor(level=self.level).compress(data)
+
+    def decompress(self, data):
+        return zstandard.ZstdDecompressor().decompress(data)
+
+
+CODECS = {
+    'gzip': GzipCodec,
+    'zstd': ZstdCodec,
+}
+
+
+class LocalContentStorage:
+    """ DataSetのcontentを圧縮してローカルディスクに保存する
+    ファイル名は圧縮前のデータのSHA-256なので同じ内容は1つだけ保存される
+    """
+
+    def __init__(self, root, compression='gzip', level=None):
+        self.root = Path(root)
+        options = {} if level is None else {'level': level}
+        self.codec = CODECS[compression](**options)
+
+    def _path(self, content_hash, suffix):
+        return Path(self.root, content_hash[:2], content_hash[2:4], f'{content_hash}{suffix}')
+
+    def _find(self, content_hash):
+        # 圧縮方式を変更しても以前のファイルを読めるようにする
+        for codec_class in CODECS.values():
+            path = self._path(content_hash, codec_class.suffix)
+            if path.exists():
+                return path, codec_class
+        return None, None
+
+    def _codec(self, codec_class):
+        if isinstance(self.codec, codec_class):
+            return self.codec
+        return codec_class()
+
+    def exists(self, content_hash):
+        path, _ = self._find(content_hash)
+        return path is not None
+
+    def put(self, data):
+        content_hash = hashlib.sha256(data).hexdigest()
+        path, _ = self._find(content_hash)
+        if path is not None:
+            try:
+                # 参照されていないcontentの削除(purge_contents)は更新時刻で保存直後のものを残すので、保存し直したことにする
+                os.utime(path)
+                return StoredContent(content_hash, len(data), path.stat().st_size)
+            except FileNotFoundError:
+                # 削除された直後なので書き込み直す
+                pass
+
+        path = self._path(content_hash, self.codec.suffix)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        compressed = self.codec.compress(data)
+        # 書き込み途中のファイルを読まれないように一時ファイルからrenameする
+        fd, temp_path = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(compressed)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        return StoredContent(content_hash, len(data), len(compressed))
+
+    def get(self, content_hash):
+        path, codec_class = self._find(content_hash)
+        if path is None:
+            raise FileNotFoundError(content_hash)
+        return self._codec(codec_class).decompress(path.read_bytes())
+
+    def delete(self, content_hash):
+        path, _ = self._find(content_hash)
+        if path is not None:
+            path.unlink()
+
+    def content_hashes(self, older_than=0):
+        # older_than秒より前に保存されたものだけを返す
+        if not self.root.exists():
+            return
+        threshold = time.time() - older_than
+        suffixes = set(codec_class.suffix for codec_class in CODECS.values())
+        for path in self.root.glob('*/*/*'):
+            if path.suffix in suffixes and path.stat().st_mtime <= threshold:
+                yield path.name[:-len(path.suffix)]
+
+
+def create_content_storage(config):
+    options = dict(config)
+    backend = import_string(options.pop('backend'))
+    return backend(**options)
@@ -0,0 +1,133 @@
+import time
+
+from dbcls import redis_client
+
+
+# ユーザーのキューが空だった場合はユーザーを順番待ちの最後に追加する
+ENQUEUE_SCRIPT = """
+local length = redis.call('RPUSH', KEYS[2], ARGV[1])
+if length == 1 then
+    redis.call('RPUSH', KEYS[1], ARGV[2])
+end
+return length
+"""
+
+# 先頭のユーザーのタスクを1つ取り出し、まだタスクがあればユーザーを最後に戻す
+# 取り出したタスクはackされるまで処理中として記録しておく
+DEQUEUE_SCRIPT = """
+local user = redis.call('LPOP', KEYS[1])
+if not user then
+    return false
+end
+local queue = ARGV[1] .. user
+local task_id = redis.call('LPOP', queue)
+if redis.call('LLEN', queue) > 0 then
+    redis.call('RPUSH', KEYS[1], user)
+end
+if task_id then
+    redis.call('ZADD', KEYS[2], ARGV[2], task_id)
+    redis.call('HSET', KEYS[3], task_id, user)
+    redis.call('HINCRBY', KEYS[4], task_id, 1)
+end
+return task_id
+"""
+
+# 処理中のタスクをユーザーのキューの先頭に戻す。他のプロセスが先に戻していればfalse
+REQUEUE_SCRIPT = """
+if redis.call('ZREM', KEYS[1], ARGV[1]) == 0 then
+    return false
+end
+local user = redis.call('HGET', KEYS[2], ARGV[1])
+redis.call('HDEL', KEYS[2], ARGV[1])
+if redis.call('LPUSH', ARGV[2] .. user, ARGV[1]) == 1 then
+    redis.call('LPUSH', KEYS[3], user)
+end
+return user
+"""
+
+
+class FairTaskQueue:
+    """ ユーザーごとのキューを順番に処理するタスクキュー
+    1人が大量に登録しても他のユーザーのタスクが後回しにならない
+    取り出したタスクはackするまで処理中として残るので、処理していたプロセスが終了してもrequeueで戻せる
+    """
+
+    def __init__(self, name):
+        self.users_key = f'{name}:users'
+        self.queue_key_prefix = f'{name}:queue:'
+        self.processing_key = f'{name}:processing'
+        self.owners_key = f'{name}:owners'
+        self.attempts_key = f'{name}:attempts'
+        self._enqueue = redis_client.register_script(ENQUEUE_SCRIPT)
+        self._dequeue = redis_client.register_script(DEQUEUE_SCRIPT)
+        self._requeue = redis_client.register_script(REQUEUE_SCRIPT)
+
+    def _queue_key(self, user_id):
+        return f'{self.queue_key_prefix}{user_id}'
+
+    def enqueue(self, user_id, task_id):
+        self._enqueue(keys=[self.users_key, self._queue_key(user_id)], args=[task_id, user_id])
+
+    def dequeue(self):
+        return self._dequeue(
+            keys=[self.users_key, self.processing_key, self.owners_key, self.attempts_key],
+            args=[self.queue_key_prefix, time.time()]
+        )
+
+    def ack(self, task_id):
+        """ 処理が終わったタスクを処理中から外す(成功しても失敗しても呼ぶ) """
+        pipe = redis_client.pipeline()
+        pipe.zrem(self.processing_key, task_id)
+        pipe.hdel(self.owners_key, task_id)
+        pipe.hdel(self.attempts_key, task_id)
+        pipe.execute()
+
+    def is_processing(self, task_id):
+        return redis_client.zscore(self.processing_key, task_id) is not None
+
+    def stale(self, grace):
+        """ 取り出してからgrace秒以上経った処理中のタスク """
+        return redis_client.zrangebyscore(self.processing_key, '-inf', time.time() - grace)
+
+    def attempts(self, task_id):
+        return int(redis_client.hget(self.attempts_key, task_id) or 0)
+
+    def requeue(self, task_id):
+        """ 処理中のタスクをユーザーのキューの先頭に戻す。処理中でなければFalse """
+        return bool(self._requeue(
+            keys=[self.processing_key, self.owners_key, self.users_key],
+            args=[task_id, self.queue_key_prefix]
+        ))
+
+    def position(self, user_id, task_id):
+        """ タスクより前に処理されるタスクの数。キューにない場合はNone """
+        users = redis_client.lrange(self.users_key, 0, -1)
+        pipe = redis_client.pipeline()
+        for user in users:
+            pipe.llen(self._queue_key(user))
+        pipe.lrange(self._queue_key(user_id), 0, -1)
+        *lengths, task_ids = pipe.execute()
+        if task_id not in task_ids or str(user_id) not in users:
+            return None
+
+        # 1周ごとに各ユーザーのタスクを1つずつ処理する
+        index = task_ids.index(task_id)
+        user_index = users.index(str(user_id))
+        position = 0
+        for i, length in enumerate(lengths):
+            position += min(length, index)
+            if i < user_index and length > index:
+                position += 1
+        return position
+
+    def __len__(self):
+        users = redis_client.lrange(self.users_key, 0, -1)
+        pipe = redis_client.pipeline()
+        for user in users:
+            pipe.llen(self._queue_key(user))
+        return sum(pipe.execute())
+
+
+generate_task_queue = FairTaskQueue('generate')
+delete_task_queue = FairTaskQueue('delete')
+bulk_upload_task_queue = FairTaskQueue('bulk_upload')
@@ -1,23 +1,61 @@
+import datetime
+from functools import lru_cache
 import json
 from enum import Enum
+import multiprocessing
 import os
+import signal
 import subprocess
 import tempfile
+import threading
+import time
 
+import pkg_resources
+from sqlalchemy import and_
 from werkzeug.datastructures import FileStorage
 
-from dbcls import db, app, redis_client
-from dbcls.constants import TASK_PROPERTIES_EXPIRE
-from dbcls.models import DataSet, User
+from dbcls import db, app, redis_client, index_asset_cache, converted_ontology_cache
+from dbcls.asset_cache import file_hash
+from dbcls.bulk_upload import ingest_archive, InvalidArchiveError
+from dbcls.cache import public_data_sets_cache
+from dbcls.constants import (
+    TASK_PROPERTIES_EXPIRE, TASK_HEARTBEAT_INTERVAL, TASK_HEARTBEAT_EXPIRE, TASK_MAX_ATTEMPTS, DELETE_CHUNK_SIZE
+)
+from dbcls.content import InvalidContentError
+from dbcls.models import DataSet, User, delete_data_sets
+from dbcls.task_queue import generate_task_queue, delete_task_queue, bulk_upload_task_queue
 
 
-class UmakaparserState(Enum):
+CONVRDF_JAR = 'ConvRDF/ConvRDF.jar'
+
+
+class TaskState(Enum):
+    """ ワーカーで処理するタスクの状態。DataSet生成、まとめてアップロード、まとめて削除で共通 """
     PENDING = 0
     STARTED = 1
     SUCCESS = 2
     FAILURE = 3
 
 
+UmakaparserState = TaskState
+
+
+@lru_cache()
+def umakaparser_version():
+    try:
+        return pkg_resources.get_distribution('umakaparser').version
+    except pkg_resources.DistributionNotFound:
+        return 'unknown'
+
+
+@lru_cache()
+def convrdf_version():
+    try:
+        return file_hash(CONVRDF_JAR)
+    except FileNotFoundError:
+        return 'unknown'
+
+
 class UmakaparserException(Exception):
     def __init__(self, return_code, message):
         self.return_code = return_code
@@ -41,66 +79,171 @@ def update_task_properties(task_id=None, **kwargs):
     pipe.execute()
 
 
+def heartbeat_key(task_id):
+    return f'{task_id}:heartbeat'
+
+
+def is_task_lost(queue, task_id):
+    """ 処理中のタスクが想定外のエラーで終了したかどうか
+    ハートビートが切れていても、キューの処理中に残っていればrecover_tasksで再実行される
+    """
+    return not redis_client.exists(heartbeat_key(task_id)) and not queue.is_processing(task_id)
+
+
+class Heartbeat:
+    """ タスクの処理中は定期的にRedisのキーを更新する
+    キーが期限切れになっていればタスクを処理していたプロセスは終了している
+    """
+
+    def __init__(self, task_id, interval=TASK_HEARTBEAT_INTERVAL, expire=TASK_HEARTBEAT_EXPIRE):
+        self.task_id = task_id
+        self.interval = interval
+        self.expire = expire
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _beat(self):
+        redis_client.set(heartbeat_key(self.task_id), 1, ex=self.expire)
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            self._beat()
+
+    def __enter__(self):
+        if self.task_id is not None:
+            self._beat()
+            self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.task_id is not None:
+            self._stop_event.set()
+            self._thread.join()
+            redis_client.delete(heartbeat_key(self.task_id))
+
+
+class GenerateStage(Enum):
+    UPLOADED = 'UPLOADED'
+    CONVERT = 'CONVERT'
+    BUILD_INDEX = 'BUILD_INDEX'
+    BUILD = 'BUILD'
+    INGEST = 'INGEST'
+    SUCCESS = 'SUCCESS'
+    FAILURE = 'FAILURE'
+
+
+def task_events_key(task_id):
+    return f'{task_id}:events'
+
+
+def task_events_channel(task_id):
+    return f'{task_id}:events:channel'
+
+
+def record_progress(task_id, stage, **kwargs):
+    """ 進捗をイベントとして記録し、待っているクライアントに通知する """
+    if task_id is None:
+        return
+
+    task_properties = redis_client.get(task_id)
+    created_at = json.loads(task_properties).get('created_at') if task_properties else None
+    event = {
+        'stage': stage.value,
+        'elapsed': round(time.time() - created_at, 3) if created_at is not None else None,
+        **kwargs,
+    }
+    pipe = redis_client.pipeline()
+    pipe.rpush(task_events_key(task_id), json.dumps(event))
+    pipe.expire(task_events_key(task_id), TASK_PROPERTIES_EXPIRE)
+    pipe.publish(task_events_channel(task_id), stage.value)
+    pipe.execute()
+
+
 class ProcessErrorType(Enum):
     CONVERT_ERROR = 'CONVERT_ERROR'
     OWL_ERROR = 'OWL_ERROR'
     SBM_ERROR = 'SBM_ERROR'
 
 
-def generate_by_umakaparser(user_id, sbm_path, ontology_path, task_id=None):
-    with app.app_context():
+def generate_by_umakaparser(user_id, sbm_path, ontology_path, task_id=None, ontology_hash=None):
+    with app.app_context(), Heartbeat(task_id):
         update_task_properties(
             task_id,
-            state=UmakaparserState.STARTED.value,
-            pid=os.getpid()
+            state=UmakaparserState.STARTED.value
         )
 
+        # ワーカーは長時間動くのでファイルディスクリプタを残さない
+        fd, output = tempfile.mkstemp()
+        os.close(fd)
         try:
             user = User.query.get(user_id)
             if not user:
                 raise UmakaparserException(1, f'user({user_id}) not found')
 
-            _, output = tempfile.mkstemp()
-
             with tempfile.TemporaryDirectory() as assets_path:
                 # オントロジーをコンバート
                 assets = []
                 if ontology_path:
+                    # アップロード時に計算したハッシュがあればそれを使う
+                    ontology_hash = ontology_hash or file_hash(ontology_path)
                     _, ext = os.path.splitext(ontology_path)
                     if ext not in ('.ttl', '.nt'):
+                        record_progress(task_id, GenerateStage.CONVERT)
+                        converted_dir = os.path.join(assets_path, 'converted')
+                        os.mkdir(converted_dir)
                         converted_path = os.path.join(
-                            assets_path, 'converted_file.nt')
-                        with open(converted_path, 'w') as fp:
-                            convert_process = subprocess.run(
-                                ['java', '-jar', 'ConvRDF/ConvRDF.jar', ontology_path],
-                                stdout=fp,
-                                stderr=subprocess.PIPE,
-                                encoding='utf-8'
-                            )
+                            converted_dir, 'converted_file.nt')
+                        # 同じ内容のオントロジーは変換済みのものを使う
+                        converted_key = converted_ontology_cache.key(ontology_hash, convrdf_version())
+                        if not converted_ontology_cache.checkout(converted_key, converted_dir):
+                            # 変換結果はPythonを経由せずにファイルへ直接書き出す
+                            with open(converted_path, 'wb') as fp:
+                                convert_process = subprocess.run(
+                                    ['java', '-jar', CONVRDF_JAR, ontology_path],
+                                    stdout=fp,
+                                    stderr=subprocess.PIPE
+                                )
+                            if convert_process.stderr:
+                                app.logger.warning(
+                                    'ConvRDF reported errors (task_id=%s): %s',
+                                    task_id, convert_process.stderr.decode(errors='replace')
+                                )
 
-                        if convert_process.returncode != 0:
-                            raise UmakaparserException(
-                                convert_process.returncode,
-                                ProcessErrorType.CONVERT_ERROR.value
-                            )
+                            if convert_process.returncode != 0:
+                                raise UmakaparserException(
+                                    convert_process.returncode,
+                                    ProcessErrorType.CONVERT_ERROR.value
+                                )
+                            converted_ontology_cache.store(converted_key, converted_dir)
+                        # 同じ入力とConvRDFなら変換結果も同じなので読み直さない
+                        converted_hash = converted_key
                     else:
                         converted_path = ontology_path
+                        converted_hash = ontology_hash
 
                     # オントロジーからassets
-                    build_index = subprocess.run(
-                        ['umakaparser', 'build-index',
-                            converted_path, '-d', assets_path],
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.PIPE,
-                        encoding='utf-8'
-                    )
-                    if build_index.returncode != 0:
-                        raise UmakaparserException(
-                            build_index.returncode,
-                            ProcessErrorType.OWL_ERROR.value
+                    record_progress(task_id, GenerateStage.BUILD_INDEX)
+                    index_path = os.path.join(assets_path, 'index')
+                    os.mkdir(index_path)
+                    # 同じオントロジーとumakaparserのバージョンならキャッシュを使う
+                    asset_key = index_asset_cache.key(converted_hash, umakaparser_version())
+                    if not index_asset_cache.checkout(asset_key, index_path):
+                        build_index = subprocess.run(
+                            ['umakaparser', 'build-index',
+                                converted_path, '-d', index_path],
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE,
+                            encoding='utf-8'
                         )
-                    assets = ['-a', assets_path]
+                        if build_index.returncode != 0:
+                            raise UmakaparserException(
+                                build_index.returncode,
+                                ProcessErrorType.OWL_ERROR.value
+                            )
+                        index_asset_cache.store(asset_key, index_path)
+                    assets = ['-a', index_path]
                 # モデルデータ作成
+                record_progress(task_id, GenerateStage.BUILD)
                 build = subprocess.run(
                     ['umakaparser', 'build'] + assets + ['-d', output, sbm_path],
                     stdout=subprocess.PIPE,
@@ -113,25 +256,242 @@ def generate_by_umakaparser(user_id, sbm_path, ontology_path, task_id=None):
                         ProcessErrorType.SBM_ERROR.value
                     )
                 # 生成されたJSONファイルからDataSetを作成
+                record_progress(task_id, GenerateStage.INGEST)
                 with open(output, 'rb') as json_file:
-                    data_set = DataSet.create(user, FileStorage(
-                        json_file, 'generated by umakaparser'))
+                    try:
+                        data_set = DataSet.create(user, FileStorage(
+                            json_file, 'generated by umakaparser'))
+                    except InvalidContentError:
+                        raise UmakaparserException(
+                            1,
+                            ProcessErrorType.SBM_ERROR.value
+                        )
                 db.session.add(data_set)
                 db.session.commit()
+                public_data_sets_cache.invalidate()
 
             update_task_properties(
                 task_id,
                 state=UmakaparserState.SUCCESS.value,
                 data_set_id=data_set.id
             )
+            record_progress(task_id, GenerateStage.SUCCESS, data_set_id=data_set.id)
         except UmakaparserException as e:
             update_task_properties(
                 task_id,
                 state=UmakaparserState.FAILURE.value,
                 message=e.message
             )
+            record_progress(task_id, GenerateStage.FAILURE, message=e.message)
         finally:
             os.remove(output)
             if ontology_path:
                 os.remove(ontology_path)
             os.remove(sbm_path)
+
+
+def data_set_condition(criteria):
+    """ まとめて削除するDataSetの条件。指定された条件をすべて満たすもの """
+    conditions = []
+    if 'ids' in criteria:
+        conditions.append(DataSet.id.in_(criteria['ids']))
+    if 'user_id' in criteria:
+        conditions.append(DataSet.user_id == criteria['user_id'])
+    if 'is_public' in criteria:
+        conditions.append(DataSet.is_public.is_(criteria['is_public']))
+    if 'uploaded_before' in criteria:
+        conditions.append(DataSet.upload_at < datetime.datetime.fromisoformat(criteria['uploaded_before']))
+    if 'uploaded_after' in criteria:
+        conditions.append(DataSet.upload_at >= datetime.datetime.fromisoformat(criteria['uploaded_after']))
+    return and_(*conditions)
+
+
+def delete_by_criteria(task_id, criteria, chunk_size=DELETE_CHUNK_SIZE):
+    """ chunk_sizeごとにトランザクションを分けて削除し、DBを長くロックしないようにする """
+    condition = data_set_condition(criteria)
+    update_task_properties(task_id, state=TaskState.STARTED.value)
+    deleted = 0
+    last_id = 0
+    with Heartbeat(task_id):
+        while True:
+            ids = [
+                row.id for row in
+                DataSet.query.with_entities(DataSet.id)
+                .filter(condition, DataSet.id > last_id)
+                .order_by(DataSet.id)
+                .limit(chunk_size)
+            ]
+            if not ids:
+                break
+            deleted += delete_data_sets(db.session, DataSet.id.in_(ids))
+            db.session.commit()
+            public_data_sets_cache.invalidate()
+            last_id = ids[-1]
+            update_task_properties(task_id, deleted=deleted)
+    update_task_properties(task_id, state=TaskState.SUCCESS.value, deleted=deleted)
+
+
+def run_delete_task(task_id):
+    task_properties = redis_client.get(task_id)
+    if not task_properties:
+        return
+    if TaskState(json.loads(task_properties)['state']) in (TaskState.SUCCESS, TaskState.FAILURE):
+        return
+    try:
+        delete_by_criteria(task_id, json.loads(task_properties)['criteria'])
+    except Exception:
+        db.session.rollback()
+        app.logger.exception('failed to delete data sets (task_id=%s)', task_id)
+        update_task_properties(task_id, state=TaskState.FAILURE.value, message='raised unknown error')
+
+
+def bulk_upload(task_id, task_properties):
+    """ アップロードされたアーカイブからDataSetを作る
+    書き込むたびに結果を記録し、再実行した場合は記録済みのファイルを読み飛ばす
+    """
+    files = task_properties['files']
+    update_task_properties(task_id, state=TaskState.STARTED.value)
+
+    def on_batch(results):
+        files.extend(results)
+        if any(result['status'] == 'created' for result in results):
+            public_data_sets_cache.invalidate()
+        update_task_properties(task_id, files=files)
+
+    with Heartbeat(task_id):
+        try:
+            ingest_archive(
+                task_properties['user'],
+                task_properties['archive_path'],
+                app.config['BULK_UPLOAD_WORKER_PROCESSES'],
+                app.config['BULK_UPLOAD_BATCH_SIZE'],
+                app.config['BULK_UPLOAD_MAX_FILES'],
+                app.config['BULK_UPLOAD_MAX_FILE_SIZE'],
+                skip=len(files),
+                on_batch=on_batch
+            )
+        except InvalidArchiveError as e:
+            update_task_properties(task_id, state=TaskState.FAILURE.value, message=e.message)
+            return
+    update_task_properties(task_id, state=TaskState.SUCCESS.value)
+
+
+def run_bulk_upload_task(task_id):
+    task_properties = redis_client.get(task_id)
+    if not task_properties:
+        return
+    task_properties = json.loads(task_properties)
+    if TaskState(task_properties['state']) in (TaskState.SUCCESS, TaskState.FAILURE):
+        return
+    try:
+        bulk_upload(task_id, task_properties)
+    except Exception:
+        db.session.rollback()
+        app.logger.exception('failed to upload data sets (task_id=%s)', task_id)
+        update_task_properties(task_id, state=TaskState.FAILURE.value, message='raised unknown error')
+    # ワーカーが途中で終了した場合は再実行するのでアーカイブを残しておく
+    os.remove(task_properties['archive_path'])
+
+
+def run_generate_task(task_id):
+    task_properties = redis_client.get(task_id)
+    if not task_properties:
+        return
+    task_properties = json.loads(task_properties)
+    # 処理が終わってからackする前にワーカーが終了した場合
+    if UmakaparserState(task_properties['state']) in (UmakaparserState.SUCCESS, UmakaparserState.FAILURE):
+        return
+    try:
+        generate_by_umakaparser(
+            task_properties['user'],
+            task_properties['sbm_path'],
+            task_properties['ontology_path'],
+            task_id,
+            ontology_hash=task_properties.get('ontology_hash')
+        )
+    except Exception:
+        # 想定外のエラーでもワーカーは止めない
+        app.logger.exception('failed to generate data set (task_id=%s)', task_id)
+        update_task_properties(
+            task_id,
+            state=UmakaparserState.FAILURE.value,
+            message='raised unknown error'
+        )
+        record_progress(task_id, GenerateStage.FAILURE, message='raised unknown error')
+
+
+def run_generate_worker(stop_event, poll_interval=1):
+    # 終了は親プロセスから伝えるので処理中のタスクは最後まで実行する
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    while not stop_event.is_set():
+        # DataSet生成のタスクがなければまとめてアップロードするタスク、まとめて削除するタスクの順に処理する
+        tasks = (
+            (generate_task_queue, run_generate_task),
+            (bulk_upload_task_queue, run_bulk_upload_task),
+            (delete_task_queue, run_delete_task),
+        )
+        for queue, run_task in tasks:
+            task_id = queue.dequeue()
+            if task_id is not None:
+                try:
+                    run_task(task_id)
+                finally:
+                    queue.ack(task_id)
+                break
+        else:
+            stop_event.wait(poll_interval)
+
+
+def recover_tasks(queue):
+    """ 処理中にワーカーが終了したタスクをキューに戻す
+    ハートビートが切れていれば処理していたワーカーは終了している
+    何度もワーカーを終了させるタスクはTASK_MAX_ATTEMPTS回で諦める
+    """
+    for task_id in queue.stale(TASK_HEARTBEAT_EXPIRE):
+        if redis_client.exists(heartbeat_key(task_id)):
+            continue
+        task_properties = redis_client.get(task_id)
+        state = TaskState(json.loads(task_properties)['state']) if task_properties else None
+        if state in (None, TaskState.SUCCESS, TaskState.FAILURE):
+            # 処理が終わっているか、タスクが期限切れ
+            queue.ack(task_id)
+        elif queue.attempts(task_id) >= TASK_MAX_ATTEMPTS:
+            queue.ack(task_id)
+            update_task_properties(
+                task_id, state=TaskState.FAILURE.value, message='worker stopped while processing the task'
+            )
+        elif queue.requeue(task_id):
+            app.logger.warning('requeued task (task_id=%s)', task_id)
+            update_task_properties(task_id, state=TaskState.PENDING.value)
+
+
+def run_generate_worker_pool(processes, poll_interval=1):
+    # 子プロセスではconnectionを持ち越せないので、forkの前に破棄しておく
+    # https://docs.sqlalchemy.org/en/13/faq/connections.html#how-do-i-use-engines-connections-sessions-with-python-multiprocessing-or-os-fork
+    db.engine.dispose()
+    stop_event = multiprocessing.Event()
+
+    def start_worker():
+        worker = multiprocessing.Process(target=run_generate_worker, args=(stop_event, poll_interval))
+        worker.start()
+        return worker
+
+    def stop(signum, frame):
+        stop_event.set()
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    workers = [start_worker() for _ in range(processes)]
+    while not stop_event.is_set():
+        # 異常終了したワーカーは作り直し、処理していたタスクはキューに戻す
+        for i, worker in enumerate(workers):
+            if not worker.is_alive():
+                workers[i] = start_worker()
+        recover_tasks(generate_task_queue)
+        recover_tasks(bulk_upload_task_queue)
+        recover_tasks(delete_task_queue)
+        stop_event.wait(poll_interval)
+    for worker in workers:
+        worker.join()
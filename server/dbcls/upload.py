@@ -0,0 +1,231 @@
+import bz2
+import hashlib
+import lzma
+import os
+from pathlib import Path
+import tempfile
+import zipfile
+import zlib
+
+from flask import Request as BaseRequest
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge
+
+
+# 一度に展開するサイズ。展開後に極端に大きくなるファイルでもメモリを使いすぎないようにする
+CHUNK_SIZE = 1024 * 1024
+
+
+class Request(BaseRequest):
+    """ file_stream_factoryを設定するとアップロードされたファイルをそこに書き込む """
+    file_stream_factory = None
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if self.file_stream_factory is not None:
+            return self.file_stream_factory(total_content_length, content_type, filename, content_length)
+        return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+
+
+class GzipDecompressor:
+    """ zlibをbz2.BZ2Decompressorやlzma.LZMADecompressorと同じように使う """
+
+    def __init__(self):
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._tail = b''
+
+    def decompress(self, data, max_length=-1):
+        data = self._decompressor.decompress(self._tail + data, max(max_length, 0))
+        self._tail = self._decompressor.unconsumed_tail
+        return data
+
+    @property
+    def eof(self):
+        return self._decompressor.eof
+
+    @property
+    def unused_data(self):
+        return self._decompressor.unused_data
+
+    @property
+    def needs_input(self):
+        return not self._tail
+
+
+DECOMPRESSORS = {
+    '.gz': GzipDecompressor,
+    '.bz2': bz2.BZ2Decompressor,
+    '.xz': lzma.LZMADecompressor,
+}
+DECOMPRESS_ERRORS = (zlib.error, OSError, EOFError, lzma.LZMAError)
+
+
+class StreamDecompressor:
+    """ 書き込まれたデータを少しずつ展開する。複数のストリームを連結したファイルにも対応する """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._decompressor = factory()
+
+    def decompress(self, data):
+        while True:
+            if self._decompressor.eof:
+                data = self._decompressor.unused_data + data
+                if not data:
+                    return
+                self._decompressor = self._factory()
+            elif not data and self._decompressor.needs_input:
+                return
+            chunk = self._decompressor.decompress(data, CHUNK_SIZE)
+            data = b''
+            if chunk:
+                yield chunk
+
+    @property
+    def eof(self):
+        return self._decompressor.eof
+
+
+def split_compression_suffix(filename):
+    """ ファイル名から展開後の拡張子と圧縮形式の拡張子を取り出す """
+    path = Path(filename or '')
+    compression = path.suffix.lower()
+    if compression in DECOMPRESSORS or compression == '.zip':
+        return Path(path.stem).suffix, compression
+    return path.suffix, None
+
+
+class HashingFile:
+    """ 書き込みながら展開し、展開後のSHA-256とサイズを計算する
+    zipは最後にまとめて展開する(中央ディレクトリがファイルの末尾にあるため)
+    """
+
+    def __init__(self, uploader, path, fp, compression=None):
+        self.uploader = uploader
+        self.path = path
+        self.created_paths = [path]
+        self.compression = compression
+        self.size = 0
+        self._fp = fp
+        self._sha256 = hashlib.sha256()
+        self._decompressor = None
+        if compression in DECOMPRESSORS:
+            self._decompressor = StreamDecompressor(DECOMPRESSORS[compression])
+
+    def write(self, data):
+        self.uploader.count(len(data))
+        if self.compression == '.zip':
+            return self._fp.write(data)
+        if self._decompressor is None:
+            self._write(data)
+            return len(data)
+        try:
+            for chunk in self._decompressor.decompress(data):
+                self._write(chunk)
+        except DECOMPRESS_ERRORS:
+            raise BadRequest(f'{self.compression} file is broken')
+        return len(data)
+
+    def _write(self, data):
+        self.size += len(data)
+        self.uploader.count_extracted(self.size)
+        self._sha256.update(data)
+        self._fp.write(data)
+
+    def finish(self):
+        if self._decompressor is not None and not self._decompressor.eof:
+            self._fp.close()
+            raise BadRequest(f'{self.compression} file is broken')
+        if self.compression != '.zip':
+            self._fp.close()
+            return
+
+        # 1つだけ含まれているファイルを取り出す
+        zip_fp, zip_path = self._fp, self.path
+        zip_fp.seek(0)
+        try:
+            with zipfile.ZipFile(zip_fp) as archive:
+                members = [info for info in archive.infolist() if not info.is_dir()]
+                if len(members) != 1:
+                    raise BadRequest('.zip file must contain exactly one file')
+                if not Path(members[0].filename).suffix:
+                    raise BadRequest('file in .zip must have the RDF extension (e.g. data.ttl)')
+                fd, self.path = tempfile.mkstemp(
+                    suffix=Path(members[0].filename).suffix, dir=self.uploader.workspace
+                )
+                self.created_paths.append(self.path)
+                self._fp = os.fdopen(fd, 'wb')
+                with archive.open(members[0]) as member:
+                    for chunk in iter(lambda: member.read(CHUNK_SIZE), b''):
+                        self._write(chunk)
+        except (zipfile.BadZipFile, *DECOMPRESS_ERRORS):
+            raise BadRequest('.zip file is broken')
+        finally:
+            zip_fp.close()
+            self._fp.close()
+        os.remove(zip_path)
+        self.created_paths.remove(zip_path)
+
+    @property
+    def sha256(self):
+        return self._sha256.hexdigest()
+
+    def __getattr__(self, name):
+        return getattr(self._fp, name)
+
+
+class WorkspaceUploader:
+    """ アップロードされたファイルをバッファせずに作業ディレクトリへ直接書き込む
+    合計がmax_sizeを超えた時点で413を返し、書き込んだファイルを削除する
+    圧縮されたファイル(.gz, .bz2, .xz, .zip)は展開して保存する。decompressがFalseならそのまま保存する
+    """
+
+    def __init__(self, workspace, max_size=None, max_extracted_size=None, decompress=True):
+        self.workspace = workspace
+        self.max_size = max_size
+        self.max_extracted_size = max_extracted_size
+        self.decompress = decompress
+        self.size = 0
+        self.files = []
+
+    def check_content_length(self, content_length):
+        # 本文を受け取る前にわかる場合はすぐに断る
+        if self.max_size is not None and content_length and content_length > self.max_size:
+            raise RequestEntityTooLarge()
+
+    def count(self, size):
+        self.size += size
+        if self.max_size is not None and self.size > self.max_size:
+            raise RequestEntityTooLarge()
+
+    def count_extracted(self, size):
+        if self.max_extracted_size is not None and size > self.max_extracted_size:
+            raise RequestEntityTooLarge()
+
+    def stream_factory(self, total_content_length, content_type, filename=None, content_length=None):
+        os.makedirs(self.workspace, exist_ok=True)
+        if not self.decompress:
+            fd, path = tempfile.mkstemp(suffix=Path(filename or '').suffix, dir=self.workspace)
+            stream = HashingFile(self, path, os.fdopen(fd, 'w+b'))
+            self.files.append(stream)
+            return stream
+        suffix, compression = split_compression_suffix(filename)
+        if compression is not None and compression != '.zip' and not suffix:
+            # 展開後の拡張子でRDFの形式を判断するので、data.gzのような名前では変換できない
+            raise BadRequest(f'{compression} file name must include the RDF extension (e.g. data.ttl{compression})')
+        if compression == '.zip':
+            suffix = compression
+        fd, path = tempfile.mkstemp(suffix=suffix, dir=self.workspace)
+        stream = HashingFile(self, path, os.fdopen(fd, 'w+b'), compression)
+        self.files.append(stream)
+        return stream
+
+    def finish(self):
+        for stream in self.files:
+            stream.finish()
+
+    def discard(self):
+        for stream in self.files:
+            stream.close()
+            for path in stream.created_paths:
+                if os.path.exists(path):
+                    os.remove(path)
+        self.files = []
@@ -0,0 +1,34 @@
+import hashlib
+
+
+def uri_hash(uri):
+    # URIは長さの制限がないのでハッシュでインデックスを作る
+    return hashlib.sha256(uri.encode()).hexdigest()
+
+
+def _count(value):
+    return value if isinstance(value, int) and not isinstance(value, bool) else None
+
+
+def extract_uri_usages(content):
+    """ contentから(クラスの行の一覧, プロパティの行の一覧)を作る
+    クラスはentities、プロパティはtriplesを一緒に保存する
+    """
+    classes = []
+    content_classes = content.get('classes')
+    if isinstance(content_classes, dict):
+        for uri, detail in content_classes.items():
+            entities = detail.get('entities') if isinstance(detail, dict) else None
+            classes.append({'uri_hash': uri_hash(uri), 'uri': uri, 'entities': _count(entities)})
+
+    properties = {}
+    content_properties = content.get('properties')
+    if isinstance(content_properties, list):
+        for prop in content_properties:
+            if not isinstance(prop, dict) or not isinstance(prop.get('uri'), str):
+                continue
+            # 同じURIが複数ある場合は最初のものを使う
+            properties.setdefault(prop['uri'], {
+                'uri_hash': uri_hash(prop['uri']), 'uri': prop['uri'], 'triples': _count(prop.get('triples'))
+            })
+    return classes, list(properties.values())
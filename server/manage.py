@@ -1,8 +1,272 @@
 #! /usr/bin/env python
+import asyncio
+from collections import Counter
+
+from aiohttp import web
 from flask_script import Manager
-from dbcls import app, db
+from sqlalchemy import bindparam, true
+from sqlalchemy.orm import undefer
+from dbcls import app, db, content_storage, payload_cache, binary_redis_client
+from dbcls.cache import public_data_sets_cache
+from dbcls.content import parse_crawl_date
+from dbcls.facets import facet_values, endpoint_host
+from dbcls.models import DataSet, replace_uri_usages, store_sections, public_facet_table
+from dbcls.proxy_benchmark import run_benchmark
+from dbcls.proxy_cache import ProxyResultCache
+from dbcls.search import build_search_text
+from dbcls.sparql_proxy import create_proxy_app
+from dbcls.uri_index import extract_uri_usages
+from dbcls.tasks import run_generate_worker_pool
 
 manager = Manager(app)
 
+
+@manager.command
+def migrate_contents(batch_size=100):
+    """ DBに保存されているcontentをcontent_storageに移す """
+    batch_size = int(batch_size)
+    migrated = 0
+    while True:
+        data_sets = (
+            DataSet.query
+            .filter(DataSet.content_hash.is_(None))
+            .options(undefer(DataSet.legacy_content))
+            .order_by(DataSet.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not data_sets:
+            break
+        for data_set in data_sets:
+            data_set.content = data_set.legacy_content
+        db.session.commit()
+        migrated += len(data_sets)
+        print(f'{migrated} data sets migrated')
+
+
+@manager.command
+def restore_contents(batch_size=100):
+    """ content_storageのcontentをDBに戻す(alembic downgrade用) """
+    batch_size = int(batch_size)
+    restored = 0
+    while True:
+        data_sets = (
+            DataSet.query
+            .filter(DataSet.content_hash.isnot(None))
+            .order_by(DataSet.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not data_sets:
+            break
+        for data_set in data_sets:
+            data_set.legacy_content = data_set.content
+            data_set.content_hash = None
+        db.session.commit()
+        restored += len(data_sets)
+        print(f'{restored} data sets restored')
+
+
+@manager.command
+def build_search_texts(batch_size=100):
+    """ 全文検索用の文字列をcontentから作り直す """
+    batch_size = int(batch_size)
+    built = 0
+    last_id = 0
+    while True:
+        data_sets = (
+            DataSet.query
+            .filter(DataSet.id > last_id)
+            .order_by(DataSet.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not data_sets:
+            break
+        for data_set in data_sets:
+            data_set.search_text = build_search_text(data_set.content)
+        db.session.commit()
+        built += len(data_sets)
+        last_id = data_sets[-1].id
+        print(f'{built} data sets indexed')
+
+
+@manager.command
+def build_uri_index(batch_size=100):
+    """ クラスとプロパティのURIのインデックスをcontentから作り直す """
+    batch_size = int(batch_size)
+    built = 0
+    last_id = 0
+    while True:
+        data_sets = (
+            DataSet.query
+            .filter(DataSet.id > last_id)
+            .order_by(DataSet.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not data_sets:
+            break
+        for data_set in data_sets:
+            replace_uri_usages(db.session, data_set.id, extract_uri_usages(data_set.content))
+        db.session.commit()
+        built += len(data_sets)
+        last_id = data_sets[-1].id
+        print(f'{built} data sets indexed')
+
+
+@manager.command
+def build_meta_data_columns(batch_size=1000):
+    """ meta_dataのcrawl_dateとendpointから絞り込みとソート用のカラムを設定する """
+    batch_size = int(batch_size)
+    built = 0
+    last_id = 0
+    while True:
+        rows = (
+            db.session.query(DataSet.id, DataSet.meta_data)
+            .filter(DataSet.id > last_id)
+            .order_by(DataSet.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not rows:
+            break
+        db.session.execute(
+            DataSet.__table__.update().where(DataSet.id == bindparam('data_set_id')),
+            [
+                {
+                    'data_set_id': row.id,
+                    'crawled_at': parse_crawl_date((row.meta_data or {}).get('crawl_date')),
+                    'endpoint_host': endpoint_host((row.meta_data or {}).get('endpoint')),
+                }
+                for row in rows
+            ]
+        )
+        db.session.commit()
+        built += len(rows)
+        last_id = rows[-1].id
+        print(f'{built} data sets updated')
+    public_data_sets_cache.invalidate()
+
+
+@manager.command
+def build_facet_counts(batch_size=1000):
+    """ 公開DataSetの一覧のファセットごとの数を数え直す
+    数えている間に公開状態が変わると数がずれるので、更新が少ないときに実行する
+    """
+    batch_size = int(batch_size)
+    counts = Counter()
+    last_id = 0
+    while True:
+        rows = (
+            db.session.query(DataSet.id, DataSet.meta_data)
+            .filter(DataSet.id > last_id, DataSet.is_public == true())
+            .order_by(DataSet.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not rows:
+            break
+        for row in rows:
+            counts.update(facet_values(row.meta_data))
+        last_id = rows[-1].id
+
+    db.session.execute(public_facet_table.delete())
+    if counts:
+        db.session.execute(public_facet_table.insert(), [
+            {'facet': facet, 'value': value, 'count': count} for (facet, value), count in counts.items()
+        ])
+    db.session.commit()
+    public_data_sets_cache.invalidate()
+    print(f'{len(counts)} facet values counted')
+
+
+@manager.command
+def build_content_sections(batch_size=100):
+    """ contentをセクションごとに分けて保存する(可視化APIのfields, languages用) """
+    batch_size = int(batch_size)
+    built = 0
+    while True:
+        data_sets = (
+            DataSet.query
+            .filter(DataSet.content_hash.isnot(None), DataSet.content_sections.is_(None))
+            .order_by(DataSet.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not data_sets:
+            break
+        for data_set in data_sets:
+            # 全体を保存したcontentはpurge_contentsで削除される
+            data_set.content_sections, data_set.content_stored_size = store_sections(data_set.content)
+        db.session.commit()
+        built += len(data_sets)
+        print(f'{built} data sets split')
+
+
+@manager.command
+def purge_contents(older_than=60 * 60 * 24, batch_size=1000):
+    """ どのDataSetからも参照されていないcontentを削除する """
+    batch_size = int(batch_size)
+    referenced = set()
+    last_id = 0
+    while True:
+        rows = (
+            DataSet.query
+            .with_entities(DataSet.id, DataSet.content_hash, DataSet.content_sections)
+            .filter(DataSet.id > last_id)
+            .order_by(DataSet.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not rows:
+            break
+        for _, content_hash, content_sections in rows:
+            if content_sections:
+                referenced.update(content_sections['fields'].values())
+                referenced.update(content_sections['labels'].values())
+            else:
+                # セクションごとに保存する前のデータは全体を参照している
+                referenced.add(content_hash)
+        last_id = rows[-1].id
+
+    # 保存直後(既にある内容を保存し直した場合を含む)でまだcommitされていないものは残す
+    purged = 0
+    for content_hash in content_storage.content_hashes(older_than=int(older_than)):
+        if content_hash not in referenced:
+            content_storage.delete(content_hash)
+            purged += 1
+    print(f'{purged} contents purged')
+
+
+@manager.command
+def purge_payloads(older_than=60 * 60 * 24 * 7):
+    """ 圧縮済みの可視化用レスポンスを削除する(次のアクセスで作り直される) """
+    purged = payload_cache.purge(older_than=int(older_than))
+    print(f'{purged} payloads purged')
+
+
+@manager.command
+def generate_worker(processes=None):
+    """ DataSet生成のワーカーを起動する """
+    processes = int(processes or app.config['GENERATOR_WORKER_PROCESSES'])
+    run_generate_worker_pool(processes)
+
+
+@manager.command
+def proxy_server(host='0.0.0.0', port=5001):
+    """ /api/v1/proxyを受け持つSPARQLプロキシを起動する """
+    cache = ProxyResultCache(binary_redis_client, **app.config['SPARQL_PROXY_CACHE'])
+    web.run_app(create_proxy_app(app.config['SPARQL_PROXY'], cache), host=host, port=int(port))
+
+
+@manager.command
+def benchmark_proxy(requests=200, concurrency=50, delay=0.1):
+    """ 遅いSPARQLエンドポイントの代わりを立ててSPARQLプロキシの性能を測る """
+    result = asyncio.run(run_benchmark(app.config['SPARQL_PROXY'], int(requests), int(concurrency), float(delay)))
+    for key, value in result.items():
+        print(f'{key}: {value}')
+
+
 if __name__ == '__main__':
     manager.run()
@@ -2,9 +2,11 @@ from datetime import datetime, timedelta
 import json
 from random import randint
 from pathlib import Path
+import shutil
 import tempfile
 
 import pytest
+from sqlalchemy import event
 
 from dbcls import app, db, redis_client
 from dbcls.models import User, DataSet, Tag, UserRole, UserRoleTypes
@@ -28,6 +30,11 @@ def client(mocker):
     db.session.commit()
 
     redis_client.flushdb()
+    shutil.rmtree(app.config['CONTENT_STORAGE']['root'], ignore_errors=True)
+    shutil.rmtree(app.config['PAYLOAD_CACHE_PATH'], ignore_errors=True)
+    shutil.rmtree(app.config['INDEX_ASSET_CACHE']['root'], ignore_errors=True)
+    shutil.rmtree(app.config['CONVERTED_ONTOLOGY_CACHE']['root'], ignore_errors=True)
+    shutil.rmtree(app.config['GENERATOR_WORKSPACE'], ignore_errors=True)
 
 
 @pytest.fixture
@@ -149,6 +156,18 @@ def public_data_sets(users):
     db.session.commit()
 
 
+@pytest.fixture
+def executed_statements():
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    yield statements
+    event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+
 def ttl_path(filename):
     origin = Path(Path(__file__).parent, filename)
     _, temp_ttl = tempfile.mkstemp(suffix=origin.suffix)
@@ -184,18 +203,15 @@ def task_properties_list(users, data_sets):
     redis_client.set('task_id_taro_success', json.dumps({
         'state': UmakaparserState.SUCCESS.value,
         'user': users[1].id,
-        'pid': 99999999,
         'data_set_id': data_sets[2].id
     }))
     redis_client.set('task_id_started', json.dumps({
         'state': UmakaparserState.STARTED.value,
         'user': users[0].id,
-        'pid': 99999999,
     }))
     redis_client.set('task_id_success', json.dumps({
         'state': UmakaparserState.SUCCESS.value,
         'user': users[0].id,
-        'pid': 99999999,
         'data_set_id': data_sets[-1].id
     }))
 
@@ -1,4 +1,9 @@
+from datetime import datetime
+
+from dbcls import db
 from dbcls.models import DataSet
+from dbcls.task_queue import delete_task_queue
+from dbcls.tasks import delete_by_criteria, run_delete_task
 from .fixtures import (
     client, users, data_sets, authorized_john, user_roles, REQUEST_HEADERS,
     authorized_taro
@@ -16,6 +21,17 @@ class TestAdminDataSetList:
             # 自分のDataSet以外も見えている
             assert response_data['count'] > DataSet.query.filter_by(user=authorized_john).count()
 
+    def test_get_cursor(self, client, users, user_roles, data_sets, authorized_john):
+        with client:
+            res = client.get('/api/v1/admin/data_sets?cursor=', headers=REQUEST_HEADERS)
+            assert res.status_code == 200
+            response_data = res.get_json()
+            assert response_data['previous'] is None
+            assert response_data['next'] is None
+            assert [d['id'] for d in response_data['data']] == [
+                d.id for d in DataSet.query.order_by(DataSet.upload_at.desc(), DataSet.id.desc())
+            ]
+
 
 class TestHasNoAdminRole:
     def test_get_data_sets(self, client, users, user_roles, data_sets, authorized_taro):
@@ -42,3 +58,78 @@ class TestDataSetDetail:
             res = client.delete('/api/v1/admin/data_sets/0', headers=REQUEST_HEADERS)
             assert res.status_code == 404
             assert res.get_json() == {'message': 'not found'}
+
+
+class TestDataSetBulkDelete:
+    def test_delete(self, client, users, user_roles, data_sets, authorized_john):
+        taro = users[1]
+        with client:
+            previous_count = DataSet.query.count()
+            res = client.post(
+                '/api/v1/admin/data_sets/bulk_delete', json={'user_id': taro.id}, headers=REQUEST_HEADERS
+            )
+            assert res.status_code == 202
+            task_id = res.get_json()['task_id']
+
+            res = client.get(f'/api/v1/admin/data_sets/bulk_delete/{task_id}', headers=REQUEST_HEADERS)
+            assert res.get_json() == {'state': 'PENDING', 'deleted': 0}
+
+            # ワーカーで削除する
+            run_delete_task(delete_task_queue.dequeue())
+            res = client.get(f'/api/v1/admin/data_sets/bulk_delete/{task_id}', headers=REQUEST_HEADERS)
+            assert res.get_json() == {'state': 'SUCCESS', 'deleted': 2}
+            assert DataSet.query.count() == previous_count - 2
+            assert DataSet.query.filter_by(user=taro).count() == 0
+
+    def test_delete_ids(self, client, users, user_roles, data_sets, authorized_john):
+        with client:
+            ids = [d.id for d in data_sets[:3]]
+            res = client.post('/api/v1/admin/data_sets/bulk_delete', json={'ids': ids}, headers=REQUEST_HEADERS)
+            assert res.status_code == 202
+            delete_by_criteria(res.get_json()['task_id'], {'ids': ids}, chunk_size=2)
+            assert DataSet.query.filter(DataSet.id.in_(ids)).count() == 0
+            assert DataSet.query.count() == len(data_sets) - 3
+
+    def test_delete_uploaded_range(self, client, users, user_roles, data_sets, authorized_john):
+        """ タイムゾーン付きの日時はUTCに変換して比較する """
+        data_sets[0].upload_at = datetime(2026, 1, 1, 0, 0)
+        data_sets[1].upload_at = datetime(2026, 1, 1, 10, 0)
+        db.session.commit()
+        ids = [data_sets[0].id, data_sets[1].id]
+        with client:
+            # 2026-01-01 09:00 UTCより前
+            criteria = {'uploaded_before': '2026-01-01T18:00:00+09:00'}
+            res = client.post('/api/v1/admin/data_sets/bulk_delete', json=criteria, headers=REQUEST_HEADERS)
+            assert res.status_code == 202
+            run_delete_task(delete_task_queue.dequeue())
+            assert [d.id for d in DataSet.query.filter(DataSet.id.in_(ids))] == [data_sets[1].id]
+
+            # 2026-01-01 10:00 UTC以降、12:00 UTCより前
+            criteria = {'uploaded_after': '2026-01-01T19:00:00+09:00', 'uploaded_before': '2026-01-01T12:00:00'}
+            res = client.post('/api/v1/admin/data_sets/bulk_delete', json=criteria, headers=REQUEST_HEADERS)
+            assert res.status_code == 202
+            run_delete_task(delete_task_queue.dequeue())
+            assert DataSet.query.filter(DataSet.id.in_(ids)).count() == 0
+            assert DataSet.query.count() == len(data_sets) - 2
+
+    def test_no_criteria(self, client, users, user_roles, data_sets, authorized_john):
+        with client:
+            res = client.post('/api/v1/admin/data_sets/bulk_delete', json={}, headers=REQUEST_HEADERS)
+            assert res.status_code == 400
+            assert res.get_json() == {'message': 'ids or filter is required'}
+
+
+class TestCacheStats:
+    def test_get(self, client, users, user_roles, data_sets, authorized_john):
+        with client:
+            client.get('/api/v1/public_data_sets')
+            client.get('/api/v1/public_data_sets')
+            res = client.get('/api/v1/admin/cache_stats', headers=REQUEST_HEADERS)
+            assert res.status_code == 200
+            assert res.get_json() == {
+                'public_data_sets': {'version': 0, 'hits': 1, 'misses': 1},
+                'data_set_count': {'version': 0, 'hits': 0, 'misses': 1},
+                'uri_usages': {'version': 0, 'hits': 0, 'misses': 0},
+                'tag_suggestions': {'version': 0, 'hits': 0, 'misses': 0},
+                'facet_counts': {'version': 0, 'hits': 0, 'misses': 1},
+            }
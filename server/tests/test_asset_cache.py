@@ -0,0 +1,53 @@
+import os
+import time
+
+import pytest
+
+from dbcls.asset_cache import AssetCache
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return AssetCache((tmp_path / 'cache').as_posix(), max_size=100)
+
+
+def make_assets(path, size):
+    os.makedirs(path / 'ja', exist_ok=True)
+    (path / 'ja' / 'labels.json').write_bytes(b'x' * size)
+    return path
+
+
+class TestAssetCache:
+    def test_store_and_checkout(self, cache, tmp_path):
+        key = cache.key('ontology-hash', '1.0.0')
+        dest = tmp_path / 'dest'
+        assert not cache.checkout(key, dest.as_posix())
+
+        cache.store(key, make_assets(tmp_path / 'assets', 10).as_posix())
+        assert cache.checkout(key, dest.as_posix())
+        assert (dest / 'ja' / 'labels.json').read_bytes() == b'x' * 10
+
+    def test_checkout_removed_while_copying(self, cache, tmp_path, mocker):
+        key = cache.key('ontology-hash', '1.0.0')
+        cache.store(key, make_assets(tmp_path / 'assets', 10).as_posix())
+        dest = tmp_path / 'dest'
+        dest.mkdir()
+        # 複製中に削除された場合は途中までのファイルを残さない
+        mocker.patch('dbcls.asset_cache.os.utime').side_effect = FileNotFoundError()
+        assert not cache.checkout(key, dest.as_posix())
+        assert dest.is_dir()
+        assert os.listdir(dest) == []
+
+    def test_key_depends_on_version(self, cache):
+        assert cache.key('ontology-hash', '1.0.0') != cache.key('ontology-hash', '1.0.1')
+
+    def test_evict_least_recently_used(self, cache, tmp_path):
+        now = time.time()
+        for i in range(2):
+            cache.store(str(i), make_assets(tmp_path / f'assets{i}', 40).as_posix())
+            os.utime(cache.root / str(i), (now - 100 + i, now - 100 + i))
+        # 古い方を使ったので新しい方が削除される
+        assert cache.checkout('0', (tmp_path / 'dest').as_posix())
+        cache.store('2', make_assets(tmp_path / 'assets2', 40).as_posix())
+
+        assert sorted(os.listdir(cache.root)) == ['0', '2']
@@ -1,7 +1,9 @@
 import json
+import time
 
 from firebase_admin.auth import AuthError
 
+from dbcls.auth import use_shared_certificate_cache
 from dbcls.models import User
 from .fixtures import client, users
 
@@ -44,3 +46,35 @@ class TestAuthenticate:
             res = client.post('/api/v1/auth', data=data, content_type='application/json')
             assert res.status_code == 400
             assert res.get_json() == {'message': 'user not found. You have to sign up.'}
+
+    def test_id_token_cached(self, client, users, mocker):
+        decoded_token_mock = {'uid': 'dummy_firebase_uid1', 'exp': time.time() + 3600}
+        verify_id_token_mock = mocker.patch('firebase_admin.auth.verify_id_token')
+        verify_id_token_mock.return_value = decoded_token_mock
+        custom_token_mock = mocker.Mock()
+        custom_token_mock.decode.return_value = 'dummy_custom_token'
+        create_custom_token_mock = mocker.patch('firebase_admin.auth.create_custom_token')
+        create_custom_token_mock.return_value = custom_token_mock
+
+        with client:
+            data = json.dumps({'token': 'dummy_id_token'})
+            for _ in range(2):
+                res = client.post('/api/v1/auth', data=data, content_type='application/json')
+                assert res.status_code == 200
+                assert res.get_json()['custom_token'] == 'dummy_custom_token'
+            assert verify_id_token_mock.call_count == 1
+            assert create_custom_token_mock.call_count == 1
+
+    def test_certificate_cache(self, mocker):
+        token_verifier = mocker.Mock()
+        mocker.patch('firebase_admin.auth._get_auth_service').return_value.token_verifier = token_verifier
+        assert use_shared_certificate_cache()
+        assert token_verifier.request.session is not None
+
+    def test_certificate_cache_without_private_api(self, mocker):
+        # firebase_adminの非公開の属性が無くなっていても起動はできる
+        mocker.patch('firebase_admin.auth._get_auth_service', None)
+        assert not use_shared_certificate_cache()
+
+        mocker.patch('firebase_admin.auth._get_auth_service').return_value = object()
+        assert not use_shared_certificate_cache()
@@ -0,0 +1,50 @@
+import json
+import tempfile
+
+import pytest
+
+from dbcls.content import InvalidContentError, content_digest, load_content
+
+
+META_DATA = {
+    'properties': 11,
+    'triples': 22,
+    'classes': 33,
+    'endpoint': 'https://~',
+    'crawl_date': '2019/08/20 15:44:00'
+}
+
+
+class TestLoadContent:
+    @pytest.mark.parametrize('max_size', [0, 1024 ** 2])
+    def test_spooled_file(self, max_size):
+        """ werkzeugはアップロードされたファイルをSpooledTemporaryFileで渡す """
+        content = {'meta_data': META_DATA, 'labels': {'http://example.com/Protein': {'ja': 'タンパク質'}}}
+        raw = json.dumps(content, ensure_ascii=False).encode('utf-16')
+        with tempfile.SpooledTemporaryFile(max_size=max_size) as f:
+            f.write(raw)
+            f.seek(0)
+            digest, loaded = load_content(f, chunk_size=16)
+        assert digest == content_digest(raw)
+        assert loaded == content
+
+    def test_invalid(self):
+        with tempfile.SpooledTemporaryFile() as f:
+            f.write(b'hoge')
+            f.seek(0)
+            with pytest.raises(InvalidContentError):
+                load_content(f)
+
+    def test_too_large(self, mocker):
+        """ 大きすぎるファイルはパースする前に断る """
+        parse_content = mocker.patch('dbcls.content.parse_content')
+        raw = json.dumps({'meta_data': META_DATA, 'labels': {}}).encode()
+        with tempfile.SpooledTemporaryFile() as f:
+            f.write(raw)
+            f.seek(0)
+            with pytest.raises(InvalidContentError) as e:
+                load_content(f, max_size=len(raw) - 1, chunk_size=16)
+            assert e.value.message == 'file is too large'
+            f.seek(0)
+            assert load_content(f, max_size=len(raw))[1] is parse_content.return_value
+        parse_content.assert_called_once()
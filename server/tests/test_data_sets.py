@@ -1,16 +1,26 @@
+import base64
+from datetime import datetime
+import gzip
+import hashlib
 import json
 from io import BytesIO
 from pathlib import Path
+import tarfile
+import zipfile
 
 from firebase_admin.auth import AuthError
 
-from dbcls import redis_client
+from dbcls import app, db, redis_client, content_storage
+from dbcls.cache import public_data_sets_cache
 from dbcls.utils import localize_as_jst
-from dbcls.models import User, DataSet, Tag
-from dbcls.tasks import UmakaparserState
+from dbcls.models import User, DataSet, Tag, public_facet_table
+from dbcls.task_queue import generate_task_queue
+from dbcls.tasks import (
+    UmakaparserState, GenerateStage, TaskState, heartbeat_key, record_progress, run_bulk_upload_task
+)
 from .fixtures import (
     client, users, data_sets, authorized_john, taros_data_set, public_data_sets,
-    ontology_path, sbm_path, task_properties_list
+    ontology_path, sbm_path, task_properties_list, executed_statements
 )
 
 
@@ -38,6 +48,23 @@ class TestDataSetList:
                 d['upload_at'] = localize_as_jst(d['upload_at']).isoformat()
             assert res.get_json() == expected_data
 
+    def test_get_cursor(self, client, users, data_sets, authorized_john):
+        with client:
+            res = client.get('/api/v1/data_sets?size=2&cursor=', headers=HEADERS)
+            assert res.status_code == 200
+            response_data = res.get_json()
+            assert response_data['previous'] is None
+            ids = [d['id'] for d in response_data['data']]
+
+            res = client.get(response_data['next'], headers=HEADERS)
+            assert res.status_code == 200
+            response_data = res.get_json()
+            assert response_data['next'] is None
+            ids += [d['id'] for d in response_data['data']]
+            assert ids == [
+                d.id for d in DataSet.query.filter_by(user=authorized_john).order_by(DataSet.id.asc())
+            ]
+
     def test_post(self, client, users, data_sets, authorized_john):
         with client:
             johns_data_sets = DataSet.query.filter_by(user=authorized_john)
@@ -63,6 +90,36 @@ class TestDataSetList:
             assert response_data['title'] == 'test'
             assert response_data['is_public'] is False
             assert johns_data_sets.count() == before_count + 1
+            # ハッシュはアップロードされたままのバイト列から計算する
+            data_set = DataSet.query.get(response_data['id'])
+            assert data_set.content_hash == hashlib.sha256(json_file).hexdigest()
+            assert data_set.content_size == len(json_file)
+
+    def test_post_utf16(self, client, users, data_sets, authorized_john):
+        with client:
+            content = {
+                'meta_data': {
+                    'properties': 11,
+                    'triples': 22,
+                    'classes': 33,
+                    'endpoint': 'https://~',
+                    'crawl_date': '2019/08/20 15:44:00'
+                },
+                'labels': {'http://example.com/Protein': {'ja': 'タンパク質'}},
+            }
+            data = {'file': (BytesIO(json.dumps(content, ensure_ascii=False).encode('utf-16')), 'test.json')}
+            res = client.post('/api/v1/data_sets', data=data, headers=HEADERS, content_type='multipart/form-data')
+            assert res.status_code == 201
+            assert DataSet.query.get(res.get_json()['id']).content == content
+
+    def test_post_too_large(self, client, users, data_sets, authorized_john, mocker):
+        with client:
+            mocker.patch.dict(app.config, {'DATA_SET_MAX_SIZE': 100})
+            before_count = DataSet.query.count()
+            data = {'file': (BytesIO(json.dumps({'meta_data': {}, 'labels': 'a' * 100}).encode()), 'test.json')}
+            res = client.post('/api/v1/data_sets', data=data, headers=HEADERS, content_type='multipart/form-data')
+            assert res.status_code == 413
+            assert DataSet.query.count() == before_count
 
     def test_post_not_ok(self, client, users, data_sets, authorized_john):
         with client:
@@ -94,6 +151,17 @@ class TestDataSetList:
             assert res.status_code == 400
             assert res.get_json() == {'message': 'meta_data does not exist'}
 
+            # JSONがオブジェクトではない
+            data = {'file': (BytesIO(b'[1, 2, 3]'), 'test.json')}
+            res = client.post(
+                '/api/v1/data_sets',
+                data=data,
+                headers=HEADERS,
+                content_type='multipart/form-data'
+            )
+            assert res.status_code == 400
+            assert res.get_json() == {'message': 'meta_data does not exist'}
+
             # meta_dataが不正
             json_file = json.dumps({
                 'meta_data': {
@@ -114,6 +182,122 @@ class TestDataSetList:
             assert res.status_code == 400
             assert res.get_json() == {'message': 'classes is invalid type'}
 
+    def test_bulk_post(self, client, users, data_sets, authorized_john):
+        meta_data = {
+            'properties': 11,
+            'triples': 22,
+            'classes': 33,
+            'endpoint': 'https://~',
+            'crawl_date': '2019/08/20 15:44:00'
+        }
+        archive = BytesIO()
+        with zipfile.ZipFile(archive, 'w') as f:
+            for i in range(3):
+                f.writestr(f'crawl/test{i}.json', json.dumps({'meta_data': meta_data}))
+            f.writestr('crawl/invalid.json', json.dumps({'meta_data': {**meta_data, 'classes': '33'}}))
+            f.writestr('crawl/README.txt', 'JSONではないファイルは無視する')
+        archive.seek(0)
+
+        with client:
+            johns_data_sets = DataSet.query.filter_by(user=authorized_john)
+            before_count = johns_data_sets.count()
+            res = client.post(
+                '/api/v1/data_sets/bulk',
+                data={'file': (archive, 'crawl.zip')},
+                headers=HEADERS,
+                content_type='multipart/form-data'
+            )
+            assert res.status_code == 202
+            task_id = res.get_json()['task_id']
+            archive_path = json.loads(redis_client.get(task_id))['archive_path']
+            assert Path(archive_path).exists()
+
+            res = client.get(f'/api/v1/data_sets/bulk/{task_id}', headers=HEADERS)
+            assert res.status_code == 200
+            assert res.get_json() == {'state': 'PENDING', 'created': 0, 'failed': 0, 'files': [], 'position': 0}
+
+            # ワーカーで処理する
+            run_bulk_upload_task(task_id)
+            assert not Path(archive_path).exists()
+            res = client.get(f'/api/v1/data_sets/bulk/{task_id}', headers=HEADERS)
+            assert res.status_code == 200
+            response_data = res.get_json()
+            assert response_data['state'] == 'SUCCESS'
+            assert response_data['created'] == 3
+            assert response_data['failed'] == 1
+            assert [(r['name'], r['status']) for r in response_data['files']] == [
+                ('crawl/test0.json', 'created'),
+                ('crawl/test1.json', 'created'),
+                ('crawl/test2.json', 'created'),
+                ('crawl/invalid.json', 'error'),
+            ]
+            assert response_data['files'][3]['message'] == 'classes is invalid type'
+            assert johns_data_sets.count() == before_count + 3
+            data_set = DataSet.query.get(response_data['files'][0]['id'])
+            assert data_set.title == 'test0'
+            assert data_set.content == {'meta_data': meta_data}
+
+            # 他のユーザーのタスク
+            redis_client.set(task_id, json.dumps({**json.loads(redis_client.get(task_id)), 'user': -1}))
+            res = client.get(f'/api/v1/data_sets/bulk/{task_id}', headers=HEADERS)
+            assert res.status_code == 404
+
+            # アーカイブではない
+            res = client.post(
+                '/api/v1/data_sets/bulk',
+                data={'file': (BytesIO(b'hoge'), 'crawl.zip')},
+                headers=HEADERS,
+                content_type='multipart/form-data'
+            )
+            assert res.status_code == 400
+            assert res.get_json() == {'message': 'file must be a zip or tar archive'}
+
+    def test_bulk_post_resume(self, client, users, data_sets, authorized_john):
+        """ ワーカーが途中で終了したタスクは記録済みのファイルを読み飛ばす """
+        meta_data = {
+            'properties': 11,
+            'triples': 22,
+            'classes': 33,
+            'endpoint': 'https://~',
+            'crawl_date': '2019/08/20 15:44:00'
+        }
+        archive = BytesIO()
+        with tarfile.open(fileobj=archive, mode='w:gz') as f:
+            for i in range(3):
+                raw = json.dumps({'meta_data': {**meta_data, 'triples': i}}).encode()
+                info = tarfile.TarInfo(f'test{i}.json')
+                info.size = len(raw)
+                f.addfile(info, BytesIO(raw))
+        archive.seek(0)
+
+        with client:
+            res = client.post(
+                '/api/v1/data_sets/bulk',
+                data={'file': (archive, 'crawl.tar.gz')},
+                headers=HEADERS,
+                content_type='multipart/form-data'
+            )
+            assert res.status_code == 202
+            task_id = res.get_json()['task_id']
+            done = [{'name': 'test0.json', 'status': 'created'}, {'name': 'test1.json', 'status': 'error'}]
+            redis_client.set(task_id, json.dumps({
+                **json.loads(redis_client.get(task_id)),
+                'state': TaskState.STARTED.value,
+                'files': done,
+            }))
+
+            before_count = DataSet.query.filter_by(user=authorized_john).count()
+            run_bulk_upload_task(task_id)
+            assert DataSet.query.filter_by(user=authorized_john).count() == before_count + 1
+            res = client.get(f'/api/v1/data_sets/bulk/{task_id}', headers=HEADERS)
+            response_data = res.get_json()
+            assert response_data['state'] == 'SUCCESS'
+            assert response_data['created'] == 2
+            assert response_data['failed'] == 1
+            assert [r['name'] for r in response_data['files']] == ['test0.json', 'test1.json', 'test2.json']
+            data_set = DataSet.query.get(response_data['files'][2]['id'])
+            assert data_set.content == {'meta_data': {**meta_data, 'triples': 2}}
+
 
 class TestDataSetDetail:
     def test_get(self, client, users, data_sets, authorized_john):
@@ -183,6 +367,23 @@ class TestDataSetDetail:
             assert tag_query.count() == 2
             for tag in tag_query.all():
                 assert data_set.id in [d.id for d in tag.data_sets]
+                assert tag.public_count == (1 if data_set.is_public else 0)
+            assert data_set.search_tags == 'おにぎり ラーメン'
+
+            # 変わったタグだけ付け替える
+            data = {
+                'comma_separated_tag_name': 'ラーメン,うどん'
+            }
+            res = client.patch(f'/api/v1/data_sets/{data_set.id}', data=data, headers=HEADERS)
+            assert res.status_code == 200
+            assert sorted(t['name'] for t in res.get_json()['tags']) == ['うどん', 'ラーメン']
+            assert Tag.query.filter_by(name='おにぎり').first().public_count == 0
+
+            data = {
+                'comma_separated_tag_name': 'a' * 21
+            }
+            res = client.patch(f'/api/v1/data_sets/{data_set.id}', data=data, headers=HEADERS)
+            assert res.status_code == 400
 
     def test_cannot_update(self, client, users, data_sets, authorized_john, taros_data_set):
         with client:
@@ -206,6 +407,87 @@ class TestVisualize:
                 'content': data_set.content,
             }
 
+    def test_gzip(self, client, users, data_sets):
+        with client:
+            data_set = DataSet.query.first()
+            res = client.get(
+                f'/api/v1/visualize/{data_set.path}',
+                headers={'Accept-Encoding': 'gzip'}
+            )
+            assert res.status_code == 200
+            assert res.headers['Content-Encoding'] == 'gzip'
+            assert json.loads(gzip.decompress(res.get_data())) == {
+                'id': data_set.id,
+                'title': data_set.title,
+                'content': data_set.content,
+            }
+
+    def test_not_modified(self, client, users, data_sets):
+        with client:
+            data_set = DataSet.query.first()
+            res = client.get(f'/api/v1/visualize/{data_set.path}')
+            assert res.status_code == 200
+            etag = res.headers['ETag']
+
+            res = client.get(f'/api/v1/visualize/{data_set.path}', headers={'If-None-Match': etag})
+            assert res.status_code == 304
+            assert res.headers['ETag'] == etag
+
+            # タイトルを変えるとETagも変わる
+            data_set.title = '食物繊維'
+            db.session.commit()
+            res = client.get(f'/api/v1/visualize/{data_set.path}', headers={'If-None-Match': etag})
+            assert res.status_code == 200
+            assert res.headers['ETag'] != etag
+            assert res.get_json()['title'] == '食物繊維'
+
+    def test_projection(self, client, users, data_sets):
+        data_set = DataSet.query.first()
+        content = {
+            **data_set.content,
+            'classes': {'http://example.com/Protein': {'entities': 1}},
+            'prefixes': {'ex': 'http://example.com/'},
+            'labels': {
+                'http://example.com/Protein': {'ja': 'タンパク質', 'en': 'Protein'},
+                'http://example.com/Gene': {'en': 'Gene'},
+            },
+        }
+        data_set.content = content
+        db.session.commit()
+
+        with client:
+            res = client.get(f'/api/v1/visualize/{data_set.path}?fields=classes,prefixes')
+            assert res.status_code == 200
+            assert res.get_json()['content'] == {'classes': content['classes'], 'prefixes': content['prefixes']}
+            fields_etag = res.headers['ETag']
+
+            res = client.get(f'/api/v1/visualize/{data_set.path}?fields=labels&languages=ja')
+            assert res.status_code == 200
+            assert res.get_json()['content'] == {'labels': {'http://example.com/Protein': {'ja': 'タンパク質'}}}
+
+            # fieldsがなければすべてのセクション
+            res = client.get(f'/api/v1/visualize/{data_set.path}?languages=en,ja', headers={'Accept-Encoding': 'gzip'})
+            assert res.status_code == 200
+            assert json.loads(gzip.decompress(res.get_data()))['content'] == content
+
+            # 絞り込み方ごとにETagが変わる
+            res = client.get(f'/api/v1/visualize/{data_set.path}')
+            assert res.headers['ETag'] != fields_etag
+            res = client.get(
+                f'/api/v1/visualize/{data_set.path}?fields=classes,prefixes', headers={'If-None-Match': fields_etag}
+            )
+            assert res.status_code == 304
+
+    def test_sections_only(self, client, users, data_sets):
+        data_set = DataSet.query.first()
+        # 全体は保存せずにセクションをつなげて返す
+        assert not content_storage.exists(data_set.content_hash)
+        assert all(content_storage.exists(h) for h in data_set.content_sections['fields'].values())
+        with client:
+            res = client.get(f'/api/v1/visualize/{data_set.path}')
+            assert res.status_code == 200
+            assert res.get_json()['content'] == data_set.content
+
     def test_not_found(self, client, users, data_sets):
         with client:
             res = client.get('/api/v1/visualize/path_not_found')
@@ -271,6 +553,48 @@ class TestPublic:
                     assert previous_properties <= d['meta_data']['properties']
                 previous_properties = d['meta_data']['properties']
 
+    def test_sort_triples_and_crawl_date(self, client, users, public_data_sets):
+        with client:
+            for sort, descending in ((8, True), (9, False)):
+                res = client.get(f'/api/v1/public_data_sets?sort={sort}&size=30')
+                assert res.status_code == 200
+                triples = [d['meta_data']['triples'] for d in res.get_json()['data']]
+                assert triples == sorted(triples, reverse=descending)
+
+            # クロール日時が同じならidの順
+            res = client.get('/api/v1/public_data_sets?sort=10&size=30')
+            assert res.status_code == 200
+            ids = [d['id'] for d in res.get_json()['data']]
+            assert ids == sorted(ids, reverse=True)
+            assert DataSet.query.first().crawled_at == datetime(2015, 12, 31, 14, 18, 17)
+
+    def test_filters(self, client, users, public_data_sets):
+        data_sets = DataSet.query.all()
+        min_triples = sorted(d.meta_data['triples'] for d in data_sets)[10]
+        max_classes = sorted(d.meta_data['classes'] for d in data_sets)[20]
+        expected = [
+            d for d in data_sets
+            if d.meta_data['triples'] >= min_triples and d.meta_data['classes'] <= max_classes
+        ]
+        with client:
+            res = client.get(
+                f'/api/v1/public_data_sets?size=2&min_triples={min_triples}&max_classes={max_classes}'
+            )
+            assert res.status_code == 200
+            response_data = res.get_json()
+            assert response_data['count'] == len(expected)
+            assert response_data['next'] == (
+                f'/api/v1/public_data_sets?size=2&page=2&sort=1&min_triples={min_triples}&max_classes={max_classes}'
+            )
+            for d in response_data['data']:
+                assert d['meta_data']['triples'] >= min_triples
+                assert d['meta_data']['classes'] <= max_classes
+
+            res = client.get('/api/v1/public_data_sets?endpoint_host=NAVI.first.lifesciencedb.jp')
+            assert res.get_json()['count'] == 30
+            res = client.get('/api/v1/public_data_sets?endpoint_host=example.com')
+            assert res.get_json()['count'] == 0
+
     def test_size(self, client, users, public_data_sets):
         with client:
             res = client.get('/api/v1/public_data_sets?size=50')
@@ -305,11 +629,211 @@ class TestPublic:
             response_data = res.get_json()
             assert response_data['count'] == 1
 
+    def test_search_content(self, client, users, public_data_sets):
+        content = {
+            'meta_data': {
+                'properties': 1,
+                'triples': 1,
+                'classes': 1,
+                'endpoint': 'http://example.com/sparql',
+                'crawl_date': '2015/12/31 14:18:17'
+            },
+            'classes': {'http://example.com/Protein': {'entities': 1}},
+            'properties': [{'uri': 'http://example.com/hasSequence', 'triples': 1, 'class_relations': []}],
+            'labels': {'http://example.com/Protein': {'ja': 'タンパク質', 'en': 'Protein'}},
+        }
+        john = users[0]
+        db.session.add(DataSet(
+            path='content_path', content=content, upload_at=datetime.utcnow(), title='生物', user=john, is_public=True
+        ))
+        db.session.add(DataSet(
+            path='title_path', content={'meta_data': content['meta_data']}, upload_at=datetime.utcnow(),
+            title='Protein', user=john, is_public=True
+        ))
+        db.session.commit()
 
-class TestDataSetGenerator:
-    def test_post(self, client, users, data_sets, authorized_john, ontology_path, sbm_path, mocker):
-        mocker.patch('dbcls.api.resources.data_set.Process')
+        with client:
+            # クラスとプロパティのURI、ラベルの部分一致
+            for search in ('hasSequence', 'タンパク', 'example.com/Prot'):
+                res = client.get(f'/api/v1/public_data_sets?search={search}')
+                assert res.status_code == 200
+                assert [d['title'] for d in res.get_json()['data']] == ['生物']
+
+            # タイトルに含まれるものが先
+            res = client.get('/api/v1/public_data_sets?search=protein')
+            assert res.status_code == 200
+            response_data = res.get_json()
+            assert [d['title'] for d in response_data['data']] == ['Protein', '生物']
+
+            # ソートを指定した場合は絞り込みだけ
+            res = client.get('/api/v1/public_data_sets?search=protein&sort=6')
+            assert res.status_code == 200
+            assert [d['path'] for d in res.get_json()['data']] == ['content_path', 'title_path']
+
+    def test_facets(self, client, users, public_data_sets):
+        with client:
+            res = client.get('/api/v1/public_data_sets')
+            assert res.status_code == 200
+            assert res.get_json()['facets'] == {
+                'tags': [
+                    {'value': 'タグ2x', 'count': 14},
+                    {'value': 'タグ3x', 'count': 9},
+                    {'value': 'タイトル24', 'count': 1},
+                ],
+                'triples': [{'value': 1000000, 'count': 30}],
+                'endpoint_host': [{'value': 'navi.first.lifesciencedb.jp', 'count': 30}],
+            }
+
+            # 非公開にしたDataSetと削除したDataSetは数えない
+            data_set = DataSet.query.filter_by(title='タイトル24').first()
+            data_set.is_public = False
+            db.session.delete(DataSet.query.filter_by(title='タイトル1').first())
+            db.session.commit()
+            public_data_sets_cache.invalidate()
+            res = client.get('/api/v1/public_data_sets')
+            facets = res.get_json()['facets']
+            assert facets['tags'] == [{'value': 'タグ2x', 'count': 13}, {'value': 'タグ3x', 'count': 8}]
+            assert facets['triples'] == [{'value': 1000000, 'count': 28}]
+            assert facets['endpoint_host'] == [{'value': 'navi.first.lifesciencedb.jp', 'count': 28}]
+
+    def test_facets_recounted(self, client, users, public_data_sets):
+        with client:
+            # 数がずれていても変更があった値は数え直される
+            db.session.execute(public_facet_table.update().values(count=100))
+            data_set = DataSet.query.filter_by(title='タイトル24').first()
+            data_set.is_public = False
+            db.session.commit()
+            public_data_sets_cache.invalidate()
+            res = client.get('/api/v1/public_data_sets')
+            facets = res.get_json()['facets']
+            assert facets['triples'] == [{'value': 1000000, 'count': 29}]
+            assert facets['endpoint_host'] == [{'value': 'navi.first.lifesciencedb.jp', 'count': 29}]
+
+    def test_uri_usages(self, client, users):
+        meta_data = {
+            'properties': 1,
+            'triples': 1,
+            'classes': 1,
+            'endpoint': 'http://example.com/sparql',
+            'crawl_date': '2015/12/31 14:18:17'
+        }
+        uri = 'http://example.com/Protein'
+        john = users[0]
+        for i, (entities, is_public) in enumerate([(10, True), (30, True), (20, False), (None, True)]):
+            content = {
+                'meta_data': meta_data,
+                'classes': {uri: {} if entities is None else {'entities': entities}},
+                'properties': [{'uri': uri, 'triples': i, 'class_relations': []}],
+            }
+            db.session.add(DataSet(
+                path=f'uri_path{i}', content=content, upload_at=datetime.utcnow(), title=f'URI{i}', user=john,
+                is_public=is_public
+            ))
+        db.session.commit()
 
+        with client:
+            res = client.get(f'/api/v1/public_data_sets/uri_usages?uri={uri}')
+            assert res.status_code == 200
+            response_data = res.get_json()
+            assert response_data['uri'] == uri
+            # 非公開のものは含まない
+            assert [(d['title'], d['entities']) for d in response_data['classes']] == [
+                ('URI1', 30), ('URI0', 10), ('URI3', None)
+            ]
+            assert [(d['title'], d['triples']) for d in response_data['properties']] == [
+                ('URI3', 3), ('URI1', 1), ('URI0', 0)
+            ]
+
+            res = client.get('/api/v1/public_data_sets/uri_usages?uri=http://example.com/Unknown')
+            assert res.status_code == 200
+            assert res.get_json()['classes'] == []
+
+    def test_cursor(self, client, users, public_data_sets):
+        with client:
+            # カーソルでページを辿る
+            url = '/api/v1/public_data_sets?sort=5&cursor='
+            pages = []
+            while url:
+                res = client.get(url)
+                assert res.status_code == 200
+                response_data = res.get_json()
+                assert response_data['count'] == 30
+                pages.append(response_data)
+                url = response_data['next']
+            assert len(pages) == 8
+            assert pages[0]['previous'] is None
+            ids = [d['id'] for page in pages for d in page['data']]
+            expected_ids = [
+                d.id
+                for d in DataSet.query.filter_by(is_public=True).order_by(DataSet.upload_at.desc(), DataSet.id.desc())
+            ]
+            assert ids == expected_ids
+
+            # 前のページに戻る
+            res = client.get(pages[1]['previous'])
+            assert res.status_code == 200
+            assert res.get_json()['data'] == pages[0]['data']
+
+            res = client.get('/api/v1/public_data_sets?cursor=invalid')
+            assert res.status_code == 400
+
+            # 値が配列のカーソル
+            cursor = base64.urlsafe_b64encode(json.dumps(['n', [1], 1]).encode()).decode().rstrip('=')
+            res = client.get(f'/api/v1/public_data_sets?cursor={cursor}')
+            assert res.status_code == 400
+
+    def test_query_count(self, client, users, public_data_sets, executed_statements):
+        with client:
+            # 件数をキャッシュしておく
+            res = client.get('/api/v1/public_data_sets?size=1')
+            assert res.status_code == 200
+
+            # ページのサイズに関係なくクエリは1回
+            for size in (2, 30):
+                executed_statements.clear()
+                res = client.get(f'/api/v1/public_data_sets?size={size}')
+                assert res.status_code == 200
+                response_data = res.get_json()
+                assert len(response_data['data']) == size
+                assert len(executed_statements) == 1
+
+            tagged_data = [d for d in response_data['data'] if d['tags']]
+            assert len(tagged_data) == 19
+            for d in tagged_data:
+                data_set = DataSet.query.get(d['id'])
+                assert sorted(d['tags'], key=lambda t: t['id']) == [
+                    {'id': t.id, 'name': t.name} for t in sorted(data_set.tags, key=lambda t: t.id)
+                ]
+                assert d['user'] == {
+                    'display_name': data_set.user.display_name,
+                    'contact_uri': data_set.user.contact_uri,
+                }
+
+    def test_cache(self, client, users, public_data_sets, authorized_john):
+        with client:
+            res = client.get('/api/v1/public_data_sets?sort=5')
+            assert res.status_code == 200
+            first_data = res.get_json()['data'][0]
+            assert public_data_sets_cache.stats()['misses'] == 1
+
+            # 2回目はキャッシュから返す
+            res = client.get('/api/v1/public_data_sets?sort=5&page=1')
+            assert res.status_code == 200
+            assert res.get_json()['data'][0] == first_data
+            assert public_data_sets_cache.stats()['hits'] == 1
+
+            # 更新したらキャッシュは使わない
+            data = {'title': '食物繊維'}
+            res = client.patch(f'/api/v1/data_sets/{first_data["id"]}', data=data, headers=HEADERS)
+            assert res.status_code == 200
+            res = client.get('/api/v1/public_data_sets?sort=5')
+            assert res.status_code == 200
+            assert res.get_json()['data'][0]['title'] == '食物繊維'
+            assert public_data_sets_cache.stats()['misses'] == 2
+
+
+class TestDataSetGenerator:
+    def test_post(self, client, users, data_sets, authorized_john, ontology_path, sbm_path):
         with client:
             johns_data_set_query = DataSet.query.filter_by(user=authorized_john)
             previous_count = johns_data_set_query.count()
@@ -329,6 +853,82 @@ class TestDataSetGenerator:
             assert 'task_id' in data
             task_properties = json.loads(redis_client.get(data['task_id']))
             assert task_properties['state'] == UmakaparserState.PENDING.value
+            assert Path(task_properties['sbm_path']).read_bytes() == Path(sbm_path).read_bytes()
+            assert Path(task_properties['ontology_path']).read_bytes() == Path(ontology_path).read_bytes()
+            assert task_properties['sbm_hash'] == hashlib.sha256(Path(sbm_path).read_bytes()).hexdigest()
+            assert task_properties['ontology_hash'] == hashlib.sha256(Path(ontology_path).read_bytes()).hexdigest()
+            # ワーカーが取り出すキューに登録されている
+            assert generate_task_queue.dequeue() == data['task_id']
+
+    def test_post_compressed(self, client, users, data_sets, authorized_john, ontology_path, sbm_path):
+        with client:
+            data = {
+                'ontology': (BytesIO(gzip.compress(Path(ontology_path).read_bytes())), 'ontology.ttl.gz'),
+                'sbm': (BytesIO(gzip.compress(Path(sbm_path).read_bytes())), 'sbm.ttl.gz'),
+            }
+            res = client.post(
+                '/api/v1/data_sets/generate',
+                data=data,
+                headers=HEADERS,
+                content_type='multipart/form-data'
+            )
+            assert res.status_code == 201
+            task_properties = json.loads(redis_client.get(res.get_json()['task_id']))
+            # 展開して保存される
+            assert task_properties['sbm_path'].endswith('.ttl')
+            assert Path(task_properties['sbm_path']).read_bytes() == Path(sbm_path).read_bytes()
+            assert Path(task_properties['ontology_path']).read_bytes() == Path(ontology_path).read_bytes()
+            assert task_properties['sbm_hash'] == hashlib.sha256(Path(sbm_path).read_bytes()).hexdigest()
+
+    def test_post_broken_compressed_file(self, client, users, data_sets, authorized_john):
+        with client:
+            data = {
+                'sbm': (BytesIO(b'not gzip'), 'sbm.ttl.gz'),
+            }
+            res = client.post(
+                '/api/v1/data_sets/generate',
+                data=data,
+                headers=HEADERS,
+                content_type='multipart/form-data'
+            )
+            assert res.status_code == 400
+            assert not any(Path(app.config['GENERATOR_WORKSPACE']).glob('*'))
+
+    def test_post_compressed_without_extension(self, client, users, data_sets, authorized_john, sbm_path):
+        """ 展開後の拡張子がなければRDFの形式がわからない """
+        archive = BytesIO()
+        with zipfile.ZipFile(archive, 'w') as zf:
+            zf.writestr('sbm', Path(sbm_path).read_bytes())
+        for data in (
+            {'sbm': (BytesIO(gzip.compress(Path(sbm_path).read_bytes())), 'sbm.gz')},
+            {'sbm': (BytesIO(archive.getvalue()), 'sbm.zip')},
+        ):
+            with client:
+                res = client.post(
+                    '/api/v1/data_sets/generate',
+                    data=data,
+                    headers=HEADERS,
+                    content_type='multipart/form-data'
+                )
+                assert res.status_code == 400
+                assert 'extension' in res.get_json()['message']
+                assert not any(Path(app.config['GENERATOR_WORKSPACE']).glob('*'))
+
+    def test_post_too_large(self, client, users, data_sets, authorized_john, sbm_path, mocker):
+        with client:
+            mocker.patch.dict(app.config, {'GENERATOR_MAX_UPLOAD_SIZE': 100})
+            data = {
+                'sbm': (BytesIO(Path(sbm_path).read_bytes()), 'sbm.ttl'),
+            }
+            res = client.post(
+                '/api/v1/data_sets/generate',
+                data=data,
+                headers=HEADERS,
+                content_type='multipart/form-data'
+            )
+            assert res.status_code == 413
+            assert len(generate_task_queue) == 0
+            assert not any(Path(app.config['GENERATOR_WORKSPACE']).glob('*'))
 
 
 class TestDataSetGenerateProcessStatus:
@@ -348,24 +948,18 @@ class TestDataSetGenerateProcessStatus:
             }
             assert redis_client.get(task_id) is None
 
-    def test_task_started(self, client, users, data_sets, authorized_john, task_properties_list, mocker):
-        process_mock = mocker.Mock()
-        process_mock.returncode = 0
-        mocker.patch('dbcls.api.resources.data_set.subprocess.run').return_value = process_mock
-
+    def test_task_started(self, client, users, data_sets, authorized_john, task_properties_list):
         with client:
             task_id = 'task_id_started'
             assert redis_client.get(task_id) is not None
+            redis_client.set(heartbeat_key(task_id), 1)
             res = client.get(f'/api/v1/data_sets/generate/{task_id}', headers=HEADERS)
             assert res.status_code == 204
             assert redis_client.get(task_id) is not None
 
-    def test_task_unknown_error(self, client, users, data_sets, authorized_john, task_properties_list, mocker):
-        process_mock = mocker.Mock()
-        process_mock.returncode = 1
-        mocker.patch('dbcls.api.resources.data_set.subprocess.run').return_value = process_mock
-
+    def test_task_unknown_error(self, client, users, data_sets, authorized_john, task_properties_list):
         with client:
+            # ハートビートがない
             task_id = 'task_id_started'
             assert redis_client.get(task_id) is not None
             res = client.get(f'/api/v1/data_sets/generate/{task_id}', headers=HEADERS)
@@ -373,6 +967,16 @@ class TestDataSetGenerateProcessStatus:
             assert res.get_json() == {'message': 'raised unknown error'}
             assert redis_client.get(task_id) is None
 
+    def test_task_requeued(self, client, users, data_sets, authorized_john, task_properties_list):
+        """ ハートビートが切れても処理中に残っているタスクはキューに戻されるので失敗にしない """
+        with client:
+            task_id = 'task_id_started'
+            generate_task_queue.enqueue(authorized_john.id, task_id)
+            assert generate_task_queue.dequeue() == task_id
+            res = client.get(f'/api/v1/data_sets/generate/{task_id}', headers=HEADERS)
+            assert res.status_code == 204
+            assert redis_client.get(task_id) is not None
+
     def test_task_pending(self, client, users, data_sets, authorized_john, task_properties_list):
         with client:
             task_id = 'task_id_pending'
@@ -381,6 +985,13 @@ class TestDataSetGenerateProcessStatus:
             assert res.status_code == 202
             assert redis_client.get(task_id) is not None
 
+            # キューでの順番
+            generate_task_queue.enqueue(authorized_john.id, 'task_id_other')
+            generate_task_queue.enqueue(authorized_john.id, task_id)
+            res = client.get(f'/api/v1/data_sets/generate/{task_id}', headers=HEADERS)
+            assert res.status_code == 202
+            assert res.get_json() == {'position': 1}
+
     def test_task_failure(self, client, users, data_sets, authorized_john, task_properties_list):
         with client:
             task_id = 'task_id_failure'
@@ -407,3 +1018,72 @@ class TestDataSetGenerateProcessStatus:
             assert res.status_code == 404
             assert res.get_json() == {'message': 'task not found'}
             assert redis_client.get(task_id) is not None
+
+
+class TestDataSetGenerateProcessEvents:
+    def _events(self, res):
+        return [
+            json.loads(line[len('data: '):])
+            for line in res.get_data(as_text=True).splitlines()
+            if line.startswith('data: ')
+        ]
+
+    def test_events(self, client, users, data_sets, authorized_john, task_properties_list):
+        task_id = 'task_id_success'
+        record_progress(task_id, GenerateStage.UPLOADED)
+        record_progress(task_id, GenerateStage.BUILD)
+        record_progress(task_id, GenerateStage.SUCCESS, data_set_id=data_sets[-1].id)
+        with client:
+            res = client.get(f'/api/v1/data_sets/generate/{task_id}/events', headers=HEADERS)
+            assert res.status_code == 200
+            assert res.mimetype == 'text/event-stream'
+            events = self._events(res)
+            assert [e['stage'] for e in events] == ['UPLOADED', 'BUILD', 'SUCCESS']
+            assert events[-1]['data_set_id'] == data_sets[-1].id
+
+            # 再接続したときは続きから送る
+            res = client.get(
+                f'/api/v1/data_sets/generate/{task_id}/events',
+                headers={**HEADERS, 'Last-Event-ID': '2'}
+            )
+            assert res.status_code == 200
+            assert [e['stage'] for e in self._events(res)] == ['SUCCESS']
+
+            # 終了まで受け取ったクライアントは再接続させない
+            res = client.get(
+                f'/api/v1/data_sets/generate/{task_id}/events',
+                headers={**HEADERS, 'Last-Event-ID': '3'}
+            )
+            assert res.status_code == 204
+
+    def test_poll_timeout(self, client, users, data_sets, authorized_john, task_properties_list, mocker):
+        mocker.patch('dbcls.api.resources.data_set.TASK_EVENTS_POLL_TIMEOUT', 0.1)
+        task_id = 'task_id_pending'
+        record_progress(task_id, GenerateStage.UPLOADED)
+        with client:
+            res = client.get(f'/api/v1/data_sets/generate/{task_id}/events', headers=HEADERS)
+            assert [e['stage'] for e in self._events(res)] == ['UPLOADED']
+
+            # 新しいイベントがなければ短い時間で切断して再接続させる
+            res = client.get(
+                f'/api/v1/data_sets/generate/{task_id}/events',
+                headers={**HEADERS, 'Last-Event-ID': '1'}
+            )
+            assert res.status_code == 200
+            assert res.get_data(as_text=True) == 'retry: 1000\n\n'
+
+    def test_dead_task(self, client, users, data_sets, authorized_john, task_properties_list):
+        task_id = 'task_id_started'
+        record_progress(task_id, GenerateStage.BUILD)
+        with client:
+            # ハートビートがない
+            res = client.get(f'/api/v1/data_sets/generate/{task_id}/events', headers=HEADERS)
+            assert res.status_code == 200
+            events = self._events(res)
+            assert events[-1] == {'stage': 'FAILURE', 'message': 'raised unknown error'}
+
+    def test_task_not_found(self, client, users, data_sets, authorized_john, task_properties_list):
+        with client:
+            res = client.get('/api/v1/data_sets/generate/task_id_taro_success/events', headers=HEADERS)
+            assert res.status_code == 404
+            assert res.get_json() == {'message': 'task not found'}
@@ -2,6 +2,8 @@ import json
 
 from firebase_admin.auth import AuthError
 
+from dbcls import redis_client
+from dbcls.auth import user_cache_key
 from dbcls.models import User, DataSet, UserRoleTypes
 from .fixtures import client, users, data_sets, authorized_john, user_roles
 
@@ -95,6 +97,34 @@ class TestMe:
             assert res.status_code == 401
 
 
+    def test_patch_invalidates_cache(self, client, users, user_roles, data_sets, authorized_john):
+        with client:
+            key = user_cache_key(authorized_john.firebase_uid)
+            res = client.get('/api/v1/me', headers=HEADERS)
+            assert res.status_code == 200
+            assert redis_client.exists(key)
+
+            data = json.dumps({'display_name': 'Jack'})
+            res = client.patch('/api/v1/me', data=data, headers=HEADERS, content_type='application/json')
+            assert res.status_code == 200
+            assert not redis_client.exists(key)
+
+            # 変更後の情報が返る
+            res = client.get('/api/v1/me', headers=HEADERS)
+            assert res.get_json()['display_name'] == 'Jack'
+            assert res.get_json()['roles'] == [UserRoleTypes.ADMIN.value]
+
+    def test_delete_invalidates_cache(self, client, users, data_sets, authorized_john):
+        with client:
+            key = user_cache_key(authorized_john.firebase_uid)
+            res = client.get('/api/v1/me', headers=HEADERS)
+            assert res.status_code == 200
+            assert redis_client.exists(key)
+
+            res = client.delete('/api/v1/me', headers=HEADERS)
+            assert res.status_code == 204
+            assert not redis_client.exists(key)
+
 class TestMyCustomToken:
     def test_get(self, client, users, data_sets, authorized_john, mocker):
         mocker.patch('firebase_admin.auth.get_user')
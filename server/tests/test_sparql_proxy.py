@@ -0,0 +1,188 @@
+import asyncio
+import json
+
+from aiohttp import ClientSession
+import pytest
+import redis
+
+from dbcls import binary_redis_client
+from dbcls.proxy_benchmark import create_fake_sparql_app, start_app, run_benchmark, FAKE_RESULT, FAKE_CSV_RESULT
+from dbcls.proxy_cache import ProxyResultCache, normalize_query
+from dbcls.sparql_proxy import PROXY_PATH, UpstreamResponse, create_proxy_app
+from .fixtures import client
+
+
+CONFIG = {
+    'timeout': 10,
+    'max_connections': 10,
+    'max_concurrency_per_endpoint': 2,
+    'keepalive_timeout': 60,
+}
+
+
+async def post_proxy(data, headers=None, config=CONFIG, cache=None):
+    fake_runner, fake_url = await start_app(create_fake_sparql_app(delay=0))
+    proxy_runner, proxy_url = await start_app(create_proxy_app(config, cache))
+    try:
+        data = {key: value.format(fake_url=fake_url) for key, value in data.items()}
+        async with ClientSession() as session:
+            async with session.post(f'{proxy_url}{PROXY_PATH}', data=data, headers=headers) as res:
+                return res.status, res.content_type, await res.read()
+    finally:
+        await proxy_runner.cleanup()
+        await fake_runner.cleanup()
+
+
+class TestSparqlProxy:
+    def test_query(self):
+        status, content_type, body = asyncio.run(
+            post_proxy({'endpoint': '{fake_url}/sparql', 'query': 'SELECT * WHERE {{}}'})
+        )
+        assert status == 200
+        # エンドポイントのレスポンスをそのまま返す
+        assert content_type == 'application/sparql-results+json'
+        assert json.loads(body) == FAKE_RESULT
+
+    def test_query_csv(self):
+        status, content_type, body = asyncio.run(post_proxy(
+            {'endpoint': '{fake_url}/sparql', 'query': 'SELECT * WHERE {{}}'},
+            headers={'Accept': 'text/csv'}
+        ))
+        assert status == 200
+        assert content_type == 'text/csv'
+        assert body.decode() == FAKE_CSV_RESULT
+
+    def test_result_too_large(self):
+        status, _, body = asyncio.run(post_proxy(
+            {'endpoint': '{fake_url}/sparql', 'query': 'SELECT * WHERE {{}}'},
+            config={**CONFIG, 'max_result_size': 10}
+        ))
+        assert status == 502
+        assert json.loads(body) == {'message': 'result is too large'}
+
+    def test_invalid_endpoint(self):
+        status, _, body = asyncio.run(post_proxy({'endpoint': 'file:///etc/passwd', 'query': 'SELECT * WHERE {{}}'}))
+        assert status == 400
+        assert json.loads(body) == {'message': 'endpoint is invalid'}
+
+    def test_endpoint_error(self):
+        status, _, body = asyncio.run(post_proxy({'endpoint': '{fake_url}/not_found', 'query': 'SELECT * WHERE {{}}'}))
+        assert status == 502
+        assert json.loads(body) == {'message': 'endpoint returned 404'}
+
+    def test_concurrency_per_endpoint(self):
+        result = asyncio.run(run_benchmark(CONFIG, requests=20, concurrency=10, delay=0.05))
+        assert result['succeeded'] == 20
+        assert result['max_upstream_concurrency'] == 2
+        # keep-aliveで接続を使い回す
+        assert result['upstream_connections'] == 2
+
+
+class TestUpstreamResponse:
+    def test_backpressure(self):
+        async def run():
+            upstream = UpstreamResponse(max_buffer_size=10)
+            reader = upstream.open()
+            assert await upstream.append(b'x' * 10)
+            # 読まれていないチャンクが多すぎると読まれるまで待つ
+            append = asyncio.ensure_future(upstream.append(b'y' * 10))
+            await asyncio.sleep(0.01)
+            assert not append.done()
+
+            assert await reader.__anext__() == b'x' * 10
+            assert await append
+            # 読まれたチャンクは残さない
+            assert upstream.chunks == [b'y' * 10]
+            assert not upstream.joinable
+
+            # 読み手がいなくなれば続きは読まない
+            reader.close()
+            assert not await upstream.append(b'z')
+
+        asyncio.run(run())
+
+    def test_retain(self):
+        async def run():
+            upstream = UpstreamResponse(retain=True, max_buffer_size=10)
+            first = upstream.open()
+            for chunk in (b'x' * 10, b'y' * 10):
+                assert await upstream.append(chunk)
+            assert await first.__anext__() == b'x' * 10
+            # キャッシュに保存するまで残すので、後から加わっても最初から読める
+            assert upstream.joinable
+            second = upstream.open()
+            upstream.finish()
+            assert [chunk async for chunk in second] == [b'x' * 10, b'y' * 10]
+            second.close()
+
+            # 保存しないことになったら読まれたチャンクを捨てる
+            upstream.release()
+            assert upstream.chunks == [b'y' * 10]
+            assert [chunk async for chunk in first] == [b'y' * 10]
+
+        asyncio.run(run())
+
+
+@pytest.fixture
+def proxy_cache(client):
+    return ProxyResultCache(binary_redis_client, default_ttl=60, ttls={'127.0.0.1:1': 0})
+
+
+async def post_proxy_concurrently(cache, times):
+    fake_app = create_fake_sparql_app(delay=0.1)
+    fake_runner, fake_url = await start_app(fake_app)
+    proxy_runner, proxy_url = await start_app(create_proxy_app(CONFIG, cache))
+    try:
+        async with ClientSession() as session:
+            async def send(query):
+                data = {'endpoint': f'{fake_url}/sparql', 'query': query}
+                async with session.post(f'{proxy_url}{PROXY_PATH}', data=data) as res:
+                    return res.headers['X-Proxy-Cache'], json.loads(await res.read())
+
+            results = await asyncio.gather(*(
+                send('SELECT * WHERE {\n  ?s ?p ?o # comment\n}') for _ in range(times)
+            ))
+            # 空白とコメントの違いは同じクエリとして扱う
+            results.append(await send('SELECT * WHERE { ?s ?p ?o }'))
+    finally:
+        await proxy_runner.cleanup()
+        await fake_runner.cleanup()
+    return fake_app['stats']['requests'], results
+
+
+class TestProxyResultCache:
+    def test_normalize_query(self):
+        query = 'SELECT ?s  WHERE {\n  ?s rdfs:label "a  # b" . # comment\n  ?s ?p <http://example.com/#x>\n}'
+        assert normalize_query(query) == 'SELECT ?s WHERE { ?s rdfs:label "a  # b" . ?s ?p <http://example.com/#x> }'
+
+    def test_ttl(self, proxy_cache):
+        assert proxy_cache.ttl('http://127.0.0.1:1/sparql') == 0
+        assert proxy_cache.ttl('http://example.com/sparql') == 60
+
+    def test_coalesce_and_cache(self, proxy_cache):
+        upstream_requests, results = asyncio.run(post_proxy_concurrently(proxy_cache, 5))
+        # 同時に送られた同じクエリは1回だけ問い合わせる
+        assert upstream_requests == 1
+        assert [status for status, _ in results] == ['MISS'] * 5 + ['HIT']
+        assert all(result == FAKE_RESULT for _, result in results)
+
+    def test_redis_error(self, mocker):
+        redis_mock = mocker.Mock()
+        redis_mock.get.side_effect = redis.ConnectionError('redis is down')
+        redis_mock.set.side_effect = redis.ConnectionError('redis is down')
+        status, _, body = asyncio.run(post_proxy(
+            {'endpoint': '{fake_url}/sparql', 'query': 'SELECT * WHERE {{}}'},
+            cache=ProxyResultCache(redis_mock)
+        ))
+        # キャッシュが使えなくても問い合わせた結果を返す
+        assert status == 200
+        assert json.loads(body) == FAKE_RESULT
+        assert redis_mock.set.call_count == 1
+
+    def test_too_large_to_cache(self, proxy_cache):
+        proxy_cache.max_size = 10
+        upstream_requests, results = asyncio.run(post_proxy_concurrently(proxy_cache, 1))
+        # キャッシュに保存できない大きさの結果は保存しない
+        assert upstream_requests == 2
+        assert [status for status, _ in results] == ['MISS', 'MISS']
+        assert all(result == FAKE_RESULT for _, result in results)
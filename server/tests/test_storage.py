@@ -0,0 +1,67 @@
+import gzip
+import os
+
+import pytest
+
+from dbcls.storage import LocalContentStorage, create_content_storage
+
+
+@pytest.fixture
+def storage(tmp_path):
+    return LocalContentStorage(tmp_path.as_posix())
+
+
+class TestLocalContentStorage:
+    def test_put_and_get(self, storage):
+        data = b'{"meta_data": {}}' * 100
+        stored = storage.put(data)
+        assert stored.size == len(data)
+        assert stored.stored_size < stored.size
+        assert storage.exists(stored.content_hash)
+        assert storage.get(stored.content_hash) == data
+
+    def test_deduplicate(self, storage):
+        data = b'{"meta_data": {}}'
+        first = storage.put(data)
+        second = storage.put(data)
+        assert first == second
+        assert list(storage.content_hashes()) == [first.content_hash]
+
+    def test_deduplicate_touches(self, storage):
+        """ 同じ内容を保存し直したら削除の対象にしない """
+        data = b'{"meta_data": {}}'
+        stored = storage.put(data)
+        path, _ = storage._find(stored.content_hash)
+        os.utime(path, (0, 0))
+        assert list(storage.content_hashes(older_than=60)) == [stored.content_hash]
+        storage.put(data)
+        assert list(storage.content_hashes(older_than=60)) == []
+
+    def test_compressed_file(self, storage, tmp_path):
+        stored = storage.put(b'{}')
+        path = next(tmp_path.glob('*/*/*'))
+        assert gzip.decompress(path.read_bytes()) == b'{}'
+
+        # 圧縮レベルを変えても読める
+        other = LocalContentStorage(tmp_path.as_posix(), level=1)
+        assert other.get(stored.content_hash) == b'{}'
+
+    def test_delete(self, storage):
+        stored = storage.put(b'{}')
+        storage.delete(stored.content_hash)
+        assert not storage.exists(stored.content_hash)
+        with pytest.raises(FileNotFoundError):
+            storage.get(stored.content_hash)
+
+    def test_content_hashes_older_than(self, storage):
+        storage.put(b'{}')
+        assert list(storage.content_hashes(older_than=60)) == []
+
+
+def test_create_content_storage(tmp_path):
+    storage = create_content_storage({
+        'backend': 'dbcls.storage.LocalContentStorage',
+        'root': tmp_path.as_posix(),
+        'compression': 'gzip',
+    })
+    assert isinstance(storage, LocalContentStorage)
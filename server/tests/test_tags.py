@@ -0,0 +1,30 @@
+from dbcls import db
+from dbcls.models import DataSet, Tag
+from .fixtures import client, users, public_data_sets
+
+
+class TestTagList:
+    def test_prefix(self, client, users, public_data_sets):
+        """ 前方一致するタグを公開DataSetの多い順に返す """
+        with client:
+            res = client.get('/api/v1/tags', query_string={'prefix': 'タグ'})
+            assert res.status_code == 200
+            assert [(t['name'], t['public_count']) for t in res.get_json()['tags']] == [('タグ2x', 14), ('タグ3x', 9)]
+
+            res = client.get('/api/v1/tags', query_string={'size': 1})
+            assert [t['name'] for t in res.get_json()['tags']] == ['タグ2x']
+
+            # LIKEのワイルドカードはそのまま比較する
+            res = client.get('/api/v1/tags', query_string={'prefix': '%'})
+            assert res.get_json()['tags'] == []
+
+    def test_public_count(self, client, users, public_data_sets):
+        """ 非公開にしたDataSetは数えず、公開DataSetがなくなったタグは返さない """
+        data_set = DataSet.query.filter_by(title='タイトル24').first()
+        data_set.is_public = False
+        db.session.commit()
+        assert Tag.query.filter_by(name='タグ2x').first().public_count == 13
+        assert Tag.query.filter_by(name='タグ3x').first().public_count == 8
+        with client:
+            res = client.get('/api/v1/tags', query_string={'prefix': 'タイ'})
+            assert res.get_json()['tags'] == []
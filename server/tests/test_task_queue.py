@@ -0,0 +1,62 @@
+from dbcls.task_queue import FairTaskQueue
+from .fixtures import client
+
+
+class TestFairTaskQueue:
+    def test_round_robin(self, client):
+        queue = FairTaskQueue('test')
+        for task_id in ('a1', 'a2', 'a3'):
+            queue.enqueue(1, task_id)
+        queue.enqueue(2, 'b1')
+        queue.enqueue(3, 'c1')
+        queue.enqueue(2, 'b2')
+        assert len(queue) == 6
+
+        # ユーザーごとに順番に取り出す
+        assert [queue.dequeue() for _ in range(6)] == ['a1', 'b1', 'c1', 'a2', 'b2', 'a3']
+        assert queue.dequeue() is None
+        assert len(queue) == 0
+
+    def test_position(self, client):
+        queue = FairTaskQueue('test')
+        for task_id in ('a1', 'a2', 'a3'):
+            queue.enqueue(1, task_id)
+        queue.enqueue(2, 'b1')
+        queue.enqueue(3, 'c1')
+        queue.enqueue(2, 'b2')
+
+        expected = ['a1', 'b1', 'c1', 'a2', 'b2', 'a3']
+        for position, task_id in enumerate(expected):
+            user_id = {'a': 1, 'b': 2, 'c': 3}[task_id[0]]
+            assert queue.position(user_id, task_id) == position
+        assert queue.position(1, 'b1') is None
+        assert queue.position(4, 'd1') is None
+
+    def test_requeue(self, client):
+        queue = FairTaskQueue('test')
+        queue.enqueue(1, 'a1')
+        queue.enqueue(1, 'a2')
+        queue.enqueue(2, 'b1')
+        assert queue.dequeue() == 'a1'
+        assert queue.stale(0) == ['a1']
+
+        # 処理中に終了したタスクはユーザーのキューの先頭に戻る
+        assert queue.requeue('a1')
+        assert not queue.requeue('a1')
+        assert queue.stale(0) == []
+        assert [queue.dequeue() for _ in range(3)] == ['b1', 'a1', 'a2']
+        assert queue.attempts('a1') == 2
+
+        for task_id in ('a1', 'a2', 'b1'):
+            queue.ack(task_id)
+        assert queue.stale(0) == []
+        assert queue.attempts('a1') == 0
+
+    def test_requeue_empty_user(self, client):
+        queue = FairTaskQueue('test')
+        queue.enqueue(1, 'a1')
+        assert queue.dequeue() == 'a1'
+        assert queue.dequeue() is None
+        # キューが空になったユーザーも順番待ちに戻る
+        assert queue.requeue('a1')
+        assert queue.dequeue() == 'a1'
@@ -1,8 +1,44 @@
+import json
 from pathlib import Path
+import subprocess
+import time
 
+import pytest
+
+from dbcls import app, redis_client
 from dbcls.models import User, DataSet
-from dbcls.tasks import generate_by_umakaparser
-from .fixtures import client, users, data_sets, ontology_path, sbm_path
+from dbcls.task_queue import FairTaskQueue
+from dbcls.tasks import (
+    generate_by_umakaparser, Heartbeat, heartbeat_key, recover_tasks, TaskState, UmakaparserState, ProcessErrorType
+)
+from .fixtures import client, users, data_sets, ontology_path, sbm_path, ttl_path
+
+
+GENERATED_CONTENT = {
+    'meta_data': {
+        'properties': 1,
+        'triples': 1,
+        'classes': 1,
+        'endpoint': 'http://example.com/sparql',
+        'crawl_date': '2015/12/31 14:18:17'
+    }
+}
+
+
+@pytest.fixture
+def umakaparser_mock(mocker):
+    """ ConvRDFとumakaparserを実行せずに結果のファイルを書き出す """
+    def run(args, stdout=None, stderr=None, **kwargs):
+        if args[0] == 'java':
+            stdout.write(b'<http://example.com/s> <http://example.com/p> <http://example.com/o> .\n')
+            return subprocess.CompletedProcess(args, 0, None, b'')
+        if args[1] == 'build-index':
+            Path(args[args.index('-d') + 1], 'labels.json').write_text('{}')
+        else:
+            Path(args[args.index('-d') + 1]).write_text(json.dumps(GENERATED_CONTENT))
+        return subprocess.CompletedProcess(args, 0, '', '')
+
+    return mocker.patch('dbcls.tasks.subprocess.run', side_effect=run)
 
 
 class TestGenerateByUmakaparser:
@@ -15,3 +51,93 @@ class TestGenerateByUmakaparser:
             assert user_data_set_query.count() == previous_count + 1
             assert not Path(ontology_path).exists()
             assert not Path(sbm_path).exists()
+
+    def test_reuse_index_assets(self, client, users, umakaparser_mock):
+        with client:
+            user_id = User.query.first().id
+            for _ in range(2):
+                generate_by_umakaparser(user_id, next(ttl_path('sbm.ttl')), next(ttl_path('ontology.ttl')))
+            assert DataSet.query.filter_by(user_id=user_id).count() == 2
+            # 2回目は同じオントロジーなのでbuild-indexを実行しない
+            commands = [call.args[0][:2] for call in umakaparser_mock.call_args_list]
+            assert commands == [['umakaparser', 'build-index'], ['umakaparser', 'build'], ['umakaparser', 'build']]
+
+    def test_reuse_converted_ontology(self, client, users, umakaparser_mock, tmp_path):
+        with client:
+            user_id = User.query.first().id
+            for i in range(2):
+                # ConvRDFで変換する形式のオントロジー
+                ontology = tmp_path / f'ontology{i}.rdf'
+                ontology.write_text('<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"/>')
+                generate_by_umakaparser(user_id, next(ttl_path('sbm.ttl')), ontology.as_posix())
+            assert DataSet.query.filter_by(user_id=user_id).count() == 2
+            # 2回目は同じ内容なので変換もbuild-indexも実行しない
+            commands = [call.args[0][:2] for call in umakaparser_mock.call_args_list]
+            assert commands == [
+                ['java', '-jar'], ['umakaparser', 'build-index'], ['umakaparser', 'build'], ['umakaparser', 'build']
+            ]
+
+    def test_convert_error(self, client, users, tmp_path, mocker, caplog):
+        mocker.patch('dbcls.tasks.subprocess.run').return_value = subprocess.CompletedProcess(
+            [], 1, None, b'ontology is broken'
+        )
+        redis_client.set('task_id', json.dumps({'state': UmakaparserState.PENDING.value}))
+        ontology = tmp_path / 'ontology.rdf'
+        ontology.write_text('broken')
+        with client:
+            generate_by_umakaparser(User.query.first().id, next(ttl_path('sbm.ttl')), ontology.as_posix(), 'task_id')
+        task_properties = json.loads(redis_client.get('task_id'))
+        assert task_properties['state'] == UmakaparserState.FAILURE.value
+        assert task_properties['message'] == ProcessErrorType.CONVERT_ERROR.value
+        # ConvRDFのエラー出力はログに残す
+        assert 'ontology is broken' in caplog.text
+        # 失敗した変換結果はキャッシュしない
+        assert not any(Path(app.config['CONVERTED_ONTOLOGY_CACHE']['root']).glob('*'))
+
+
+class TestHeartbeat:
+    def test_heartbeat(self, client):
+        with Heartbeat('task_id', interval=0.2, expire=1):
+            assert redis_client.exists(heartbeat_key('task_id'))
+            # 期限が切れる前に更新される
+            time.sleep(1.5)
+            assert redis_client.exists(heartbeat_key('task_id'))
+        assert not redis_client.exists(heartbeat_key('task_id'))
+
+
+class TestRecoverTasks:
+    def _task(self, queue, task_id, state):
+        redis_client.set(task_id, json.dumps({'state': state.value}))
+        queue.enqueue(1, task_id)
+        assert queue.dequeue() == task_id
+
+    def test_recover(self, client, mocker):
+        mocker.patch('dbcls.tasks.TASK_HEARTBEAT_EXPIRE', 0)
+        queue = FairTaskQueue('test')
+        # ワーカーが終了したタスク、処理中のタスク、終わってからackする前に終了したタスク
+        self._task(queue, 'dead', TaskState.STARTED)
+        self._task(queue, 'running', TaskState.STARTED)
+        redis_client.set(heartbeat_key('running'), 1)
+        self._task(queue, 'done', TaskState.SUCCESS)
+
+        recover_tasks(queue)
+        assert queue.stale(0) == ['running']
+        assert json.loads(redis_client.get('dead'))['state'] == TaskState.PENDING.value
+        assert queue.dequeue() == 'dead'
+        assert queue.dequeue() is None
+
+    def test_give_up(self, client, mocker):
+        mocker.patch('dbcls.tasks.TASK_HEARTBEAT_EXPIRE', 0)
+        mocker.patch('dbcls.tasks.TASK_MAX_ATTEMPTS', 2)
+        queue = FairTaskQueue('test')
+        self._task(queue, 'dead', TaskState.STARTED)
+        recover_tasks(queue)
+        assert queue.dequeue() == 'dead'
+
+        # 上限まで取り出したタスクは戻さずに失敗にする
+        recover_tasks(queue)
+        assert queue.stale(0) == []
+        assert queue.dequeue() is None
+        task_properties = json.loads(redis_client.get('dead'))
+        assert task_properties['state'] == TaskState.FAILURE.value
+        assert task_properties['message'] == 'worker stopped while processing the task'